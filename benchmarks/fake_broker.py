@@ -0,0 +1,294 @@
+"""
+In-process mqtt broker stand-in.
+
+It speaks just enough mqtt 3.1.1 and mqtt 5 to drive the AsyncMqttClient
+on plain CPython: CONNECT, SUBSCRIBE and UNSUBSCRIBE (with wildcards),
+PUBLISH qos 0/1 with fan out to the subscribers, the client to broker
+topic aliases of mqtt 5, PINGREQ and DISCONNECT. There is no session
+state, no retained messages and no authentication. Given an SSL
+context the broker listens over TLS, the context decides whether the
+TLS sessions can be resumed (OpenSSL issues session tickets by default).
+"""
+import asyncio
+
+from mqtt_protocol import (
+    CONNECT,
+    DISCONNECT,
+    PINGREQ,
+    PINGRESP_PACKET,
+    PUBLISH,
+    SUBACK,
+    SUBSCRIBE,
+    UNSUBACK,
+    UNSUBSCRIBE,
+    PROPERTY_TOPIC_ALIAS,
+    PROPERTY_TOPIC_ALIAS_MAXIMUM,
+    PROTOCOL_LEVEL_3_1_1,
+    PROTOCOL_LEVEL_5,
+    MqttProtocolError,
+    encode_properties,
+    encode_remaining_length,
+    parse_packet_id,
+    parse_properties,
+    parse_publish,
+    puback_packet,
+    publish_packet,
+)
+from topic_router import TopicRouter
+
+
+class _Session:
+    """ A client connected to the fake broker. """
+    def __init__(self, writer) -> None:
+        self.writer = writer
+        self.filters = []
+        self.task = asyncio.current_task()
+        self.protocol_level = PROTOCOL_LEVEL_3_1_1
+        self.aliases = {}
+
+
+class FakeBroker:
+    """
+    Minimal asyncio mqtt broker.
+
+    Attributes
+    ----------
+    host : the listening address.
+    port : the listening port, 0 picks a free one at start time.
+    ack_delay_ms : a delay applied to the PUBACK, to emulate the round
+    trip time of a real network.
+    received_count : the number of PUBLISH packets received.
+    received_bytes : the size of the PUBLISH packets received, headers
+    included.
+    topic_alias_maximum : the topic aliases accepted from a mqtt 5
+    client.
+    ssl_context : the server SSL context, None to listen over plain tcp.
+    """
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        ack_delay_ms: int = 0,
+        topic_alias_maximum: int = 16,
+        ssl_context=None
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.ack_delay_ms = ack_delay_ms
+        self.topic_alias_maximum = topic_alias_maximum
+        self.ssl_context = ssl_context
+        self.received_count = 0
+        self.received_bytes = 0
+        self._router = TopicRouter()
+        self._server = None
+        self._sessions = []
+        self._received_event = asyncio.Event()
+
+    async def start(self) -> None:
+        """ Start listening. """
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port, ssl=self.ssl_context
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """ Close the server and every client connection. """
+        tasks = [session.task for session in self._sessions]
+        for session in self._sessions:
+            session.writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def wait_received(self, count: int) -> None:
+        """ Wait until count PUBLISH packets have been received. """
+        while self.received_count < count:
+            self._received_event.clear()
+            await self._received_event.wait()
+
+    async def _read_packet(self, reader) -> tuple:
+        """ Read a whole packet, returning (first_byte, body). """
+        first_byte = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length |= (digit & 0x7F) << shift
+            if not digit & 0x80:
+                break
+            shift += 7
+        body = await reader.readexactly(length) if length else b""
+        return first_byte, body
+
+    async def _handle_client(self, reader, writer) -> None:
+        """ Serve a client until it disconnects. """
+        session = _Session(writer)
+        self._sessions.append(session)
+        try:
+            while True:
+                first_byte, body = await self._read_packet(reader)
+                packet_type = first_byte & 0xF0
+                if packet_type == CONNECT:
+                    self._connect(session, body)
+                elif packet_type == SUBSCRIBE & 0xF0:
+                    self._subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE & 0xF0:
+                    self._unsubscribe(session, body)
+                elif packet_type == PUBLISH:
+                    self.received_bytes += (
+                        1 + len(encode_remaining_length(len(body)))
+                        + len(body)
+                    )
+                    self._publish(session, first_byte, body)
+                elif packet_type == PINGREQ:
+                    writer.write(PINGRESP_PACKET)
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (OSError, EOFError, MqttProtocolError):
+            pass
+        finally:
+            for topic_filter in session.filters:
+                self._router.remove(topic_filter, session)
+            self._sessions.remove(session)
+            writer.close()
+
+    def _connect(self, session: _Session, body: bytes) -> None:
+        """ Answer a CONNECT, announcing the topic aliases in mqtt 5. """
+        # the protocol level follows the "MQTT" protocol name
+        session.protocol_level = body[6]
+        if session.protocol_level != PROTOCOL_LEVEL_5:
+            session.writer.write(b"\x20\x02\x00\x00")
+            return
+        properties = encode_properties(
+            [(PROPERTY_TOPIC_ALIAS_MAXIMUM, self.topic_alias_maximum)]
+        )
+        session.writer.write(
+            b"\x20"
+            + encode_remaining_length(2 + len(properties))
+            + b"\x00\x00"
+            + properties
+        )
+
+    def _subscribe(self, session: _Session, body: bytes) -> None:
+        """ Register the topic filters of a SUBSCRIBE packet. """
+        pid = parse_packet_id(body)
+        offset = 2
+        v5 = session.protocol_level == PROTOCOL_LEVEL_5
+        if v5:
+            offset = parse_properties(body, offset)[1]
+        granted = bytearray(b"\x00" if v5 else b"")
+        while offset < len(body):
+            length = (body[offset] << 8) | body[offset + 1]
+            topic_filter = body[offset + 2:offset + 2 + length].decode()
+            offset += 2 + length
+            granted.append(min(body[offset], 1))
+            offset += 1
+            self._router.add(topic_filter, session)
+            session.filters.append(topic_filter)
+        session.writer.write(
+            bytes([SUBACK])
+            + encode_remaining_length(2 + len(granted))
+            + body[:2]
+            + bytes(granted)
+        )
+
+    def _unsubscribe(self, session: _Session, body: bytes) -> None:
+        """ Remove the topic filters of an UNSUBSCRIBE packet. """
+        offset = 2
+        v5 = session.protocol_level == PROTOCOL_LEVEL_5
+        if v5:
+            offset = parse_properties(body, offset)[1]
+        count = 0
+        while offset < len(body):
+            length = (body[offset] << 8) | body[offset + 1]
+            topic_filter = body[offset + 2:offset + 2 + length].decode()
+            offset += 2 + length
+            count += 1
+            if topic_filter in session.filters:
+                self._router.remove(topic_filter, session)
+                session.filters.remove(topic_filter)
+        # mqtt 5 acknowledges every filter with a reason code
+        payload = b"\x00" + bytes(count) if v5 else b""
+        session.writer.write(
+            bytes([UNSUBACK])
+            + encode_remaining_length(2 + len(payload))
+            + body[:2]
+            + payload
+        )
+
+    def _publish(
+        self,
+        session: _Session,
+        first_byte: int,
+        body: bytes
+    ) -> None:
+        """ Acknowledge a PUBLISH and forward it to the subscribers. """
+        if session.protocol_level == PROTOCOL_LEVEL_5:
+            topic, msg, qos, pid = self._parse_publish_v5(
+                session, first_byte, body
+            )
+        else:
+            topic, msg, qos, pid = parse_publish(first_byte, body)
+        self.received_count += 1
+        self._received_event.set()
+        if qos:
+            if self.ack_delay_ms:
+                asyncio.get_running_loop().call_later(
+                    self.ack_delay_ms / 1000,
+                    session.writer.write,
+                    puback_packet(pid)
+                )
+            else:
+                session.writer.write(puback_packet(pid))
+        subscribers = []
+        for subscriber in self._router.match(topic.decode()):
+            if subscriber not in subscribers:
+                subscribers.append(subscriber)
+        if not subscribers:
+            return
+        # forwarded at qos 0 with the full topic, without any alias
+        packets = {}
+        for subscriber in subscribers:
+            level = subscriber.protocol_level
+            if level not in packets:
+                packets[level] = publish_packet(
+                    topic,
+                    msg,
+                    properties=b"\x00" if level == PROTOCOL_LEVEL_5 else None
+                )
+            subscriber.writer.write(packets[level])
+
+    def _parse_publish_v5(
+        self,
+        session: _Session,
+        first_byte: int,
+        body: bytes
+    ) -> tuple:
+        """
+        Parse a mqtt 5 PUBLISH, resolving its topic alias.
+
+        Returns
+        -------
+        tuple : (topic, msg, qos, pid) like parse_publish.
+        """
+        qos = (first_byte >> 1) & 0x03
+        length = (body[0] << 8) | body[1]
+        topic = body[2:2 + length]
+        offset = 2 + length
+        pid = 0
+        if qos:
+            pid = (body[offset] << 8) | body[offset + 1]
+            offset += 2
+        properties, offset = parse_properties(body, offset)
+        alias = properties.get(PROPERTY_TOPIC_ALIAS)
+        if alias is not None:
+            if alias > self.topic_alias_maximum:
+                raise MqttProtocolError(f"topic alias {alias} invalid")
+            if topic:
+                session.aliases[alias] = topic
+            elif alias in session.aliases:
+                topic = session.aliases[alias]
+            else:
+                raise MqttProtocolError(f"unknown topic alias {alias}")
+        return topic, body[offset:], qos, pid
@@ -0,0 +1,389 @@
+"""
+Throughput and latency benchmarks of the mqtt engine.
+
+The benchmarks run on plain CPython against the in-process FakeBroker,
+they exercise the components MqttManager delegates to in async mode
+(AsyncMqttClient, PublishOutbox, FastPublishFrames) since MqttManager
+itself needs the device hardware.
+
+Usage, from the repository root:
+
+    python -m benchmarks.mqtt_bench [--count N] [--output results.json]
+        [--tls-cert cert.pem --tls-key key.pem]
+
+The results are printed (or written) as json, one entry per scenario
+and payload size, with the messages per second, the p50/p99 latencies
+in microseconds and the memory allocated during the run. With a TLS
+certificate the connect latency of the TLS connections is measured too,
+with full handshakes only and with the sessions resumed.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import ssl
+import struct
+import sys
+import time
+import tracemalloc
+
+from benchmarks.fake_broker import FakeBroker
+from device_logging import LOG_LEVELS
+from fast_publish import FastPublishFrames
+from mqtt_engine import AsyncMqttClient
+from mqtt_outbox import PublishOutbox
+from mqtt_protocol import PROTOCOL_LEVEL_3_1_1, PROTOCOL_LEVEL_5
+from tls import TlsContext
+
+PAYLOAD_SIZES = (16, 256, 1024)
+QOS1_WINDOWS = (1, 16)
+SUBSCRIBE_WINDOW = 16
+TLS_CONNECTS = 50
+BENCH_TOPIC = "bench/device/sensor/value"
+SCHEMA_VERSION = 1
+
+
+def percentile(samples: list, fraction: float):
+    """ Return the fraction percentile of samples (nearest rank). """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class AllocationMeter:
+    """
+    Measure the memory allocated while running a scenario.
+
+    The peak traced bytes come from tracemalloc, the net blocks are the
+    python objects still allocated at the end of the run.
+    """
+    def __enter__(self):
+        gc.collect()
+        tracemalloc.start()
+        self._blocks = sys.getallocatedblocks()
+        self.peak_bytes = 0
+        self.net_blocks = 0
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.net_blocks = sys.getallocatedblocks() - self._blocks
+
+
+def result(
+    scenario: str,
+    payload_size: int,
+    count: int,
+    elapsed_ns: int,
+    latencies_ns: list,
+    meter: AllocationMeter,
+    **extra
+) -> dict:
+    """ Build the json entry of a scenario run. """
+    entry = {
+        "scenario": scenario,
+        "payload_size": payload_size,
+        "messages": count,
+        "msgs_per_s": round(count * 1e9 / elapsed_ns, 1),
+        "p50_us": None,
+        "p99_us": None,
+        "peak_alloc_bytes": meter.peak_bytes,
+        "peak_alloc_bytes_per_msg": round(meter.peak_bytes / count, 1),
+        "net_alloc_blocks": meter.net_blocks,
+    }
+    if latencies_ns:
+        entry["p50_us"] = round(percentile(latencies_ns, 0.50) / 1000, 1)
+        entry["p99_us"] = round(percentile(latencies_ns, 0.99) / 1000, 1)
+    entry.update(extra)
+    return entry
+
+
+async def connected_client(broker: FakeBroker, name: str, **kwargs):
+    """ Return an AsyncMqttClient connected to the broker. """
+    client = AsyncMqttClient(name, broker.host, broker.port, **kwargs)
+    client.logger.level = LOG_LEVELS["CRITICAL"]
+    await client.connect()
+    return client
+
+
+async def bench_publish(
+    broker: FakeBroker,
+    size: int,
+    count: int,
+    protocol_level: int = PROTOCOL_LEVEL_3_1_1
+) -> dict:
+    """
+    Qos 0 publish, latency of each publish call, with mqtt 5 the topic
+    is replaced by its alias after the first message.
+    """
+    client = await connected_client(
+        broker, "bench-pub", protocol_level=protocol_level
+    )
+    payload = bytes(size)
+    latencies = []
+    target = broker.received_count + count
+    received_bytes = broker.received_bytes
+    with AllocationMeter() as meter:
+        started = time.perf_counter_ns()
+        for _ in range(count):
+            sent = time.perf_counter_ns()
+            await client.publish(BENCH_TOPIC, payload)
+            latencies.append(time.perf_counter_ns() - sent)
+        await broker.wait_received(target)
+        elapsed = time.perf_counter_ns() - started
+    await client.disconnect()
+    scenario = "publish_qos0"
+    if protocol_level == PROTOCOL_LEVEL_5:
+        scenario = "publish_qos0_v5"
+    return result(
+        scenario,
+        size,
+        count,
+        elapsed,
+        latencies,
+        meter,
+        wire_bytes_per_msg=round(
+            (broker.received_bytes - received_bytes) / count, 1
+        )
+    )
+
+
+async def bench_fast_publish(
+    broker: FakeBroker,
+    size: int,
+    count: int
+) -> dict:
+    """ Pre-encoded frame written as is, latency of each write. """
+    client = await connected_client(broker, "bench-fast")
+    frames = FastPublishFrames()
+    frames.add("bench", BENCH_TOPIC, bytes(size))
+    frame = frames.frame("bench")
+    latencies = []
+    target = broker.received_count + count
+    with AllocationMeter() as meter:
+        started = time.perf_counter_ns()
+        for _ in range(count):
+            sent = time.perf_counter_ns()
+            await client.write_raw(frame)
+            latencies.append(time.perf_counter_ns() - sent)
+        await broker.wait_received(target)
+        elapsed = time.perf_counter_ns() - started
+    await client.disconnect()
+    return result("fast_publish", size, count, elapsed, latencies, meter)
+
+
+async def bench_publish_qos1(
+    broker: FakeBroker,
+    size: int,
+    count: int,
+    window: int
+) -> dict:
+    """
+    Qos 1 publish through the outbox, latency from queue to PUBACK.
+    A new message is queued only when the window has a free slot, so the
+    latency does not include the time spent waiting in the queue.
+    """
+    client = AsyncMqttClient("bench-qos1", broker.host, broker.port)
+    client.logger.level = LOG_LEVELS["CRITICAL"]
+    client.outbox = PublishOutbox(client, window=window, max_queued=count)
+    queued_at = {}
+    latencies = []
+    acked = client.outbox.ack
+
+    def timed_ack(pid: int) -> None:
+        entry = client.outbox.in_flight.get(pid)
+        if entry is not None:
+            latencies.append(time.perf_counter_ns() - queued_at[entry[1]])
+        acked(pid)
+
+    client.outbox.ack = timed_ack
+    await client.connect()
+    padding = bytes(max(size - 4, 0))
+    payloads = [struct.pack("!I", i) + padding for i in range(count)]
+    with AllocationMeter() as meter:
+        started = time.perf_counter_ns()
+        for payload in payloads:
+            while client.outbox.pending_count() >= window:
+                await asyncio.sleep(0)
+            queued_at[payload] = time.perf_counter_ns()
+            await client.publish(BENCH_TOPIC, payload, qos=1)
+        while client.outbox.pending_count():
+            await asyncio.sleep(0.0005)
+        elapsed = time.perf_counter_ns() - started
+    await client.disconnect()
+    return result(
+        "publish_qos1",
+        size,
+        count,
+        elapsed,
+        latencies,
+        meter,
+        window=window,
+        ack_delay_ms=broker.ack_delay_ms,
+        retries=client.outbox.retry_count
+    )
+
+
+async def bench_subscribe_receive(
+    broker: FakeBroker,
+    size: int,
+    count: int
+) -> dict:
+    """
+    Publish to a subscribed topic, latency from publish to callback.
+    At most SUBSCRIBE_WINDOW messages are on their way at once.
+    """
+    latencies = []
+    done = asyncio.Event()
+
+    def on_message(topic: bytes, msg: bytes) -> None:
+        latencies.append(
+            time.perf_counter_ns() - struct.unpack_from("!Q", msg)[0]
+        )
+        if len(latencies) == count:
+            done.set()
+
+    subscriber = await connected_client(
+        broker, "bench-sub", on_message=on_message
+    )
+    await subscriber.subscribe("bench/+/sensor/#")
+    publisher = await connected_client(broker, "bench-pub")
+    padding = bytes(max(size - 8, 0))
+    with AllocationMeter() as meter:
+        started = time.perf_counter_ns()
+        for sent in range(count):
+            while sent - len(latencies) >= SUBSCRIBE_WINDOW:
+                await asyncio.sleep(0)
+            await publisher.publish(
+                BENCH_TOPIC,
+                struct.pack("!Q", time.perf_counter_ns()) + padding
+            )
+        await done.wait()
+        elapsed = time.perf_counter_ns() - started
+    await publisher.disconnect()
+    await subscriber.disconnect()
+    return result(
+        "subscribe_receive", size, count, elapsed, latencies, meter
+    )
+
+
+async def bench_tls_connect(
+    broker: FakeBroker,
+    connects: int,
+    resumption: bool
+) -> dict:
+    """
+    Connect and disconnect over TLS, latency of each connection (tcp,
+    TLS and mqtt handshakes), every connection after the first one
+    resuming the TLS session of the previous one if resumption is set.
+    """
+    tls = TlsContext(resumption=resumption)
+    tls.logger.level = LOG_LEVELS["CRITICAL"]
+    client = AsyncMqttClient(
+        "bench-tls", broker.host, broker.port, tls=tls
+    )
+    client.logger.level = LOG_LEVELS["CRITICAL"]
+    latencies = []
+    with AllocationMeter() as meter:
+        started = time.perf_counter_ns()
+        for _ in range(connects):
+            connect_started = time.perf_counter_ns()
+            await client.connect()
+            latencies.append(time.perf_counter_ns() - connect_started)
+            await client.disconnect()
+        elapsed = time.perf_counter_ns() - started
+    scenario = "tls_connect_resumed" if resumption else "tls_connect_full"
+    return result(
+        scenario,
+        0,
+        connects,
+        elapsed,
+        latencies,
+        meter,
+        full_handshakes=tls.full_count,
+        resumed_handshakes=tls.resumed_count
+    )
+
+
+async def run_tls_benchmarks(cert_file: str, key_file: str) -> list:
+    """ Run the TLS connect scenarios against a TLS fake broker. """
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert_file, key_file)
+    broker = FakeBroker(ssl_context=ssl_context)
+    await broker.start()
+    results = [
+        await bench_tls_connect(broker, TLS_CONNECTS, False),
+        await bench_tls_connect(broker, TLS_CONNECTS, True),
+    ]
+    await broker.stop()
+    return results
+
+
+async def run_benchmarks(
+    count: int,
+    ack_delay_ms: int,
+    cert_file: str = None,
+    key_file: str = None
+) -> dict:
+    """ Run every scenario and return the json report. """
+    broker = FakeBroker(ack_delay_ms=ack_delay_ms)
+    await broker.start()
+    results = []
+    for size in PAYLOAD_SIZES:
+        results.append(await bench_publish(broker, size, count))
+        results.append(
+            await bench_publish(broker, size, count, PROTOCOL_LEVEL_5)
+        )
+        results.append(await bench_fast_publish(broker, size, count))
+        results.append(await bench_subscribe_receive(broker, size, count))
+        for window in QOS1_WINDOWS:
+            results.append(
+                await bench_publish_qos1(broker, size, count, window)
+            )
+    await broker.stop()
+    if cert_file is not None:
+        results.extend(await run_tls_benchmarks(cert_file, key_file))
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "implementation": sys.implementation.name,
+        "python_version": sys.version.split()[0],
+        "timestamp": int(time.time()),
+        "messages_per_run": count,
+        "results": results,
+    }
+
+
+def main() -> None:
+    """ Parse the command line and run the benchmarks. """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument(
+        "--ack-delay-ms",
+        type=int,
+        default=1,
+        help="PUBACK delay of the fake broker, emulating the network rtt"
+    )
+    parser.add_argument("--output", help="write the json to this file")
+    parser.add_argument(
+        "--tls-cert",
+        help="certificate of the TLS fake broker, enables the TLS scenarios"
+    )
+    parser.add_argument("--tls-key", help="key of the TLS certificate")
+    args = parser.parse_args()
+    report = asyncio.run(
+        run_benchmarks(
+            args.count, args.ack_delay_ms, args.tls_cert, args.tls_key
+        )
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
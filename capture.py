@@ -0,0 +1,263 @@
+"""
+Capture of the mqtt traffic to the sd card and its replay.
+
+A capture file starts with the CAPTURE_MAGIC bytes followed by one
+record per message:
+
+    ticks_ms (4 bytes) | direction (1) | topic length (2) |
+    msg length (2) | topic | msg
+
+the records are packed into a ram buffer written to the file only in
+whole BLOCK_SIZE blocks, so every write maps to a single sd block write.
+A reset loses at most the content of the buffer, a truncated last record
+is ignored by the reader.
+"""
+import os
+import struct
+
+from device_logging import Logger
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms
+
+CAPTURE_MAGIC = b"MQCAP\x00\x01\x00"
+RECORD_FORMAT = "!IBHH"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FORMAT)
+BLOCK_SIZE = 512
+DIRECTION_SENT = 0
+DIRECTION_RECEIVED = 1
+YIELD_EVERY = 16
+
+
+def _to_bytes(data) -> bytes:
+    """ Encode str data, bytes like data is returned as is. """
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+
+class CaptureWriter:
+    """
+    Append the captured messages to a capture file.
+
+    Attributes
+    ----------
+    path : the path of the capture file.
+    record_count : the number of captured messages.
+    bytes_written : the number of bytes written to the file.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.record_count = 0
+        self.bytes_written = 0
+        self._file = open(path, "wb")
+        self._block = bytearray(BLOCK_SIZE)
+        self._block_view = memoryview(self._block)
+        self._header = bytearray(RECORD_HEADER_SIZE)
+        self._position = 0
+        self._append(CAPTURE_MAGIC)
+
+    def record(self, direction: int, topic, msg) -> None:
+        """
+        Capture a message.
+
+        Parameters
+        ----------
+        direction : DIRECTION_SENT or DIRECTION_RECEIVED.
+        topic : the topic, as str or bytes.
+        msg : the payload, as str or bytes.
+        """
+        topic = _to_bytes(topic)
+        msg = _to_bytes(msg)
+        struct.pack_into(
+            RECORD_FORMAT,
+            self._header,
+            0,
+            ticks_ms(),
+            direction,
+            len(topic),
+            len(msg)
+        )
+        self._append(self._header)
+        self._append(topic)
+        self._append(msg)
+        self.record_count += 1
+
+    def _append(self, data) -> None:
+        """ Copy data into the block buffer, writing every full block. """
+        data = memoryview(data)
+        while data:
+            length = min(len(data), BLOCK_SIZE - self._position)
+            end = self._position + length
+            self._block_view[self._position:end] = data[:length]
+            self._position = end
+            data = data[length:]
+            if self._position == BLOCK_SIZE:
+                self._write(self._block)
+                self._position = 0
+
+    def _write(self, data) -> None:
+        """ Write data to the card. """
+        self._file.write(data)
+        self._file.flush()
+        self.bytes_written += len(data)
+
+    def close(self) -> None:
+        """ Write the partial last block and close the file. """
+        if self._file is None:
+            return
+        if self._position:
+            self._write(self._block_view[:self._position])
+            self._position = 0
+        self._file.close()
+        self._file = None
+
+
+def read_capture(path: str):
+    """
+    Iterate over the records of a capture file.
+
+    Parameters
+    ----------
+    path : the path of the capture file.
+
+    Returns
+    -------
+    generator : (stamp_ms, direction, topic, msg) tuples, topic and msg
+    are bytes.
+    """
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = capture_file.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+            stamp, direction, topic_len, msg_len = struct.unpack(
+                RECORD_FORMAT, header
+            )
+            topic = capture_file.read(topic_len)
+            msg = capture_file.read(msg_len)
+            if len(topic) < topic_len or len(msg) < msg_len:
+                return
+            yield stamp, direction, topic, msg
+
+
+class CaptureReplay:
+    """
+    Publish the messages of a capture again, with their original timing.
+
+    Attributes
+    ----------
+    publish : a coroutine function called as publish(topic, msg).
+    on_progress : an optional callable called as
+    on_progress(percentage, replayed_count) at the end of the replay
+    and at most every progress_interval_ms.
+    running : True while a capture is replayed.
+    replayed_count : the number of messages published by the last run.
+    error_count : the number of failed publications of the last run.
+    progress : the percentage of the capture replayed.
+    """
+    def __init__(
+        self,
+        publish,
+        on_progress=None,
+        progress_interval_ms: int = 250
+    ) -> None:
+        self.publish = publish
+        self.on_progress = on_progress
+        self.progress_interval_ms = progress_interval_ms
+        self.running = False
+        self.replayed_count = 0
+        self.error_count = 0
+        self.progress = 0
+        self.logger = Logger("CAPTURE_REPLAY")
+        self._stop_requested = False
+
+    def stop(self) -> None:
+        """ Stop the running replay after the current message. """
+        self._stop_requested = True
+
+    async def run(
+        self,
+        path: str,
+        speed: int = 1,
+        direction: int = None
+    ) -> int:
+        """
+        Replay a capture file.
+
+        Parameters
+        ----------
+        path : the path of the capture file.
+        speed : the replay speed factor, 1 keeps the original timing,
+        0 publishes as fast as possible.
+        direction : replay only the messages of this direction,
+        None replays both the sent and the received ones.
+
+        Returns
+        -------
+        int : the number of published messages.
+        """
+        if self.running:
+            raise OSError("a replay is already running")
+        # a missing capture raises before the replay is marked running
+        file_size = max(os.stat(path)[6], 1)
+        self.running = True
+        self._stop_requested = False
+        self.replayed_count = 0
+        self.error_count = 0
+        self.progress = 0
+        offset = len(CAPTURE_MAGIC)
+        progress_at = ticks_ms()
+        started_at = None
+        first_ms = 0
+        capture_ms = 0
+        previous_stamp = None
+        try:
+            for stamp, record_direction, topic, msg in read_capture(path):
+                if self._stop_requested:
+                    break
+                offset += RECORD_HEADER_SIZE + len(topic) + len(msg)
+                if previous_stamp is not None:
+                    capture_ms += ticks_diff(stamp, previous_stamp)
+                previous_stamp = stamp
+                if direction is not None and record_direction != direction:
+                    continue
+                if started_at is None:
+                    started_at = ticks_ms()
+                    first_ms = capture_ms
+                wait_ms = 0
+                if speed:
+                    deadline = ticks_add(
+                        started_at, (capture_ms - first_ms) // speed
+                    )
+                    wait_ms = ticks_diff(deadline, ticks_ms())
+                if wait_ms > 0:
+                    await sleep_ms(wait_ms)
+                elif self.replayed_count % YIELD_EVERY == 0:
+                    await sleep_ms(0)
+                try:
+                    await self.publish(topic, msg)
+                    self.replayed_count += 1
+                except OSError as e:
+                    self.error_count += 1
+                    self.logger.warning(f"publish failed: {e}")
+                self.progress = offset * 100 // file_size
+                now = ticks_ms()
+                if (
+                    self.on_progress is not None
+                    and ticks_diff(now, progress_at)
+                    >= self.progress_interval_ms
+                ):
+                    progress_at = now
+                    self.on_progress(self.progress, self.replayed_count)
+            else:
+                self.progress = 100
+        finally:
+            self.running = False
+            if self.on_progress is not None:
+                self.on_progress(self.progress, self.replayed_count)
+        self.logger.info(
+            f"{self.replayed_count} messages replayed at x{speed}, "
+            f"{self.error_count} errors"
+        )
+        return self.replayed_count
@@ -1,21 +1,59 @@
 """ Manage the commands of the device. """
 import _thread
+import asyncio
 import gc
 import json
 import os
 import random
 from time import sleep_ms
-import socket
 from device_logging import Logger
-import uping
 
 import network
 import uos
 from umqtt.simple import MQTTClient
 
+from capture import (
+    DIRECTION_RECEIVED,
+    DIRECTION_SENT,
+    CaptureReplay,
+    CaptureWriter,
+)
+from fast_publish import FastPublishFrames
 from hardware_manager import HardwareManager
+from injector import InjectionEngine
+from lan_inventory import LanInventory, NetworkInventory, sort_addresses
+from load_generator import LoadFrame, LoadGenerator
+from message_store import MessageStore
+from mqtt_engine import AsyncMqttClient
+from mqtt_outbox import PublishOutbox
+from mqtt_pool import DEFAULT_BROKER, BrokerPool, BrokerSession
+from mqtt_session import SessionStore
+from mqtt_protocol import (
+    PROTOCOL_LEVEL_3_1_1,
+    PROTOCOL_LEVEL_5,
+    reason_name,
+)
+from mqtt_supervisor import ConnectionSupervisor
+from payload_codec import CodecTable, create_codec
+from ping_sweep import PingSweep
+from port_scan import SERVICES, PortScanner, service_name
+from publish_scheduler import PublishScheduler
+from rule_engine import RuleEngine, parse_value
+from sd_queue import SdQueue
+from settings_manager import SettingsManager
+from storage import file_exists
+from timer_wheel import TimerWheel
+from timing import sleep_ms as async_sleep_ms, ticks_diff, ticks_ms
+from tls import TlsContext
+from topic_router import TopicRouter
+from topic_tree import TopicTree
+from wlan_connector import WlanConnector
+from wlan_credentials import CredentialStore
 
 core_1_flag = True
+REPLAY_SPEEDS = (1, 2, 10, 0)
+MAX_BROWSER_CHILDREN = 24
+ACK_POLL_MS = 20
 
 def _enable_available_sram_led_indicator(hw_man) -> None:
     global core_1_flag
@@ -94,6 +132,20 @@ class WlanManager:
     saved_ssids : a list of the saved ssids.
     saved_passwords : a list of the saved passwords.
     hardware_manager : an instance of the HardwareManager class.
+    sweep_settings : the ping sweep settings of list devices, the number
+    of pings in flight, their timeout and retries.
+    devices : the addresses found by the last list devices.
+    port_scanner : the PortScanner probing the devices, caching the open
+    ports of each of them.
+    port_cache_ms : the age after which the ports of a host are scanned
+    again.
+    inventory : the LanInventory of the hosts found on each network, a
+    known network only gets its known hosts pinged in the foreground.
+    inventory_settings : the inventory path, the age after which a host
+    is stale and the interval between two full sweeps of a network.
+    credentials : the CredentialStore of the known networks.
+    connector : the WlanConnector joining the networks in the background,
+    the last good network first.
     """
     def __init__(
         self,
@@ -110,30 +162,59 @@ class WlanManager:
         self.visible_networks = []
         self.logger = Logger("WLAN_MANAGER")
         self.wlan_page_uid = "ebu9n0VQjmh1bn3v"
-        self._connect_to_known_networks()
-
-    def _connect_to_known_networks(self) -> None:
-        """
-        Connect to the known networks.
-        """
-        data = self._scan()
-        self.visible_networks = data["ssids"]
-        self.logger.debug(f"visible networks: {self.visible_networks}")
+        self.sweep_settings = {}
+        self.inventory_settings = {}
+        self.devices = []
+        port_settings = {}
+        connector_settings = {}
         try:
-            with open(
-                "/sd/networks.json", "r", encoding="utf-8"
-            ) as networks_file:
-                networks = json.load(networks_file)
-                for ssid, password in networks.items():
-                    if ssid in self.visible_networks:
-                        self.logger.debug(
-                            f"connecting to {ssid} using password {password}"
-                        )
-                        self.connect(ssid, password, save=False)
-                        break
-        except OSError:
-            self.logger.error("no networks file found !")
+            settings = SettingsManager.get_settings("wlan")
+            self.sweep_settings = settings.get("ping_sweep", {})
+            port_settings = settings.get("port_scan", {})
+            connector_settings = settings.get("connector", {})
+            self.inventory_settings = settings.get("inventory", {})
+        except ValueError:
+            pass
+        self.inventory = LanInventory(
+            self.inventory_settings.get("path", "/sd/lan_inventory.json"),
+            max_networks=self.inventory_settings.get("max_networks", 8)
+        )
+        self._refresh_task = None
+        self.port_scanner = PortScanner(
+            port_settings.get("ports", list(SERVICES)),
+            max_sockets=port_settings.get("max_sockets", 16),
+            timeout_ms=port_settings.get("timeout_ms", 500)
+        )
+        self.port_cache_ms = port_settings.get("cache_ms", 600000)
+        self.credentials = CredentialStore(
+            connector_settings.get("credentials_path", "/sd/networks.json")
+        )
+        self.credentials.load()
+        self.connector = WlanConnector(
+            self.wlan,
+            self.credentials,
+            connector_settings.get("hints_path", "/sd/wlan_last.json"),
+            fast_timeout_ms=connector_settings.get("fast_timeout_ms", 5000),
+            connect_timeout_ms=connector_settings.get(
+                "connect_timeout_ms", 15000
+            ),
+            retry_ms=connector_settings.get("retry_ms", 30000),
+            on_connected=self._on_connected
+        )
+        self.connector.start()
 
+    def _on_connected(self, ssid: str, password: str) -> None:
+        """ Keep the network the connector joined, set the clock. """
+        self.actual_ssid = ssid
+        self.actual_password = password
+        self._set_clock()
+
+    def _set_clock(self) -> None:
+        """ Set the clock the inventory times rely on. """
+        try:
+            self.inventory.set_clock()
+        except (OSError, OverflowError) as e:
+            self.logger.warning(f"clock not set: {e}")
 
     @create_response_page
     def scan_networks(self) -> tuple:
@@ -152,8 +233,11 @@ class WlanManager:
         rssi = data["rssi"]
         self.visible_networks = ssid
         entries = [f"{ssid[:8]} {rssi}" for ssid, rssi in zip(ssid, rssi)]
+        # the known networks are joined without asking their password
         [
-            self.add_command_calback(entry, self.connect, [ssid, ])
+            self.add_command_calback(
+                entry, self.connect, [ssid, self.credentials.password(ssid)]
+            )
             for entry, ssid in zip(entries, ssid)
         ]
         self.logger.info(f"networks scanned, found nertworks: {ssid}")
@@ -180,6 +264,7 @@ class WlanManager:
         """
         self.scan_called = True
         output = self.wlan.scan()
+        self.connector.remember_scan(output)
         ssids_list = []
         channels_list = []
         rssi_list = []
@@ -202,16 +287,18 @@ class WlanManager:
         save: bool = True
     ) -> tuple:
         """
-        Connect to a wireless network.
+        Connect to a wireless network, the connector joins it in the
+        background and the network is saved once joined.
 
         Parameters
         ----------
         ssid : the network ssid.
         password : the password to connect to the network.
+        save : True to save the network once joined.
 
         Returns
         -------
-        bool : True if the connection is successful, False otherwise.
+        dict : the page showing the connector state.
         """
         if not password:
             password = self.hardware_manager.write_from_keyboard_to_oled(
@@ -228,20 +315,17 @@ class WlanManager:
         self.logger.info(
             f"connecting to network {ssid} using password {password}"
         )
-        self.wlan.connect(ssid, password)
-        self.actual_ssid = ssid
-        self.actual_password = password
-        self._save_network() if save else None
+        self.connector.connect(ssid, password, save)
         return (
             "wlan connect command response",
-            [str(self.wlan.isconnected())],
+            [self.connector.state],
             self.wlan_page_uid
         )
 
     @create_response_page
     def disconnect(self) -> tuple:
         """ Disconnect from the wireless network. """
-        self.wlan.disconnect()
+        self.connector.disconnect()
         return (
             "wlan disconnect command response",
             [str(self.wlan.isconnected())],
@@ -269,6 +353,9 @@ class WlanManager:
                 "wlan status command response",
                 [
                     f"isconn: {self.wlan.isconnected()}",
+                    self.connector.state,
+                    f"ssid: {self.connector.ssid}",
+                    f"in {self.connector.connect_ms} ms",
                     "ip:",
                     ifconfig[0],
                     "subnet mask:",
@@ -279,55 +366,116 @@ class WlanManager:
                 self.wlan_page_uid
         )
     
-    def _save_network(self) -> None:
-        """
-        Save a network to the device sd.
-        """
-        with open("/sd/networks.json", "a", encoding="utf-8") as networks_file:
-            json.dump({self.actual_ssid: self.actual_password}, networks_file)
-        self.logger.info(f"network connection {self.actual_ssid} saved !")
+    def rssi(self) -> int | None:
+        """ Return the signal strength in dBm, None if not connected. """
+        if not self.wlan.isconnected():
+            return None
+        return self.wlan.status("rssi")
 
-    def _scan_network(self, base_ip: str) -> list:
+    def _scan_network(self, addresses: list, description: str) -> list:
         """
-        Scan the network for connected devices.
+        Ping addresses, the answering hosts are shown on the oled as soon
+        as they reply.
 
         Parameters
         ----------
-        base_ip : the base ip address of the network.
+        addresses : the addresses to ping.
+        description : the second oled line, describing the addresses.
 
         Returns
         -------
-        list : a list of the connected devices.
-        """
-        connected_devices = []
-        self.hardware_manager.oled.fill(0)
-        self.hardware_manager.oled.text("scanning:", 0, 0)
-        rect_start = len(base_ip) + 1
-        for i in range(1, 255):
-            percent = int((i / 255) * 100)
-            self.hardware_manager.oled.fill_rect(
-                rect_start * 8, 16, (len(str(i)) + 2) * 8, 16, 0
-            )
-            self.hardware_manager.oled.fill_rect(
-                9 * 8, 0, (len(str(i)) + 2) * 8, 8, 0
-            )
-            self.hardware_manager.oled.text(f"{base_ip}.{i}", 0, 16)
-            self.hardware_manager.oled.text(f"{percent}%", 10 * 8, 0)
-            self.hardware_manager.show_progressbar(percent, 4)
-            self.hardware_manager.oled.show()
-            ip = f"{base_ip}.{i}"
-            try:
-                if uping.ping(ip):
-                    connected_devices.append(ip)
-            except OSError:
-                pass
+        list : the (address, latency_ms) tuples of the answering hosts.
+        """
+        oled = self.hardware_manager.oled
+        oled.fill(0)
+        oled.text("scanning:", 0, 0)
+        oled.text(description, 0, 8)
+        oled.show()
+        found = []
+
+        def show_host(ip: str, latency_ms: float) -> None:
+            # the last four hosts found, on rows 2 to 5
+            found.append(f"{ip.split('.')[-1]:>3} {int(latency_ms)} ms")
+            oled.fill_rect(0, 2 * 8, 128, 4 * 8, 0)
+            for row, line in enumerate(found[-4:]):
+                oled.text(line, 0, (row + 2) * 8)
+            oled.show()
+
+        def show_progress(percentage: int, found_count: int) -> None:
+            oled.fill_rect(9 * 8, 0, 128 - 9 * 8, 8, 0)
+            oled.text(f"{percentage}%", 10 * 8, 0)
+            oled.fill_rect(0, 6 * 8, 128, 8, 0)
+            oled.text(f"found: {found_count}", 0, 6 * 8)
+            self.hardware_manager.show_progressbar(percentage, 7)
+
+        sweep = self._create_sweep(show_host, show_progress)
+        try:
+            replies = sweep.sweep(addresses)
+        except OSError as e:
+            self.logger.error(f"ping sweep failed: {e}")
+            replies = []
         self.hardware_manager.set_led_bar(0)
-        return connected_devices
+        self.logger.info(
+            f"{len(replies)} devices found with {sweep.sent_count} pings"
+        )
+        return replies
+
+    def _create_sweep(self, on_host=None, on_progress=None) -> PingSweep:
+        """ Create a PingSweep with the ping sweep settings. """
+        return PingSweep(
+            window=self.sweep_settings.get("window", 32),
+            timeout_ms=self.sweep_settings.get("timeout_ms", 1000),
+            retries=self.sweep_settings.get("retries", 1),
+            on_host=on_host,
+            on_progress=on_progress
+        )
+
+    async def _refresh_inventory(
+        self,
+        network: NetworkInventory,
+        addresses: list,
+        full_sweep: bool
+    ) -> None:
+        """
+        Ping the stale or unknown addresses of a network from a task and
+        save what answered.
+
+        Parameters
+        ----------
+        network : the inventory of the network.
+        addresses : the addresses to ping.
+        full_sweep : True if addresses cover the whole prefix.
+        """
+        try:
+            found = await self._create_sweep().sweep_async(addresses)
+            now = self.inventory.now()
+            new_count = network.record(found, now)
+            if full_sweep:
+                network.full_sweep = now
+            for ip, _ in found:
+                if ip not in self.devices:
+                    self.devices.append(ip)
+                    self.add_command_calback(ip, self.scan_host, [ip])
+            self.devices = sort_addresses(self.devices)
+            self.inventory.save()
+            self.logger.info(
+                f"inventory refreshed: {len(found)}/{len(addresses)} "
+                f"answered, {new_count} new"
+            )
+        except OSError as e:
+            self.logger.error(f"inventory refresh failed: {e}")
+        finally:
+            self._refresh_task = None
 
     @create_response_page
     def list_devices(self) -> tuple:
         """
         List the devices connected to the network.
+        On a network of the inventory only the hosts alive at the last
+        visit are pinged before the page is shown, the stale hosts (and
+        the whole prefix when a full sweep is due) are pinged by a
+        background task updating the inventory. Until the clock is set
+        the whole prefix is swept and the inventory is left untouched.
 
         Returns
         -------
@@ -338,11 +486,138 @@ class WlanManager:
         """
         parts = self.wlan.ifconfig()[0].split(".")
         base_ip = '.'.join(parts[:-1])
-        devices = self._scan_network(base_ip)
-        devices.insert(0, "found devices:")
+        if not self.inventory.clock_set:
+            self._set_clock()
+        network = None
+        known = []
+        if self.inventory.clock_set:
+            network = self.inventory.network(
+                f"{self.actual_ssid} {base_ip}"
+            )
+            now = self.inventory.now()
+            network.reset_future(now)
+            stale_since = now - self.inventory_settings.get("stale_s", 86400)
+            known = network.alive(stale_since)
+        if known:
+            # known network: the hosts alive at the last visit first
+            found = self._scan_network(known, f"{len(known)} known hosts")
+            network.record(found, now)
+            refresh = network.stale(stale_since)
+            full_sweep = now - network.full_sweep >= (
+                self.inventory_settings.get("full_sweep_s", 3600)
+            )
+            if full_sweep:
+                refresh = [
+                    f"{base_ip}.{i}" for i in range(1, 255)
+                    if f"{base_ip}.{i}" not in known
+                ]
+        else:
+            found = self._scan_network(
+                [f"{base_ip}.{i}" for i in range(1, 255)],
+                f"{base_ip}.0/24"
+            )
+            refresh = []
+            if network is not None:
+                network.record(found, now)
+                network.full_sweep = now
+        if network is not None:
+            try:
+                self.inventory.save()
+            except OSError as e:
+                self.logger.error(f"inventory not saved: {e}")
+        self.devices = sort_addresses(ip for ip, _ in found)
+        for ip in self.devices:
+            self.add_command_calback(ip, self.scan_host, [ip])
+        entries = ["found devices:"] + self.devices
+        if refresh and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(
+                self._refresh_inventory(network, refresh, full_sweep)
+            )
+            entries.append(f"refreshing {len(refresh)}")
         return (
             "connected devices",
-            devices,
+            entries,
+            self.wlan_page_uid
+        )
+
+    def _scan_ports(self, hosts: list) -> None:
+        """
+        Scan the ports of the hosts without a recent scan, the open
+        ports are shown on the oled as soon as they are found.
+        """
+        hosts = [
+            host for host in hosts
+            if self.port_scanner.cached(host, self.port_cache_ms) is None
+        ]
+        if not hosts:
+            return
+        oled = self.hardware_manager.oled
+        oled.fill(0)
+        oled.text("port scan:", 0, 0)
+        oled.text(f"{len(hosts)} hosts", 0, 8)
+        oled.show()
+        found = []
+
+        def show_open(host: str, port: int) -> None:
+            found.append(f"{host.split('.')[-1]:>3} {port}")
+            oled.fill_rect(0, 2 * 8, 128, 6 * 8, 0)
+            for row, line in enumerate(found[-6:]):
+                oled.text(line, 0, (row + 2) * 8)
+            oled.show()
+
+        self.port_scanner.on_open = show_open
+        try:
+            self.port_scanner.scan(hosts)
+        except OSError as e:
+            self.logger.error(f"port scan failed: {e}")
+        self.logger.info(f"{len(found)} open ports on {len(hosts)} hosts")
+
+    def _port_entries(self, host: str) -> list:
+        """ Return the page lines of the cached open ports of a host. """
+        ports = self.port_scanner.cached(host, self.port_cache_ms)
+        if not ports:
+            return ["  no open port"]
+        return [
+            f"  {port} {service_name(port)}".rstrip() for port in ports
+        ]
+
+    @create_response_page
+    def scan_host(self, host: str) -> tuple:
+        """
+        Show the open ports of a device, scanning it if its ports are
+        not cached.
+
+        Parameters
+        ----------
+        host : the device address.
+        """
+        self._scan_ports([host])
+        return (
+            "host ports",
+            [host] + self._port_entries(host),
+            self.wlan_page_uid
+        )
+
+    @create_response_page
+    def scan_ports(self) -> tuple:
+        """
+        Show the open ports of every device found by list devices, the
+        devices are scanned all at once.
+        """
+        if not self.devices:
+            return (
+                "scan ports response",
+                ["list devices", "first !"],
+                self.wlan_page_uid
+            )
+        self._scan_ports(self.devices)
+        entries = []
+        for host in self.devices:
+            entries.append(host)
+            entries.extend(self._port_entries(host))
+        return (
+            "scan ports response",
+            entries,
             self.wlan_page_uid
         )
 
@@ -373,49 +648,719 @@ class MqttManager:
     """
     Manage the device mqtt connection.
 
+    When async_mode is enabled the connection is handled by an
+    AsyncMqttClient: the commands schedule their network operations as
+    tasks on the event loop shared with the menu and return immediately,
+    otherwise the blocking umqtt client is used.
+
     Attributes
     ----------
     mqtt_client : the mqtt client instance.
     client_name : the mqtt client name.
     broker_ip : the mqtt broker ip address.
+    port : the mqtt broker port.
     keepalive : the mqtt keepalive.
+    async_mode : True to use the asyncio based client.
+    qos : the qos of the messages published by the publish command,
+    qos 1 messages go through the client outbox (async mode only).
+    inflight_window : the number of qos 1 messages kept in flight at once.
+    outbox_size : the number of qos 1 messages the outbox can queue.
+    retry_ms : the time after which an unacknowledged message is resent.
+    offline_queue : the SdQueue storing the messages published while the
+    broker is unreachable (async mode only), None if the sd is missing.
+    offline_queue_path : the path of the offline queue files on the sd.
+    offline_queue_size : the size in bytes of the offline queue.
+    drain_batch : the number of stored messages sent per drain batch.
+    drain_ack_timeout_ms : the time given to the broker to acknowledge a
+    drained batch before it is sent again.
+    router : the TopicRouter dispatching the received messages to the
+    handlers registered with add_handler.
+    message_store : the MessageStore keeping the last value of each
+    topic and the most recent received messages in fixed buffers.
+    store_settings : the sizes of the message store buffers.
+    supervisor : the ConnectionSupervisor keeping the async client
+    connected, started by the connect command.
+    supervisor_settings : the backoff and ping timeout of the supervisor.
     fast_reading_topics : a list of the topics to read.
     fast_publish_topic_msg : a dictionary containing the topics
     and the messages to publish.
+    fast_frames : the FastPublishFrames holding the fast publish presets
+    compiled into ready to send packets.
+    pool : the BrokerPool holding a session for the broker configured
+    above (named "default") and for each broker of the brokers settings
+    file, mqtt_client and supervisor are those of the current broker.
+    brokers_settings : the brokers of the brokers settings file.
+    injector : the InjectionEngine playing the scenario files.
+    scenarios_dir : the folder of the scenario files on the sd.
+    capture : the CaptureWriter recording every sent and received
+    message while a capture is running, None otherwise.
+    captures_dir : the folder of the capture files on the sd.
+    replayer : the CaptureReplay publishing a capture again.
+    scheduler : the PublishScheduler rate limiting the publish command
+    per topic, coalescing the messages over budget (async mode only).
+    rate_limit_settings : the default and per topic filter budgets.
+    codecs : the CodecTable giving the payload codec of each topic,
+    used by publish_value and add_value_handler.
+    protocol_level : the mqtt protocol of the async clients, 4 for
+    mqtt 3.1.1 and 5 for mqtt 5 (topic aliases and reason codes).
+    session_expiry : the mqtt 5 session expiry interval in seconds.
+    persistent_session : True to connect the default broker without
+    clean session and to snapshot its session state, so a reset
+    resumes it instead of subscribing again.
+    session_path : the path of the session snapshot.
+    session_save_ms : the minimum time between two snapshots.
+    session_store : the SessionStore of the default broker session,
+    None if the session is not persistent.
+    topic_tree : the TopicTree of the topic browser, fed by a '#'
+    subscription while the browser runs, None otherwise.
+    browser_settings : the node budget and level size of the tree.
+    rules : the RuleEngine applying the rules of the rules settings
+    file to the received messages before they are stored and handled.
+    load_generator : the LoadGenerator sending the load profiles.
+    load_profiles : the profiles of the load settings file.
+    tls_settings : the TLS settings of the broker connections, "enabled"
+    encrypts the default broker connection (on "port" if given), a
+    broker of the brokers settings file with "tls" set uses them too.
+    tls : the TlsContext of the default broker, None without TLS.
     """
-    def __init__(self, add_command_calback) -> None:
-        self.mqtt_client: MQTTClient
+    def __init__(
+        self,
+        hardware_manager: HardwareManager,
+        add_command_calback
+    ) -> None:
+        self.hardware_manager = hardware_manager
+        self.mqtt_client: MQTTClient | AsyncMqttClient
         self.client_name = ""
         self.broker_ip = ""
+        self.port = 1883
         self.keepalive = 0
+        self.async_mode = False
+        self.qos = 0
+        self.inflight_window = 16
+        self.outbox_size = 64
+        self.retry_ms = 5000
+        self.offline_queue = None
+        self.offline_queue_path = "/sd/mqtt_queue"
+        self.offline_queue_size = 262144
+        self.drain_batch = 32
+        self.drain_ack_timeout_ms = 30000
+        self._draining = False
+        self.protocol_level = PROTOCOL_LEVEL_3_1_1
+        self.session_expiry = 0
+        self.persistent_session = False
+        self.session_path = "/sd/mqtt_session.json"
+        self.session_save_ms = 1000
+        self.session_store = None
+        self.tls_settings = {}
+        self.tls = None
+        self.topic_tree = None
+        self.browser_settings = {}
+        self._browser_subscribed = False
         self.fast_reading_topics = []
         self.fast_publish_topic_msg = {}
+        self.fast_frames = FastPublishFrames()
         self.add_command_calback = add_command_calback
+        self.logger = Logger("MQTT_MANAGER")
+        self.mqtt_page_uid = "Y9OQNRBTclzzFGtU"
+        self.router = TopicRouter()
+        self.store_settings = {}
+        self.supervisor = None
+        self.supervisor_settings = {}
+        self.pool = BrokerPool()
+        self.brokers_settings = {}
+        self.rate_limit_settings = {}
+        self.scenarios_dir = "/sd/scenarios"
+        self.injector = InjectionEngine(
+            self._inject_publish, self._show_progress
+        )
+        self.capture = None
+        self.captures_dir = "/sd/captures"
+        self.replayer = CaptureReplay(
+            self._replay_publish, self._show_progress
+        )
+        self.codecs = CodecTable()
+        self.load_generator = LoadGenerator(
+            self._load_write, self._show_load
+        )
+        self.load_profiles = {}
+        self.rules = RuleEngine(
+            self._rule_publish,
+            self.publish_value,
+            hardware_manager.set_led_bar,
+            self._decode_rule_value
+        )
+        self._load_settings()
+        if self.async_mode:
+            # umqtt only speaks mqtt 3.1.1, the frames keep its encoding
+            self.fast_frames.protocol_level = self.protocol_level
+        self._load_brokers()
+        self._load_codecs()
+        self._load_rules()
+        self._load_load_profiles()
+        self.scheduler = PublishScheduler(
+            self._publish_or_store,
+            rate=self.rate_limit_settings.get("rate", 10),
+            burst=self.rate_limit_settings.get("burst", 5),
+            max_topics=self.rate_limit_settings.get("max_topics", 32)
+        )
+        for topic_filter, (rate, burst) in self.rate_limit_settings.get(
+            "topics", {}
+        ).items():
+            self.scheduler.set_limit(topic_filter, rate, burst)
+        self.message_store = MessageStore(
+            cache_slots=self.store_settings.get("cache_slots", 16),
+            ring_size=self.store_settings.get("ring_size", 32),
+            topic_size=self.store_settings.get("topic_size", 48),
+            msg_size=self.store_settings.get("msg_size", 64)
+        )
+        self._load_fast_publish_presets()
+
+    def _load_settings(self) -> None:
+        """
+        Load the connection parameters from the mqtt settings file,
+        the defaults are kept if the file is missing.
+        """
+        try:
+            settings = SettingsManager.get_settings("mqtt")
+        except ValueError:
+            return
+        self.client_name = settings.get("client_name", self.client_name)
+        self.broker_ip = settings.get("broker_ip", self.broker_ip)
+        self.port = settings.get("port", self.port)
+        self.keepalive = settings.get("keepalive", self.keepalive)
+        self.async_mode = settings.get("async_mode", self.async_mode)
+        self.qos = settings.get("qos", self.qos)
+        self.inflight_window = settings.get(
+            "inflight_window", self.inflight_window
+        )
+        self.outbox_size = settings.get("outbox_size", self.outbox_size)
+        self.retry_ms = settings.get("retry_ms", self.retry_ms)
+        self.offline_queue_path = settings.get(
+            "offline_queue_path", self.offline_queue_path
+        )
+        self.offline_queue_size = settings.get(
+            "offline_queue_size", self.offline_queue_size
+        )
+        self.drain_batch = settings.get("drain_batch", self.drain_batch)
+        self.drain_ack_timeout_ms = settings.get(
+            "drain_ack_timeout_ms", self.drain_ack_timeout_ms
+        )
+        self.protocol_level = settings.get(
+            "protocol_level", self.protocol_level
+        )
+        self.session_expiry = settings.get(
+            "session_expiry", self.session_expiry
+        )
+        self.persistent_session = settings.get(
+            "persistent_session", self.persistent_session
+        )
+        self.session_path = settings.get("session_path", self.session_path)
+        self.session_save_ms = settings.get(
+            "session_save_ms", self.session_save_ms
+        )
+        self.scenarios_dir = settings.get(
+            "scenarios_dir", self.scenarios_dir
+        )
+        self.captures_dir = settings.get("captures_dir", self.captures_dir)
+        self.store_settings = settings.get("message_store", {})
+        self.supervisor_settings = settings.get("supervisor", {})
+        self.rate_limit_settings = settings.get("rate_limit", {})
+        self.browser_settings = settings.get("browser", {})
+        self.tls_settings = settings.get("tls", {})
+        if self.tls_settings.get("enabled", False):
+            self.port = self.tls_settings.get("port", self.port)
 
-    @staticmethod
-    def subscribe_callback(topic: str, msg: str) -> None:
+    def _load_brokers(self) -> None:
         """
-        This is the callback function for the mqtt client.
+        Load the additional brokers from the brokers settings file,
+        the pool only holds the default broker if the file is missing.
         """
-        print(topic, msg)
+        try:
+            settings = SettingsManager.get_settings("brokers")
+        except ValueError:
+            return
+        self.pool.idle_timeout_ms = settings.get(
+            "idle_timeout_ms", self.pool.idle_timeout_ms
+        )
+        self.brokers_settings = settings.get("brokers", {})
 
-    @create_response_page
-    def create_connection(self) -> tuple:
+    def _load_codecs(self) -> None:
         """
-        Create the connection with the parameters specified at init time.
+        Load the payload codecs from the codecs settings file,
+        every topic uses json if the file is missing.
+        """
+        try:
+            settings = SettingsManager.get_settings("codecs")
+        except ValueError:
+            return
+        self.codecs.default = create_codec(settings.get("default", {}))
+        for topic_filter, codec in settings.get("topics", {}).items():
+            self.codecs.add(topic_filter, create_codec(codec))
+
+    def _load_rules(self) -> None:
+        """
+        Compile the rules of the rules settings file,
+        no rule is applied if the file is missing.
+        """
+        try:
+            settings = SettingsManager.get_settings("rules")
+        except ValueError:
+            return
+        try:
+            self.rules.load(settings.get("rules", []))
+        except (KeyError, ValueError) as e:
+            self.logger.error(f"rules not loaded: {e}")
+            self.rules.load([])
+
+    def _load_load_profiles(self) -> None:
+        """
+        Load the load generator profiles from the load settings file,
+        no profile is available if the file is missing.
+        """
+        try:
+            settings = SettingsManager.get_settings("load")
+        except ValueError:
+            return
+        self.load_profiles = settings.get("profiles", {})
+
+    def _load_fast_publish_presets(self) -> None:
+        """
+        Compile the presets of the fast publish settings file,
+        the presets are kept empty if the file is missing.
+        """
+        try:
+            presets = SettingsManager.get_settings("fast_publish")
+        except ValueError:
+            return
+        self.fast_frames.load(presets)
+        self.fast_publish_topic_msg = self.fast_frames.presets
+
+    def _spawn(self, coro, action: str) -> None:
+        """
+        Schedule a coroutine on the event loop, logging its failure.
+
+        Parameters
+        ----------
+        coro : the coroutine to run.
+        action : a short description of the operation, used in the logs.
+        """
+        async def runner():
+            try:
+                await coro
+            except Exception as e:
+                self.logger.error(f"{action} failed: {e}")
+        asyncio.create_task(runner())
+
+    def _resume_session(self, client: AsyncMqttClient) -> None:
+        """
+        Make the session of a client persistent: restore its last
+        snapshot and keep snapshotting it while it changes. Called again
+        for every new client of the default broker, the snapshot task
+        then follows the new client.
+
+        Parameters
+        ----------
+        client : the client of the default broker, not connected yet.
+        """
+        client.clean_session = False
+        store = self.session_store
+        if store is None:
+            if (
+                self.protocol_level == PROTOCOL_LEVEL_5
+                and not self.session_expiry
+            ):
+                self.logger.warning(
+                    "session expiry is 0, the broker ends the session "
+                    "on disconnection"
+                )
+            store = SessionStore(self.session_path, self.session_save_ms)
+            self.session_store = store
+            self._spawn(store.run(), "session snapshot")
+        elif store.client is client:
+            return
+        try:
+            store.attach(client)
+            store.restore(client)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f"session snapshot unusable: {e}")
+
+    def _open_offline_queue(self) -> None:
+        """ Open the offline queue, it lives on the sd mounted at /sd. """
+        if self.offline_queue is not None:
+            return
+        try:
+            self.offline_queue = SdQueue(
+                self.offline_queue_path, self.offline_queue_size
+            )
+        except OSError as e:
+            self.logger.error(f"offline queue unavailable: {e}")
+
+    async def _publish_or_store(
+        self,
+        topic: str,
+        msg: str,
+        broker: str = None
+    ) -> None:
+        """
+        Publish a message on the broker chosen by name or topic prefix.
+        The messages for the default broker are stored in the offline
+        queue if it is unreachable, the other brokers only keep the
+        qos 1 messages in their outbox until they are reconnected.
+        """
+        session = self.pool.acquire(self.pool.route(topic, broker).name)
+        client = session.client
+        if client.isconnected():
+            try:
+                await client.publish(topic, msg, qos=self.qos)
+                return
+            except OSError as e:
+                self.logger.warning(f"publish failed, storing it: {e}")
+        if session.name != DEFAULT_BROKER:
+            await client.publish(topic, msg, qos=self.qos)
+            return
+        if self.offline_queue is None:
+            raise OSError("broker unreachable and no offline queue")
+        self.offline_queue.put(topic, msg)
+
+    async def _publish_stored(self, topic: bytes, msg: bytes) -> None:
+        """
+        Publish a message read from the offline queue to the default
+        broker, waiting for room in the outbox instead of overflowing it.
+        """
+        client = self.pool.get(DEFAULT_BROKER).client
+        if self.qos:
+            await self._wait_outbox(client)
+        await client.publish(topic, msg, qos=self.qos)
+
+    async def _wait_outbox(self, client: AsyncMqttClient) -> None:
+        """ Wait for room in the outbox of a connected client. """
+        outbox = client.outbox
+        while (
+            outbox.pending_count() >= outbox.max_queued
+            and client.isconnected()
+        ):
+            await async_sleep_ms(self.retry_ms // 10)
+
+    async def _stored_acked(self, records: list) -> bool:
+        """
+        Wait until the default broker acknowledged the drained records.
+        On a disconnection or after drain_ack_timeout_ms they are
+        withdrawn from the outbox, the next drain reads them again from
+        the sd, and False is returned.
+        """
+        client = self.pool.get(DEFAULT_BROKER).client
+        outbox = client.outbox
+        batch = {(id(topic), id(msg)) for topic, msg, _ in records}
+        started_at = ticks_ms()
+        while outbox.holds(batch):
+            if not client.isconnected() or ticks_diff(
+                ticks_ms(), started_at
+            ) >= self.drain_ack_timeout_ms:
+                outbox.discard(batch)
+                return False
+            await async_sleep_ms(ACK_POLL_MS)
+        return True
+
+    async def _start_drain(self) -> None:
+        """
+        Drain the offline queue in its own task, so the supervisor keeps
+        watching the connection meanwhile.
+        """
+        if self._draining:
+            return
+        self._draining = True
+        self._spawn(self._drain_offline_queue(), "offline queue drain")
+
+    async def _drain_offline_queue(self) -> None:
+        """ Send the messages stored while the broker was unreachable. """
+        try:
+            if self.offline_queue is None or not self.offline_queue.count:
+                return
+            drained = await self.offline_queue.drain(
+                self._publish_stored,
+                self.drain_batch,
+                self._stored_acked if self.qos else None
+            )
+            self.logger.info(f"{drained} stored messages forwarded")
+        finally:
+            self._draining = False
+
+    async def _inject_publish(
+        self,
+        topic: str,
+        msg: str,
+        qos: int,
+        broker: str = None
+    ) -> None:
+        """
+        Publish a message of a scenario on the broker chosen by name or
+        topic prefix, the messages are not stored if it is unreachable.
+        The qos 1 messages wait for room in the outbox.
+        """
+        session = self.pool.acquire(self.pool.route(topic, broker).name)
+        if qos:
+            await self._wait_outbox(session.client)
+        await session.client.publish(topic, msg, qos=qos)
+
+    async def _replay_publish(self, topic: bytes, msg: bytes) -> None:
+        """ Publish a message of a capture, routed like the scenarios. """
+        await self._inject_publish(topic, msg, 0)
+
+    def _capture_sent(self, topic, msg) -> None:
+        """ Record a sent message if a capture is running. """
+        if self.capture is not None:
+            self.capture.record(DIRECTION_SENT, topic, msg)
+
+    def _show_progress(self, percentage: int, sent: int) -> None:
+        """
+        Show the progress of an injection or a replay on the last two
+        oled rows.
+        """
+        oled = self.hardware_manager.oled
+        oled.fill_rect(0, 6 * 8, 128, 8, 0)
+        oled.text(f"sent: {sent}", 0, 6 * 8)
+        self.hardware_manager.show_progressbar(percentage, 7)
+
+    async def _load_write(self, frame: bytearray) -> None:
+        """
+        Write a frame of the load generator, the generated messages are
+        not captured since the capture would allocate for each of them.
+        """
+        await self.mqtt_client.write_raw(frame)
+
+    def _show_load(self, percentage: int, target: int, achieved: int) -> None:
+        """
+        Show the achieved rate against the target rate of the load
+        generator on the last two oled rows.
+        """
+        oled = self.hardware_manager.oled
+        oled.fill_rect(0, 6 * 8, 128, 8, 0)
+        oled.text(f"{achieved}/{target} msg/s", 0, 6 * 8)
+        self.hardware_manager.show_progressbar(percentage, 7)
+
+    def subscribe_callback(self, topic: bytes, msg: bytes) -> None:
+        """
+        This is the callback function for the mqtt client, the message
+        goes through the rules then, unless a rule dropped it, it is
+        stored in the message store and dispatched to the handlers whose
+        topic filter matches.
+        """
+        if self.capture is not None:
+            self.capture.record(DIRECTION_RECEIVED, topic, msg)
+        if not self.rules.process(topic, msg):
+            return
+        self.message_store.add(topic, msg)
+        self.router.dispatch(topic, msg)
+
+    def _rule_publish(self, topic: str, msg) -> None:
+        """ Publish a message republished by a rule. """
+        if self.async_mode:
+            self.scheduler.submit(topic, msg)
+            return
+        self.mqtt_client.publish(topic, msg)
+        self._capture_sent(topic, msg)
+
+    def _decode_rule_value(self, topic: str, msg):
+        """
+        Return the value of a payload for the rules, the json topics
+        also accept plain text and numbers.
+        """
+        codec = self.codecs.codec_for(topic)
+        if codec.name == "json":
+            return parse_value(msg)
+        return codec.decode(msg)
+
+    def add_handler(self, topic_filter: str, handler) -> None:
+        """
+        Register a handler for the received messages.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter, '+' and '#' wildcards allowed.
+        handler : a callable called as handler(topic, msg).
+        """
+        self.router.add(topic_filter, handler)
+
+    def add_value_handler(self, topic_filter: str, handler) -> None:
+        """
+        Register a handler receiving the decoded payloads.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter, '+' and '#' wildcards allowed.
+        handler : a callable called as handler(topic, value), value is
+        the payload decoded with the codec of the topic.
+        """
+        def decoding_handler(topic: str, msg: bytes) -> None:
+            try:
+                value = self.codecs.codec_for(topic).decode(msg)
+            except Exception as e:
+                self.logger.warning(f"undecodable payload on {topic}: {e}")
+                return
+            handler(topic, value)
+        self.router.add(topic_filter, decoding_handler)
+
+    def publish_value(self, topic: str, value, broker: str = None) -> bool:
+        """
+        Encode a value with the codec of the topic and publish it,
+        through the rate limiting scheduler in async mode.
+
+        Parameters
+        ----------
+        topic : the topic to publish to.
+        value : the value to encode, e.g. a dict of numbers.
+        broker : the name of the broker to publish to (async mode only).
+
+        Returns
+        -------
+        bool : False if the message has been dropped by the scheduler.
+        """
+        payload = self.codecs.codec_for(topic).encode(value)
+        if self.async_mode:
+            # the codec buffer is reused, the queued payload is a copy
+            return self.scheduler.submit(topic, bytes(payload), broker)
+        self.mqtt_client.publish(topic, payload)
+        self._capture_sent(topic, payload)
+        return True
+
+    def remove_handler(self, topic_filter: str, handler=None) -> None:
         """
-        self.mqtt_client = MQTTClient(
+        Unregister the handlers of a topic filter.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter used to register the handler.
+        handler : the handler to remove, None to remove all of them.
+        """
+        self.router.remove(topic_filter, handler)
+
+    def _create_session(
+        self,
+        name: str,
+        broker_ip: str,
+        port: int = 1883,
+        keepalive: int = 0,
+        prefixes: list = (),
+        on_connect=None,
+        tls: bool = False
+    ) -> BrokerSession:
+        """
+        Create the async client, outbox and supervisor of a broker,
+        the session is not opened.
+
+        Parameters
+        ----------
+        name : the broker name.
+        broker_ip : the broker ip address.
+        port : the broker port.
+        keepalive : the mqtt keepalive.
+        prefixes : the topic prefixes routed to the broker.
+        on_connect : the coroutine function awaited after every connection.
+        tls : True to encrypt the connections with the TLS settings.
+        """
+        client = AsyncMqttClient(
             self.client_name,
-            self.broker_ip,
-            keepalive=self.keepalive
+            broker_ip,
+            port=port,
+            keepalive=keepalive,
+            on_message=self.subscribe_callback,
+            protocol_level=self.protocol_level,
+            session_expiry=self.session_expiry,
+            tls=self._create_tls() if tls else None
+        )
+        client.on_sent = self._capture_sent
+        client.outbox = PublishOutbox(
+            client,
+            window=self.inflight_window,
+            retry_ms=self.retry_ms,
+            max_queued=self.outbox_size
         )
-        self.mqtt_client.set_callback(
-            self.subscribe_callback
+        supervisor = ConnectionSupervisor(
+            client,
+            on_connect=on_connect,
+            min_backoff_ms=self.supervisor_settings.get(
+                "min_backoff_ms", 500
+            ),
+            max_backoff_ms=self.supervisor_settings.get(
+                "max_backoff_ms", 60000
+            ),
+            ping_timeout_ms=self.supervisor_settings.get(
+                "ping_timeout_ms", 5000
+            )
+        )
+        return BrokerSession(name, client, supervisor, prefixes)
+
+    def _create_tls(self) -> TlsContext:
+        """
+        Create the TlsContext of a broker, each broker has its own since
+        a TLS session can only be resumed with the server which made it.
+        """
+        return TlsContext(
+            ca_file=self.tls_settings.get("ca_file"),
+            cert_file=self.tls_settings.get("cert_file"),
+            key_file=self.tls_settings.get("key_file"),
+            server_hostname=self.tls_settings.get("server_hostname"),
+            resumption=self.tls_settings.get("resumption", True)
         )
+
+    def _use_session(self, session: BrokerSession) -> None:
+        """ Make the commands work on the client of a broker session. """
+        self.mqtt_client = session.client
+        self.supervisor = session.supervisor
+
+    @create_response_page
+    def create_connection(self) -> tuple:
+        """
+        Create the connection with the parameters specified at init time.
+        In async mode a session is created for the default broker and
+        for each broker of the brokers settings file, they are opened
+        on their first use.
+        """
+        if self.async_mode:
+            self._open_offline_queue()
+            self.pool.current = DEFAULT_BROKER
+            self.pool.add(self._create_session(
+                DEFAULT_BROKER,
+                self.broker_ip,
+                port=self.port,
+                keepalive=self.keepalive,
+                on_connect=self._start_drain,
+                tls=self.tls_settings.get("enabled", False)
+            ))
+            for name, broker in self.brokers_settings.items():
+                self.pool.add(self._create_session(
+                    name,
+                    broker["broker_ip"],
+                    port=broker.get("port", 1883),
+                    keepalive=broker.get("keepalive", self.keepalive),
+                    prefixes=broker.get("prefixes", []),
+                    tls=broker.get("tls", False)
+                ))
+            self._use_session(self.pool.get(DEFAULT_BROKER))
+            self.tls = self.mqtt_client.tls
+            if self.persistent_session:
+                self._resume_session(self.mqtt_client)
+            self.rules.start()
+        else:
+            ssl_context = None
+            if self.tls_settings.get("enabled", False):
+                # umqtt takes the context but cannot resume the sessions
+                self.tls = self._create_tls()
+                ssl_context = self.tls.context()
+            self.mqtt_client = MQTTClient(
+                self.client_name,
+                self.broker_ip,
+                port=self.port,
+                keepalive=self.keepalive,
+                ssl=ssl_context
+            )
+            self.mqtt_client.set_callback(
+                self.subscribe_callback
+            )
         return (
             "mqtt create connection response",
             ["connection created"],
-            "Y9OQNRBTclzzFGtU"
+            self.mqtt_page_uid
         )
 
 
@@ -423,23 +1368,138 @@ class MqttManager:
     def connect(self) -> tuple:
         """
         Connect to the broker.
+        In async mode the session of the current broker is opened, its
+        supervisor keeps the client connected from then on, forwarding
+        the stored messages after every reconnection.
         """
+        if self.async_mode:
+            self.pool.acquire(self.pool.current)
+            return (
+                "mqtt connect response",
+                ["connecting..."],
+                self.mqtt_page_uid
+            )
         self.mqtt_client.connect()
         return (
             "mqtt connect response",
             [str(self.mqtt_client.isconnected())],
-            "Y9OQNRBTclzzFGtU"
+            self.mqtt_page_uid
         )
 
     @create_response_page
     def status(self) -> tuple:
         """
-        Return the status of the connection.
-        """
+        Return the status of the connection, in async mode the outbox
+        throughput and retry counters are shown too.
+        """
+        entries = [str(self.mqtt_client.isconnected())]
+        if self.async_mode:
+            outbox = self.mqtt_client.outbox
+            entries.extend([
+                f"rate: {outbox.throughput} msg/s",
+                f"sent: {outbox.sent_count}",
+                f"acked: {outbox.acked_count}",
+                f"retries: {outbox.retry_count}",
+                f"inflight: {len(outbox.in_flight)}/{outbox.window}",
+                f"pending: {outbox.pending_count()}",
+                f"dropped: {outbox.dropped_count}",
+                f"qos0 sent: {self.mqtt_client.sent_count}",
+            ])
+            if self.session_store is not None:
+                entries.extend([
+                    "session: " + (
+                        "resumed" if self.mqtt_client.session_present
+                        else "new"
+                    ),
+                    f"snapshots: {self.session_store.saved_count}",
+                ])
+            if self.protocol_level == PROTOCOL_LEVEL_5:
+                entries.extend([
+                    f"aliases: {self.mqtt_client.topic_alias_maximum}",
+                    f"alias sent: {self.mqtt_client.alias_count}",
+                    f"reason: {reason_name(self.mqtt_client.last_reason)}",
+                ])
+            if self.offline_queue is not None:
+                entries.append(f"stored: {self.offline_queue.count}")
+            supervisor = self.supervisor
+            entries.extend([
+                f"reconnects: {supervisor.reconnect_count}",
+                f"attempts: {supervisor.attempts_count}",
+                f"failures: {supervisor.failures_count}",
+                f"dead conns: {supervisor.dead_count}",
+                f"last: {supervisor.last_attempts} tries",
+                f"in {supervisor.last_reconnect_ms} ms",
+                f"handshake: {supervisor.last_handshake_ms} ms",
+                f"connect: {self.mqtt_client.connect_ms} ms",
+            ])
+            if self.mqtt_client.tls is not None:
+                entries.extend(self.mqtt_client.tls.status_lines())
+            entries.extend(self.pool.status_lines())
+            scheduler = self.scheduler
+            entries.extend([
+                f"coalesced: {scheduler.coalesced_count}",
+                f"rate limited: {scheduler.pending_count()}",
+                f"limit drops: {scheduler.dropped_count}",
+            ])
+            if self.rules.rules:
+                entries.extend([
+                    f"rules: {len(self.rules.rules)}",
+                    f"evaluated: {self.rules.evaluated_count}",
+                    f"rule drops: {self.rules.dropped_count}",
+                ])
+            if self.injector.sent_count:
+                entries.extend([
+                    f"injected: {self.injector.sent_count}",
+                    f"inject rate: {self.injector.rate} msg/s",
+                ])
         return(
             "mqtt status response",
-            [str(self.mqtt_client.isconnected())],
-            "Y9OQNRBTclzzFGtU"
+            normalize_entries_len(entries),
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_brokers(self) -> tuple:
+        """
+        Show the brokers of the pool, selecting one makes it the current
+        broker, its session is reused if it is still open.
+        """
+        if not self.async_mode:
+            return (
+                "mqtt brokers response",
+                ["async mode only"],
+                self.mqtt_page_uid
+            )
+        entries = []
+        for name in self.pool.sessions:
+            entry = name[:14]
+            self.add_command_calback(entry, self.use_broker, [name])
+            entries.append(entry)
+        if not entries:
+            entries = ["no connection"]
+        return (
+            "mqtt brokers response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def use_broker(self, name: str) -> tuple:
+        """
+        Make a broker the current one, the following commands work on
+        its connection.
+
+        Parameters
+        ----------
+        name : the broker name.
+        """
+        self._use_session(self.pool.switch(name))
+        return (
+            "mqtt use broker response",
+            normalize_entries_len(
+                [f"using {name}"] + self.pool.status_lines()
+            ),
+            self.mqtt_page_uid
         )
 
     @create_response_page
@@ -451,62 +1511,594 @@ class MqttManager:
         ---------
         topic : the topic to subscribe to.
         """
-        self.mqtt_client.subscribe(topic)
+        if self.async_mode:
+            self._spawn(self.mqtt_client.subscribe(topic), "subscribe")
+        else:
+            self.mqtt_client.subscribe(topic)
         return (
-            "mqtt subscribe response"
+            "mqtt subscribe response",
             [f"subscribed to {topic}"],
-            "Y9OQNRBTclzzFGtU"
+            self.mqtt_page_uid
         )
 
     @create_response_page
-    def publish(self, topic: str, msg: str) -> tuple:
+    def publish(self, topic: str, msg: str, broker: str = None) -> tuple:
         """
         Publish a message to a topic.
+        In async mode the message goes through the rate limiting
+        scheduler, then to the broker whose prefix matches the topic,
+        it is stored on the sd if the default broker is unreachable and
+        forwarded after the next connection.
 
         Parameters
         ---------
         topic : the topic to publish to.
         msg : the message to publish.
-        """
-        self.mqtt_client.publish(topic, msg)
+        broker : the name of the broker to publish to (async mode only),
+        if None it is chosen by topic prefix.
+        """
+        if self.async_mode:
+            if not self.scheduler.submit(topic, msg, broker):
+                return (
+                    "mqtt publish response",
+                    ["publish dropped", "too many topics"],
+                    self.mqtt_page_uid
+                )
+        else:
+            self.mqtt_client.publish(topic, msg)
+            self._capture_sent(topic, msg)
         return (
             "mqtt publish response",
             [f"published to {topic}"],
-            "Y9OQNRBTclzzFGtU"
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_scenarios(self) -> tuple:
+        """
+        Show the scenario files of scenarios_dir, selecting one plays it.
+        While a scenario is played the page allows to stop it.
+        """
+        if not self.async_mode:
+            return (
+                "mqtt inject response",
+                ["async mode only"],
+                self.mqtt_page_uid
+            )
+        if self.injector.running:
+            self.add_command_calback("stop inject", self.stop_injection, [])
+            return (
+                "mqtt inject response",
+                [
+                    "stop inject",
+                    f"done: {self.injector.progress}%",
+                    f"sent: {self.injector.sent_count}",
+                ],
+                self.mqtt_page_uid
+            )
+        try:
+            files = sorted(os.listdir(self.scenarios_dir))
+        except OSError:
+            return (
+                "mqtt inject response",
+                ["no scenarios", "card mounted ?"],
+                self.mqtt_page_uid
+            )
+        entries = []
+        for file in files:
+            entry = file[:14]
+            self.add_command_calback(
+                entry, self.inject, [f"{self.scenarios_dir}/{file}"]
+            )
+            entries.append(entry)
+        if not entries:
+            entries = ["no scenarios"]
+        return (
+            "mqtt inject response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def inject(self, path: str) -> tuple:
+        """
+        Play a scenario file in the background, the progress is shown
+        on the oled and the final rate in the logs.
+
+        Parameters
+        ----------
+        path : the path of the scenario file.
+        """
+        self._spawn(self.injector.run(path), "injection")
+        return (
+            "mqtt inject response",
+            normalize_entries_len([f"playing {path.split('/')[-1]}"]),
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop_injection(self) -> tuple:
+        """ Stop the scenario being played. """
+        self.injector.stop()
+        return (
+            "mqtt inject response",
+            [f"stopped at {self.injector.progress}%"],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_load_profiles(self) -> tuple:
+        """
+        Show the load profiles, selecting one starts it. While a load is
+        generated the page shows its rates and allows to stop it.
+        """
+        if not self.async_mode:
+            return (
+                "mqtt load response",
+                ["async mode only"],
+                self.mqtt_page_uid
+            )
+        generator = self.load_generator
+        if generator.running:
+            self.add_command_calback("stop load", self.stop_load, [])
+            return (
+                "mqtt load response",
+                [
+                    "stop load",
+                    f"target: {generator.target_rate}/s",
+                    f"got: {generator.rate}/s",
+                    f"sent: {generator.sent_count}",
+                    f"errors: {generator.error_count}",
+                ],
+                self.mqtt_page_uid
+            )
+        entries = []
+        for name in self.load_profiles:
+            entry = name[:14]
+            self.add_command_calback(entry, self.start_load, [name])
+            entries.append(entry)
+        if not entries:
+            entries = ["no profiles"]
+        return (
+            "mqtt load response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def start_load(self, name: str) -> tuple:
+        """
+        Start generating the load of a profile, the achieved and target
+        rates are shown on the oled.
+
+        Parameters
+        ----------
+        name : the profile name.
+        """
+        profile = self.load_profiles[name]
+        try:
+            frame = LoadFrame(
+                profile["topic"],
+                profile.get("payload", ""),
+                self.protocol_level
+            )
+        except (KeyError, ValueError) as e:
+            self.logger.error(f"bad load profile {name}: {e}")
+            return (
+                "mqtt load response",
+                ["bad profile !"],
+                self.mqtt_page_uid
+            )
+        self._spawn(
+            self.load_generator.run(
+                frame,
+                profile.get("rate", 10),
+                count=profile.get("count", 0),
+                duration_ms=profile.get("duration_ms", 0)
+            ),
+            "load generation"
+        )
+        return (
+            "mqtt load response",
+            [name[:14], f"{frame.size} B/msg"],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop_load(self) -> tuple:
+        """ Stop the running load. """
+        self.load_generator.stop()
+        return (
+            "mqtt load response",
+            [
+                "load stopped",
+                f"got: {self.load_generator.rate}/s",
+                f"sent: {self.load_generator.sent_count}",
+            ],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_topic_browser(self) -> tuple:
+        """
+        Start the topic browser if needed and show the root of the topic
+        tree, the browser subscribes to '#' and accounts every message.
+        """
+        if self.topic_tree is None:
+            self.topic_tree = TopicTree(
+                max_nodes=self.browser_settings.get("max_nodes", 128),
+                name_size=self.browser_settings.get("name_size", 24)
+            )
+            self.add_handler("#", self.topic_tree.record)
+            # the subscription is left as is if it was made by the user
+            self._browser_subscribed = "#" not in getattr(
+                self.mqtt_client, "subscriptions", {}
+            )
+            if self._browser_subscribed:
+                if self.async_mode:
+                    self._spawn(self.mqtt_client.subscribe("#"), "browse")
+                else:
+                    self.mqtt_client.subscribe("#")
+        return self._topic_node_page([])
+
+    @create_response_page
+    def browse_topics(self, path: list) -> tuple:
+        """
+        Show a node of the topic tree.
+
+        Parameters
+        ----------
+        path : the topic levels of the node, as bytes.
+        """
+        if self.topic_tree is None:
+            return (
+                "topic browser response",
+                ["browser stopped"],
+                self.mqtt_page_uid
+            )
+        return self._topic_node_page(path)
+
+    def _topic_node_page(self, path: list) -> tuple:
+        """
+        Build the page of a node: its counters then its children, the
+        busiest first, selecting a child shows its own page.
+        """
+        tree = self.topic_tree
+        node = tree.find(path)
+        entries = []
+        if node is None:
+            entries.append("node pruned")
+            path = []
+            node = tree.root
+        if path:
+            # the commands are keyed by entry text across every page, the
+            # entry names the parent so each level keeps its own
+            parent = "/".join(
+                str(level, "utf-8", "ignore") for level in path[:-1]
+            ) or "#"
+            entry = f"..{parent[-12:]}"
+            self.add_command_calback(entry, self.browse_topics, [path[:-1]])
+            entries.append(entry)
+        else:
+            self.add_command_calback(
+                "stop browser", self.stop_topic_browser, []
+            )
+            entries.append("stop browser")
+        now = ticks_ms()
+        msg_rate, byte_rate = node.rates(now)
+        stats = [
+            "/".join(str(level, "utf-8") for level in path) or "#",
+            f"msgs: {node.msg_count}",
+            f"{msg_rate} msg/s",
+            f"{byte_rate} B/s",
+            f"seen {ticks_diff(now, node.last_seen_ms) // 1000}s ago",
+        ]
+        if not path:
+            stats.extend([
+                f"nodes: {tree.node_count}/{tree.max_nodes}",
+                f"pruned: {tree.pruned_count}",
+            ])
+        entries.extend(normalize_entries_len(stats))
+        children = tree.busiest_children(node, now)[:MAX_BROWSER_CHILDREN]
+        for index, child in enumerate(children):
+            entry = "+" + str(child.name[:13], "utf-8", "ignore")
+            if entry in entries:
+                entry = f"{entry[:10]}~{index}"
+            self.add_command_calback(
+                entry, self.browse_topics, [path + [child.name]]
+            )
+            entries.append(entry)
+        return (
+            "topic browser response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop_topic_browser(self) -> tuple:
+        """ Stop the topic browser, dropping its tree. """
+        tree = self.topic_tree
+        if tree is None:
+            return (
+                "topic browser response",
+                ["not running"],
+                self.mqtt_page_uid
+            )
+        self.remove_handler("#", tree.record)
+        if self._browser_subscribed and self.async_mode:
+            self._spawn(self.mqtt_client.unsubscribe("#"), "stop browse")
+        self.topic_tree = None
+        return (
+            "topic browser response",
+            [
+                "browser stopped",
+                f"msgs: {tree.root.msg_count}",
+                f"topics: {tree.node_count}",
+            ],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_capture(self) -> tuple:
+        """
+        Show the capture state, allowing to start or stop it.
+        """
+        if self.capture is None:
+            self.add_command_calback("start capture", self.start_capture, [])
+            entries = ["start capture"]
+        else:
+            self.add_command_calback("stop capture", self.stop_capture, [])
+            entries = [
+                "stop capture",
+                f"msgs: {self.capture.record_count}",
+                f"bytes: {self.capture.bytes_written}",
+            ]
+        return (
+            "mqtt capture response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def start_capture(self) -> tuple:
+        """ Start recording the sent and received messages to the sd. """
+        if self.capture is not None:
+            return (
+                "mqtt capture response",
+                ["already running"],
+                self.mqtt_page_uid
+            )
+        try:
+            if not file_exists(self.captures_dir):
+                os.mkdir(self.captures_dir)
+            index = 0
+            while file_exists(f"{self.captures_dir}/cap{index:03d}.bin"):
+                index += 1
+            path = f"{self.captures_dir}/cap{index:03d}.bin"
+            self.capture = CaptureWriter(path)
+        except OSError as e:
+            self.logger.error(f"capture not started: {e}")
+            return (
+                "mqtt capture response",
+                ["capture error !", "card mounted ?"],
+                self.mqtt_page_uid
+            )
+        self.logger.info(f"capturing to {path}")
+        return (
+            "mqtt capture response",
+            ["capturing to", path.split("/")[-1]],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop_capture(self) -> tuple:
+        """ Stop the running capture, flushing its last block. """
+        capture = self.capture
+        if capture is None:
+            return (
+                "mqtt capture response",
+                ["not running"],
+                self.mqtt_page_uid
+            )
+        self.capture = None
+        capture.close()
+        return (
+            "mqtt capture response",
+            [
+                "capture saved",
+                f"msgs: {capture.record_count}",
+                f"bytes: {capture.bytes_written}",
+            ],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_captures(self) -> tuple:
+        """
+        Show the capture files, selecting one asks for the replay speed.
+        While a capture is replayed the page allows to stop it.
+        """
+        if not self.async_mode:
+            return (
+                "mqtt replay response",
+                ["async mode only"],
+                self.mqtt_page_uid
+            )
+        if self.replayer.running:
+            self.add_command_calback("stop replay", self.stop_replay, [])
+            return (
+                "mqtt replay response",
+                [
+                    "stop replay",
+                    f"done: {self.replayer.progress}%",
+                    f"sent: {self.replayer.replayed_count}",
+                ],
+                self.mqtt_page_uid
+            )
+        try:
+            files = sorted(os.listdir(self.captures_dir))
+        except OSError:
+            return (
+                "mqtt replay response",
+                ["no captures", "card mounted ?"],
+                self.mqtt_page_uid
+            )
+        entries = []
+        for file in files:
+            entry = file[:14]
+            self.add_command_calback(
+                entry,
+                self.show_replay_speeds,
+                [f"{self.captures_dir}/{file}"]
+            )
+            entries.append(entry)
+        if not entries:
+            entries = ["no captures"]
+        return (
+            "mqtt replay response",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_replay_speeds(self, path: str) -> tuple:
+        """
+        Show the replay speeds of a capture.
+
+        Parameters
+        ----------
+        path : the path of the capture file.
+        """
+        entries = []
+        for speed in REPLAY_SPEEDS:
+            entry = f"replay x{speed}" if speed else "replay max"
+            self.add_command_calback(entry, self.replay, [path, speed])
+            entries.append(entry)
+        return (
+            "mqtt replay speed",
+            entries,
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def replay(self, path: str, speed: int = 1) -> tuple:
+        """
+        Publish the messages of a capture again in the background,
+        the sent and received messages are both replayed.
+
+        Parameters
+        ----------
+        path : the path of the capture file.
+        speed : the speed factor, 0 to publish as fast as possible.
+        """
+        self._spawn(self.replayer.run(path, speed), "replay")
+        return (
+            "mqtt replay response",
+            normalize_entries_len([f"replaying {path.split('/')[-1]}"]),
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop_replay(self) -> tuple:
+        """ Stop the capture being replayed. """
+        self.replayer.stop()
+        return (
+            "mqtt replay response",
+            [f"stopped at {self.replayer.progress}%"],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_last_values(self) -> tuple:
+        """
+        Show the last message received on each topic,
+        the most recently updated first.
+        """
+        entries = self.message_store.last_values_lines()
+        if not entries:
+            entries = ["no messages"]
+        return (
+            "mqtt last values response",
+            normalize_entries_len(entries),
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def show_messages(self) -> tuple:
+        """ Show the most recent received messages, the newest first. """
+        entries = self.message_store.recent_lines()
+        if not entries:
+            entries = ["no messages"]
+        return (
+            "mqtt messages response",
+            normalize_entries_len(entries),
+            self.mqtt_page_uid
         )
 
     def check_messages_on_broker(self) -> None:
         """
         Check for messages on the broker.
+        In async mode the messages are read by the client receive task.
 
         Returns
         -------
         dict : a dictionary containing the topics and the messages.
         """
+        if self.async_mode:
+            return
         self.mqtt_client.check_msg()
 
+    @create_response_page
+    def show_fast_publish_presets(self) -> tuple:
+        """
+        Show the fast publish presets, selecting one publishes it.
+        """
+        entries = []
+        for key in self.fast_frames.frames:
+            entry = key[:14]
+            self.add_command_calback(entry, self.fast_publish, [key])
+            entries.append(entry)
+        if not entries:
+            entries = ["no presets"]
+        return (
+            "mqtt fast publish presets",
+            entries,
+            self.mqtt_page_uid
+        )
+
     @create_response_page
     def fast_publish(self, key: str) -> tuple:
         """
         Publish a message to a topic.
+        The preset packet is compiled at load time and written as is
+        to the socket.
 
         Parameters
         ---------
         key: the key of the topic and message to publish.
         """
-        self.publish(
-            self.fast_publish_topic_msg[key][0],
-            self.fast_publish_topic_msg[key][1]
-        )
+        frame = self.fast_frames.frame(key)
+        if self.async_mode:
+            self._spawn(self.mqtt_client.write_raw(frame), "fast publish")
+        else:
+            self.mqtt_client.sock.write(frame)
+        self._capture_sent(*self.fast_publish_topic_msg[key])
         return (
             "mqtt fast publish response",
             [f"published to {self.fast_publish_topic_msg[key][0]}"],
-            "Y9OQNRBTclzzFGtU"
+            self.mqtt_page_uid
         )
 
 
 class SdManager:
-    """ Manage the sd card. """
+    """
+    Manage the sd card.
+
+    Attributes
+    ----------
+    script_globals : the names made available to the scripts run by
+    excecute_file (e.g. the mqtt manager to register handlers).
+    """
     def __init__(
         self,
         hw_man: HardwareManager,
@@ -516,6 +2108,7 @@ class SdManager:
         self.parent_uid = "3piowGrCWbJkB9Jo"
         self.sd_reader = None
         self.add_command_calback = add_command_calback
+        self.script_globals = {}
         self.logger = Logger("SD_MANAGER")
         self.mount_card()
 
@@ -609,13 +2202,20 @@ class SdManager:
     def excecute_file(self, file: str) -> None:
         """
         Excecute a python file.
+        The script sees the sd manager as `self` plus the names of
+        script_globals, e.g. it can register an mqtt handler with
+        mqtt_manager.add_handler("sensors/#", on_sensor).
 
         Parameters
         ----------
         file : the path of the file to excecute.
         """
         try:
-            exec(open(file, encoding="utf-8").read())
+            with open(file, encoding="utf-8") as script_file:
+                source = script_file.read()
+            script_globals = {"__name__": "__script__", "self": self}
+            script_globals.update(self.script_globals)
+            exec(source, script_globals)
             return (
                 "excectue file response",
                 ["excecution ok !"],
@@ -758,6 +2358,27 @@ class ConfigManager:
         core_1_flag = False
         self.hw_man.set_led_bar(0)
 
+    def sram_usage(self) -> tuple:
+        """
+        Return the heap usage.
+
+        Returns
+        -------
+        tuple : (allocated, free) in bytes.
+        """
+        return gc.mem_alloc(), gc.mem_free()
+
+    def flash_usage(self) -> tuple:
+        """
+        Return the usage of the internal flash filesystem.
+
+        Returns
+        -------
+        tuple : (free, total) in bytes.
+        """
+        fs_stats = uos.statvfs("/")
+        return fs_stats[0] * fs_stats[3], fs_stats[0] * fs_stats[2]
+
     @create_response_page
     def get_available_sram(self) -> tuple:
         """
@@ -767,9 +2388,10 @@ class ConfigManager:
         -------
         int : the available sram.
         """
+        allocated, _ = self.sram_usage()
         return(
             "get available sram response",
-            [f"{int(gc.mem_alloc()/1024)} KB/264 KB"],
+            [f"{int(allocated/1024)} KB/264 KB"],
             "gv5qU62isrkomZHr",
         )
 
@@ -782,11 +2404,154 @@ class ConfigManager:
         -------
         the available flash memory.
         """
-        fs_stats = uos.statvfs("/")
-        total_flash = fs_stats[0] * fs_stats[2]
-        free_flash = fs_stats[0] * fs_stats[3]
+        free_flash, total_flash = self.flash_usage()
         return(
             "get available flash response",
             [f"{int(free_flash/1024)} KB/{int(total_flash/1024)} KB"],
             "gv5qU62isrkomZHr",
         )
+
+
+class TelemetryManager:
+    """
+    Publish the device telemetry on a fixed cadence.
+
+    The jobs of the telemetry settings file run on a TimerWheel task,
+    each one samples a source and hands the value to the mqtt manager,
+    which encodes it with the codec of the topic and schedules it, the
+    menu loop is never blocked by a sample.
+
+    Attributes
+    ----------
+    wheel : the TimerWheel running the jobs.
+    topic_prefix : the prefix of the telemetry topics, a job publishes
+    to {topic_prefix}/{source} unless it sets its own topic.
+    jobs_settings : the jobs of the settings file, each one built as
+    {"source": ..., "period_ms": ..., "topic": ...}.
+    sources : a dict containing the sampling function of each source.
+    published_count : the number of published samples.
+    """
+    def __init__(
+        self,
+        config_manager: ConfigManager,
+        wlan_manager: WlanManager,
+        mqtt_manager: MqttManager
+    ) -> None:
+        self.config_manager = config_manager
+        self.wlan_manager = wlan_manager
+        self.mqtt_manager = mqtt_manager
+        self.topic_prefix = "mqtt_injector/telemetry"
+        self.jobs_settings = []
+        self.published_count = 0
+        self.logger = Logger("TELEMETRY_MANAGER")
+        self.mqtt_page_uid = "Y9OQNRBTclzzFGtU"
+        self.sources = {
+            "sram": self._sample_sram,
+            "flash": self._sample_flash,
+            "rssi": self.wlan_manager.rssi,
+            "uptime": self._sample_uptime,
+        }
+        self._jobs = []
+        self._task = None
+        self._uptime_ms = 0
+        self._uptime_at = 0
+        slots, tick_ms = self._load_settings()
+        self.wheel = TimerWheel(slots, tick_ms)
+
+    def _load_settings(self) -> tuple:
+        """
+        Load the jobs from the telemetry settings file.
+
+        Returns
+        -------
+        tuple : (slots, tick_ms) of the timer wheel.
+        """
+        try:
+            settings = SettingsManager.get_settings("telemetry")
+        except ValueError:
+            return 64, 100
+        self.topic_prefix = settings.get("topic_prefix", self.topic_prefix)
+        self.jobs_settings = settings.get("jobs", [])
+        return settings.get("slots", 64), settings.get("tick_ms", 100)
+
+    def _sample_sram(self) -> dict:
+        """ Return the heap usage in bytes. """
+        allocated, free = self.config_manager.sram_usage()
+        return {"allocated": allocated, "free": free}
+
+    def _sample_flash(self) -> dict:
+        """ Return the flash usage in bytes. """
+        free, total = self.config_manager.flash_usage()
+        return {"free": free, "total": total}
+
+    def _sample_uptime(self) -> int:
+        """
+        Return the uptime in seconds, ticks_ms wraps after about 12 days
+        so the elapsed time is accumulated at every sample.
+        """
+        now = ticks_ms()
+        self._uptime_ms += ticks_diff(now, self._uptime_at)
+        self._uptime_at = now
+        return self._uptime_ms // 1000
+
+    def _job(self, source: str, topic: str):
+        """ Return the callback sampling source and publishing it. """
+        sample = self.sources[source]
+
+        def callback() -> None:
+            if self.mqtt_manager.publish_value(topic, sample()):
+                self.published_count += 1
+        return callback
+
+    @create_response_page
+    def start(self) -> tuple:
+        """ Schedule the telemetry jobs and start the timer wheel. """
+        if self._task is None:
+            for job in self.jobs_settings:
+                source = job["source"]
+                if source not in self.sources:
+                    self.logger.error(f"unknown telemetry source {source}")
+                    continue
+                topic = job.get("topic", f"{self.topic_prefix}/{source}")
+                self._jobs.append(self.wheel.add(
+                    job["period_ms"],
+                    self._job(source, topic),
+                    job.get("delay_ms")
+                ))
+            self._task = asyncio.create_task(self.wheel.run())
+        return (
+            "telemetry start response",
+            [f"{self.wheel.jobs_count} jobs running"],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def stop(self) -> tuple:
+        """ Cancel the telemetry jobs and stop the timer wheel. """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            for job in self._jobs:
+                self.wheel.cancel(job)
+            self._jobs = []
+        return (
+            "telemetry stop response",
+            ["telemetry off"],
+            self.mqtt_page_uid
+        )
+
+    @create_response_page
+    def status(self) -> tuple:
+        """ Show the telemetry jobs and counters. """
+        entries = [
+            f"running: {self._task is not None}",
+            f"published: {self.published_count}",
+            f"late ticks: {self.wheel.late_ticks}",
+        ]
+        for job in self.jobs_settings:
+            entries.append(f"{job['source']} {job['period_ms']} ms")
+        return (
+            "telemetry status response",
+            normalize_entries_len(entries),
+            self.mqtt_page_uid
+        )
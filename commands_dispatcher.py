@@ -4,7 +4,8 @@ from commands import (
     BleManager,
     MqttManager,
     SdManager,
-    ConfigManager
+    ConfigManager,
+    TelemetryManager
 )
 from hardware_manager import HardwareManager
 
@@ -21,6 +22,7 @@ class CommandsDispatcher:
     mqtt_manager : an instance of the MqttManager class.
     sd_manager : an instance of the SdManager class.
     config_manager : an instance of the ConfigManager class.
+    telemetry_manager : an instance of the TelemetryManager class.
     commands : a dict containing the commands.
     """
     def __init__(self, hw_man: HardwareManager) -> None:
@@ -28,8 +30,16 @@ class CommandsDispatcher:
         self.sd_manager = SdManager(hw_man, self.add_command)
         self.wlan_manager = WlanManager(hw_man, self.add_command)
         self.ble_manager = BleManager(self.add_command)
-        self.mqtt_manager = MqttManager(self.add_command)
+        self.mqtt_manager = MqttManager(hw_man, self.add_command)
         self.config_manager = ConfigManager(hw_man, self.add_command)
+        self.telemetry_manager = TelemetryManager(
+            self.config_manager, self.wlan_manager, self.mqtt_manager
+        )
+        self.sd_manager.script_globals.update({
+            "hw_man": hw_man,
+            "mqtt_manager": self.mqtt_manager,
+            "wlan_manager": self.wlan_manager,
+        })
         self.commands = {}
         self._bind_commands()
         self.command_output_to_display = {}
@@ -41,17 +51,29 @@ class CommandsDispatcher:
             "wlan scan": self.wlan_manager.scan_networks,
             "wlan status": self.wlan_manager.status,
             "list devices": self.wlan_manager.list_devices,
+            "scan ports": self.wlan_manager.scan_ports,
             "disconnect": self.wlan_manager.disconnect,
             "ble status": self.ble_manager.status,
             "ble scan": self.ble_manager.scan,
             "ble connect": self.ble_manager.connect,
-            "fast_publish": self.mqtt_manager.fast_publish,
+            "fast publish": self.mqtt_manager.show_fast_publish_presets,
             "fast_connect": self.mqtt_manager.connect,
             "mqtt set conn": self.mqtt_manager.create_connection,
             "mqtt connect": self.mqtt_manager.connect,
             "mqtt status": self.mqtt_manager.status,
             "mqtt subscribe": self.mqtt_manager.subscribe,
             "mqtt publish": self.mqtt_manager.publish,
+            "mqtt last vals": self.mqtt_manager.show_last_values,
+            "mqtt messages": self.mqtt_manager.show_messages,
+            "mqtt brokers": self.mqtt_manager.show_brokers,
+            "mqtt inject": self.mqtt_manager.show_scenarios,
+            "mqtt capture": self.mqtt_manager.show_capture,
+            "mqtt replay": self.mqtt_manager.show_captures,
+            "topic browser": self.mqtt_manager.show_topic_browser,
+            "load generator": self.mqtt_manager.show_load_profiles,
+            "telemetry on": self.telemetry_manager.start,
+            "telemetry off": self.telemetry_manager.stop,
+            "telemetry stat": self.telemetry_manager.status,
             "mount card": self.sd_manager.mount_card,
             "umount card": self.sd_manager.unmount_card,
             "list files": self.sd_manager.list_card_files,
@@ -1,6 +1,7 @@
 """ A simple logger module. """
 import os
-import time
+
+from timing import ticks_ms
 
 LOG_FOLDER = "logs"
 LOG_FILE = "device.log"
@@ -41,7 +42,7 @@ class Logger:
                 f.write("")
 
     def _get_uptime(self) -> str:
-        uptime_s = time.ticks_ms() // 1000
+        uptime_s = ticks_ms() // 1000
         return '{:02}:{:02}:{:02}'.format(
             uptime_s // 3600, (uptime_s % 3600) // 60, uptime_s % 60
         )
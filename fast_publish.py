@@ -0,0 +1,80 @@
+"""
+Pre-encoded fast publish frames.
+
+The fast publish presets are compiled once into complete qos 0 PUBLISH
+packets, pressing a preset then costs a single socket write, without
+encoding anything at publish time.
+"""
+from mqtt_protocol import (
+    PROTOCOL_LEVEL_3_1_1,
+    PROTOCOL_LEVEL_5,
+    publish_packet,
+)
+
+
+class FastPublishFrames:
+    """
+    The compiled fast publish presets.
+
+    Attributes
+    ----------
+    presets : a dict containing for each preset key its (topic, msg).
+    frames : a dict containing for each preset key its PUBLISH packet.
+    protocol_level : the mqtt protocol the packets are encoded for, the
+    mqtt 5 packets carry an empty properties block and no topic alias.
+    """
+    def __init__(self, protocol_level: int = PROTOCOL_LEVEL_3_1_1) -> None:
+        self.presets = {}
+        self.frames = {}
+        self.protocol_level = protocol_level
+
+    def load(self, presets: dict) -> None:
+        """
+        Compile the presets, replacing the previous ones.
+
+        Parameters
+        ----------
+        presets : a dict built as follows:
+            key : [topic, msg] or {"topic": ..., "msg": ..., "retain": ...}
+        """
+        self.presets = {}
+        self.frames = {}
+        for key, preset in presets.items():
+            if isinstance(preset, dict):
+                self.add(
+                    key,
+                    preset["topic"],
+                    preset["msg"],
+                    preset.get("retain", False)
+                )
+            else:
+                self.add(key, preset[0], preset[1])
+
+    def add(
+        self,
+        key: str,
+        topic: str,
+        msg: str,
+        retain: bool = False
+    ) -> None:
+        """
+        Compile a single preset.
+
+        Parameters
+        ----------
+        key : the preset name.
+        topic : the topic to publish to.
+        msg : the message to publish.
+        retain : the retain flag.
+        """
+        self.presets[key] = (topic, msg)
+        properties = None
+        if self.protocol_level == PROTOCOL_LEVEL_5:
+            properties = b"\x00"
+        self.frames[key] = bytearray(
+            publish_packet(topic, msg, 0, retain, properties=properties)
+        )
+
+    def frame(self, key: str) -> bytearray:
+        """ Return the PUBLISH packet of a preset. """
+        return self.frames[key]
@@ -0,0 +1,292 @@
+"""
+Scripted mqtt traffic injection from a scenario file.
+
+A scenario is a text file of json lines, one step per line:
+
+    {"topic": "lab/dev/${counter}", "payload": "t=${rand:18:25}",
+     "delay_ms": 100, "repeat": 50}
+
+every step publishes repeat messages, delay_ms apart (0 to publish as
+fast as the link accepts them). Empty lines and lines starting with '#'
+are skipped. The optional "qos" and "broker" keys select the quality of
+service and the broker of the step.
+
+The topic and the payload are templates compiled once per step, the
+supported fields are:
+
+    ${counter}       the message index in the step, from 0
+    ${seq}           the message index in the whole scenario, from 0
+    ${ts}            the ticks_ms at publish time
+    ${rand:min:max}  a random integer in [min, max]
+    ${choice:a|b|c}  one of the listed values, picked at random
+
+The file is streamed line by line so a scenario can be larger than the
+ram, the pacing follows absolute deadlines so the publish time does not
+accumulate as drift over a long step.
+"""
+import json
+import os
+import random
+
+from device_logging import Logger
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms, ticks_us
+
+FIELD_COUNTER = 0
+FIELD_SEQ = 1
+FIELD_TS = 2
+FIELD_RAND = 3
+FIELD_CHOICE = 4
+FIELD_NAMES = {
+    "counter": FIELD_COUNTER,
+    "seq": FIELD_SEQ,
+    "ts": FIELD_TS,
+    "rand": FIELD_RAND,
+    "choice": FIELD_CHOICE,
+}
+YIELD_EVERY = 16
+MAX_LAG_US = 1000000
+PROGRESS_INTERVAL_MS = 250
+
+
+def compile_template(template: str) -> list:
+    """
+    Split a template into its literal and field parts.
+
+    Parameters
+    ----------
+    template : the template, e.g. "lab/${choice:a|b}/${counter}".
+
+    Returns
+    -------
+    list : the parts, a str for the literal text and a tuple
+    (field, args) for every field.
+    """
+    parts = []
+    position = 0
+    while True:
+        start = template.find("${", position)
+        if start < 0:
+            break
+        end = template.find("}", start)
+        if end < 0:
+            raise ValueError(f"unclosed field in {template}")
+        if start > position:
+            parts.append(template[position:start])
+        name, _, args = template[start + 2:end].partition(":")
+        field = FIELD_NAMES.get(name)
+        if field is None:
+            raise ValueError(f"unknown field {name}")
+        if field == FIELD_RAND:
+            low, high = args.split(":")
+            parts.append((field, (int(low), int(high))))
+        elif field == FIELD_CHOICE:
+            parts.append((field, args.split("|")))
+        else:
+            parts.append((field, None))
+        position = end + 1
+    if position < len(template):
+        parts.append(template[position:])
+    return parts
+
+
+def render(parts: list, counter: int, seq: int) -> str:
+    """
+    Fill the fields of a compiled template.
+
+    Parameters
+    ----------
+    parts : the parts returned by compile_template.
+    counter : the message index in the step.
+    seq : the message index in the scenario.
+    """
+    if len(parts) == 1 and isinstance(parts[0], str):
+        return parts[0]
+    values = []
+    for part in parts:
+        if isinstance(part, str):
+            values.append(part)
+            continue
+        field, args = part
+        if field == FIELD_COUNTER:
+            values.append(str(counter))
+        elif field == FIELD_SEQ:
+            values.append(str(seq))
+        elif field == FIELD_TS:
+            values.append(str(ticks_ms()))
+        elif field == FIELD_RAND:
+            values.append(str(random.randint(args[0], args[1])))
+        else:
+            values.append(random.choice(args))
+    return "".join(values)
+
+
+class InjectionEngine:
+    """
+    Play a scenario file, publishing its messages at the scripted pace.
+
+    Attributes
+    ----------
+    publish : a coroutine function called as
+    publish(topic, msg, qos, broker) for every message.
+    on_progress : an optional callable called as
+    on_progress(percentage, sent_count) at most every
+    PROGRESS_INTERVAL_MS and once at the end.
+    running : True while a scenario is played.
+    sent_count : the number of messages published by the last run.
+    error_count : the number of failed publications and bad lines.
+    progress : the percentage of the scenario played.
+    elapsed_ms : the duration of the last run.
+    rate : the average rate of the last run in messages per second.
+    """
+    def __init__(self, publish, on_progress=None) -> None:
+        self.publish = publish
+        self.on_progress = on_progress
+        self.running = False
+        self.sent_count = 0
+        self.error_count = 0
+        self.progress = 0
+        self.elapsed_ms = 0
+        self.rate = 0
+        self.logger = Logger("INJECTOR")
+        self._stop_requested = False
+        self._file_size = 1
+        self._progress_at = 0
+        self._seq = 0
+
+    def stop(self) -> None:
+        """ Stop the running scenario after the current message. """
+        self._stop_requested = True
+
+    async def run(self, path: str) -> int:
+        """
+        Play a scenario file.
+
+        Parameters
+        ----------
+        path : the path of the scenario, e.g. "/sd/scenarios/burst.jsonl".
+
+        Returns
+        -------
+        int : the number of published messages.
+        """
+        if self.running:
+            raise OSError("an injection is already running")
+        # a missing scenario raises before the engine is marked running
+        self._file_size = max(os.stat(path)[6], 1)
+        self.running = True
+        self._stop_requested = False
+        self.sent_count = 0
+        self.error_count = 0
+        self.progress = 0
+        self._seq = 0
+        started_at = ticks_ms()
+        self._progress_at = started_at
+        try:
+            with open(path, "r", encoding="utf-8") as scenario_file:
+                offset = 0
+                line_number = 0
+                for line in scenario_file:
+                    line_number += 1
+                    line_start = offset
+                    offset += len(line)
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    try:
+                        step = self._parse_step(line)
+                    except (ValueError, KeyError) as e:
+                        self.error_count += 1
+                        self.logger.error(f"line {line_number}: {e}")
+                        continue
+                    await self._play_step(step, line_start, offset)
+                    if self._stop_requested:
+                        break
+                else:
+                    self.progress = 100
+        finally:
+            self.running = False
+            self.elapsed_ms = ticks_diff(ticks_ms(), started_at)
+            self.rate = self.sent_count * 1000 // max(self.elapsed_ms, 1)
+            self._report_progress(force=True)
+        self.logger.info(
+            f"{self.sent_count} messages in {self.elapsed_ms} ms, "
+            f"{self.rate} msg/s, {self.error_count} errors"
+        )
+        return self.sent_count
+
+    def _parse_step(self, line: str) -> tuple:
+        """
+        Compile a scenario line.
+
+        Returns
+        -------
+        tuple : (topic_parts, payload_parts, period_us, repeat, qos, broker)
+        """
+        step = json.loads(line)
+        return (
+            compile_template(step["topic"]),
+            compile_template(str(step.get("payload", ""))),
+            int(step.get("delay_ms", 0) * 1000),
+            int(step.get("repeat", 1)),
+            step.get("qos", 0),
+            step.get("broker"),
+        )
+
+    async def _play_step(
+        self,
+        step: tuple,
+        line_start: int,
+        line_end: int
+    ) -> None:
+        """
+        Publish the messages of a step, each one at its deadline.
+
+        Parameters
+        ----------
+        step : the compiled step.
+        line_start : the offset of the step line in the scenario file.
+        line_end : the offset of the following line.
+        """
+        topic_parts, payload_parts, period_us, repeat, qos, broker = step
+        deadline = ticks_us()
+        for counter in range(repeat):
+            if self._stop_requested:
+                return
+            wait_us = ticks_diff(deadline, ticks_us())
+            if wait_us >= 1000:
+                await sleep_ms(wait_us // 1000)
+            elif wait_us < -MAX_LAG_US:
+                # too late to catch up, restart the pacing from now
+                deadline = ticks_us()
+            elif counter % YIELD_EVERY == 0:
+                await sleep_ms(0)
+            try:
+                await self.publish(
+                    render(topic_parts, counter, self._seq),
+                    render(payload_parts, counter, self._seq),
+                    qos,
+                    broker
+                )
+                self.sent_count += 1
+            except (OSError, ValueError) as e:
+                # ValueError: a broker unknown to the pool
+                self.error_count += 1
+                self.logger.warning(f"publish failed: {e}")
+            self._seq += 1
+            deadline = ticks_add(deadline, period_us)
+            self.progress = (
+                line_start + (line_end - line_start) * (counter + 1) // repeat
+            ) * 100 // self._file_size
+            self._report_progress()
+
+    def _report_progress(self, force: bool = False) -> None:
+        """ Call on_progress, at most every PROGRESS_INTERVAL_MS. """
+        if self.on_progress is None:
+            return
+        now = ticks_ms()
+        if not force and ticks_diff(now, self._progress_at) < (
+            PROGRESS_INTERVAL_MS
+        ):
+            return
+        self._progress_at = now
+        self.on_progress(self.progress, self.sent_count)
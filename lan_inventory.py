@@ -0,0 +1,167 @@
+"""
+Persistent inventory of the devices found on the visited networks.
+
+The hosts answering the ping sweeps are kept per network (the ssid and
+the /24 prefix) with the time they were first and last seen and their
+last ping latency, in a json file of the sd. A network seen before is
+rescanned in two passes: the hosts alive at the last visit are pinged
+first so their page shows up at once, the rest of the prefix is swept in
+the background, only when the last full sweep is older than
+full_sweep_s, which keeps the ping traffic low on the usual networks.
+
+The times are the seconds of time.time(), the clock is set with ntp
+once the network is joined and the inventory is not used until then.
+Times later than now, written before the clock went back, are reset so
+their hosts count as stale and a full sweep is due.
+"""
+import time
+
+import ntptime
+
+from storage import atomic_write_json, load_json
+
+INVENTORY_FORMAT = 1
+FIRST_SEEN = 0
+LAST_SEEN = 1
+LATENCY = 2
+
+
+class NetworkInventory:
+    """
+    The known hosts of a network.
+
+    Attributes
+    ----------
+    hosts : a dict containing [first_seen, last_seen, latency_ms] by
+    host address.
+    full_sweep : the time of the last sweep of the whole prefix.
+    """
+    def __init__(self, hosts: dict = None, full_sweep: int = 0) -> None:
+        self.hosts = hosts if hosts is not None else {}
+        self.full_sweep = full_sweep
+
+    def record(self, found: list, now: int) -> int:
+        """
+        Account the hosts which answered a sweep.
+
+        Parameters
+        ----------
+        found : the (address, latency_ms) tuples of the sweep.
+        now : the current time.
+
+        Returns
+        -------
+        int : the number of hosts never seen before.
+        """
+        new_count = 0
+        for address, latency_ms in found:
+            entry = self.hosts.get(address)
+            if entry is None:
+                self.hosts[address] = [now, now, round(latency_ms, 1)]
+                new_count += 1
+                continue
+            entry[LAST_SEEN] = now
+            entry[LATENCY] = round(latency_ms, 1)
+        return new_count
+
+    def reset_future(self, now: int) -> None:
+        """ Reset the times later than now, making them stale. """
+        for entry in self.hosts.values():
+            if entry[LAST_SEEN] > now:
+                entry[LAST_SEEN] = 0
+        if self.full_sweep > now:
+            self.full_sweep = 0
+
+    def alive(self, since: int) -> list:
+        """ Return the hosts seen since a time, sorted by address. """
+        return sort_addresses(
+            address for address, entry in self.hosts.items()
+            if entry[LAST_SEEN] >= since
+        )
+
+    def stale(self, since: int) -> list:
+        """ Return the hosts not seen since a time, sorted by address. """
+        return sort_addresses(
+            address for address, entry in self.hosts.items()
+            if entry[LAST_SEEN] < since
+        )
+
+
+def sort_addresses(addresses) -> list:
+    """ Return ipv4 addresses sorted numerically. """
+    return sorted(
+        addresses,
+        key=lambda address: [int(part) for part in address.split(".")]
+    )
+
+
+class LanInventory:
+    """
+    The inventory of every visited network, saved on the sd.
+
+    Attributes
+    ----------
+    path : the path of the inventory file.
+    max_networks : the number of networks kept, the least recently swept
+    ones are forgotten first.
+    networks : a dict containing the NetworkInventory by network key.
+    loaded : True once the file has been read.
+    clock_set : True once the clock has been set with ntp.
+    """
+    def __init__(self, path: str, max_networks: int = 8) -> None:
+        self.path = path
+        self.max_networks = max_networks
+        self.networks = {}
+        self.loaded = False
+        self.clock_set = False
+
+    def load(self) -> None:
+        """ Read the inventory file, an unreadable file is ignored. """
+        self.loaded = True
+        data = load_json(self.path)
+        if not data or data.get("format") != INVENTORY_FORMAT:
+            return
+        self.networks = {
+            key: NetworkInventory(network["hosts"], network["full_sweep"])
+            for key, network in data["networks"].items()
+        }
+
+    def save(self) -> None:
+        """ Write the inventory file. """
+        if len(self.networks) > self.max_networks:
+            keys = sorted(
+                self.networks,
+                key=lambda key: self.networks[key].full_sweep
+            )
+            for key in keys[:len(self.networks) - self.max_networks]:
+                del self.networks[key]
+        atomic_write_json(self.path, {
+            "format": INVENTORY_FORMAT,
+            "networks": {
+                key: {
+                    "hosts": network.hosts,
+                    "full_sweep": network.full_sweep,
+                }
+                for key, network in self.networks.items()
+            },
+        })
+
+    def network(self, key: str) -> NetworkInventory:
+        """ Return the inventory of a network, created if unknown. """
+        if not self.loaded:
+            self.load()
+        network = self.networks.get(key)
+        if network is None:
+            network = NetworkInventory()
+            self.networks[key] = network
+        return network
+
+    def set_clock(self) -> None:
+        """ Set the clock with ntp, the network must be joined. """
+        ntptime.settime()
+        self.clock_set = True
+
+    @staticmethod
+    def now() -> int:
+        """ Return the current time in seconds. """
+        return int(time.time())
@@ -0,0 +1,281 @@
+"""
+Allocation free mqtt load generator.
+
+A load profile is a topic and a payload template rendered once into a
+complete qos 0 PUBLISH packet. Every field of the templates has a fixed
+width, so the packet length never changes and sending a message only
+rewrites the digits of the variable fields in place before writing the
+same buffer again: the generation loop does not allocate.
+
+The supported fields, usable in the topic and in the payload, are:
+
+    ${seq:width}        the message index, from 0 (width 8 by default)
+    ${ts:width}         the ticks_ms at send time (width 10 by default)
+    ${rand:min:max}     a random integer in [min, max], 0 <= min <= max
+    ${pad:size}         size filler bytes, rendered once
+
+the numbers are zero padded to their width and wrap when they overflow
+it (e.g. a ${seq:4} counts 0000 to 9999 then 0000 again).
+"""
+import random
+
+from device_logging import Logger
+from mqtt_protocol import (
+    PROTOCOL_LEVEL_3_1_1,
+    PROTOCOL_LEVEL_5,
+    publish_packet,
+)
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms, ticks_us
+
+FIELD_SEQ = 0
+FIELD_TS = 1
+FIELD_RAND = 2
+FIELD_PAD = 3
+DEFAULT_WIDTHS = {"seq": 8, "ts": 10}
+PAD_BYTE = ord("x")
+YIELD_EVERY = 16
+MAX_LAG_US = 1000000
+ERROR_BACKOFF_MS = 100
+PROGRESS_INTERVAL_MS = 250
+
+
+def render_fixed_template(template: str) -> tuple:
+    """
+    Render a template with every field at its initial value.
+
+    Parameters
+    ----------
+    template : the template, e.g. '{"n":${seq:6},"pad":"${pad:32}"}'.
+
+    Returns
+    -------
+    tuple : (rendered, fields), rendered is the bytes of the template and
+    fields a list of (field, offset, width, low, span) tuples, offset
+    being relative to the rendered bytes.
+    """
+    rendered = bytearray()
+    fields = []
+    position = 0
+    while True:
+        start = template.find("${", position)
+        if start < 0:
+            break
+        end = template.find("}", start)
+        if end < 0:
+            raise ValueError(f"unclosed field in {template}")
+        rendered += template[position:start].encode("utf-8")
+        name, _, args = template[start + 2:end].partition(":")
+        offset = len(rendered)
+        if name in DEFAULT_WIDTHS:
+            width = int(args) if args else DEFAULT_WIDTHS[name]
+            field = FIELD_SEQ if name == "seq" else FIELD_TS
+            fields.append((field, offset, width, 0, 0))
+            rendered += b"0" * width
+        elif name == "rand":
+            low, high = (int(arg) for arg in args.split(":"))
+            if not 0 <= low <= high:
+                raise ValueError(f"bad random range in {template}")
+            width = len(str(high))
+            fields.append((FIELD_RAND, offset, width, low, high - low))
+            rendered += b"0" * width
+        elif name == "pad":
+            rendered += bytes([PAD_BYTE]) * int(args)
+        else:
+            raise ValueError(f"unknown field {name}")
+        position = end + 1
+    rendered += template[position:].encode("utf-8")
+    return bytes(rendered), fields
+
+
+def write_digits(buffer, offset: int, width: int, value: int) -> None:
+    """ Write value in decimal, zero padded, over buffer[offset:+width]. """
+    position = offset + width - 1
+    while position >= offset:
+        buffer[position] = 48 + value % 10
+        value //= 10
+        position -= 1
+
+
+class LoadFrame:
+    """
+    A pre-rendered PUBLISH packet and the position of its fields.
+
+    Attributes
+    ----------
+    frame : the packet, patched in place by patch.
+    size : the length of the packet.
+    """
+    def __init__(
+        self,
+        topic: str,
+        payload: str,
+        protocol_level: int = PROTOCOL_LEVEL_3_1_1
+    ) -> None:
+        topic_bytes, topic_fields = render_fixed_template(topic)
+        payload_bytes, payload_fields = render_fixed_template(payload)
+        properties = b""
+        if protocol_level == PROTOCOL_LEVEL_5:
+            properties = b"\x00"
+        self.frame = bytearray(
+            publish_packet(
+                topic_bytes,
+                payload_bytes,
+                0,
+                properties=properties if properties else None
+            )
+        )
+        self.size = len(self.frame)
+        # a qos 0 packet ends with topic | properties | payload
+        payload_offset = self.size - len(payload_bytes)
+        topic_offset = payload_offset - len(properties) - len(topic_bytes)
+        self._fields = [
+            (field, topic_offset + offset, width, low, span)
+            for field, offset, width, low, span in topic_fields
+        ] + [
+            (field, payload_offset + offset, width, low, span)
+            for field, offset, width, low, span in payload_fields
+            if field != FIELD_PAD
+        ]
+
+    def patch(self, seq: int) -> None:
+        """ Write the values of the fields of message seq. """
+        frame = self.frame
+        for field, offset, width, low, span in self._fields:
+            if field == FIELD_SEQ:
+                value = seq
+            elif field == FIELD_TS:
+                value = ticks_ms()
+            else:
+                value = low + random.randint(0, span)
+            write_digits(frame, offset, width, value)
+
+
+class LoadGenerator:
+    """
+    Send a LoadFrame at a target rate.
+
+    Attributes
+    ----------
+    write : a coroutine function writing a complete packet to the
+    broker, called as write(frame).
+    on_progress : an optional callable called as
+    on_progress(percentage, target_rate, achieved_rate) at most every
+    PROGRESS_INTERVAL_MS and at the end of the run.
+    running : True while a load is generated.
+    sent_count : the number of messages sent by the last run.
+    error_count : the number of failed writes of the last run.
+    target_rate : the messages per second requested.
+    rate : the messages per second achieved since the start of the run.
+    progress : the percentage of the run done.
+    """
+    def __init__(self, write, on_progress=None) -> None:
+        self.write = write
+        self.on_progress = on_progress
+        self.running = False
+        self.sent_count = 0
+        self.error_count = 0
+        self.target_rate = 0
+        self.rate = 0
+        self.progress = 0
+        self.logger = Logger("LOAD_GENERATOR")
+        self._stop_requested = False
+        self._started_at = 0
+        self._progress_at = 0
+
+    def stop(self) -> None:
+        """ Stop the running load after the current message. """
+        self._stop_requested = True
+
+    async def run(
+        self,
+        frame: LoadFrame,
+        rate: int,
+        count: int = 0,
+        duration_ms: int = 0
+    ) -> int:
+        """
+        Generate the load until count messages have been sent or for
+        duration_ms, whichever comes first, or until stopped.
+
+        Parameters
+        ----------
+        frame : the frame to send.
+        rate : the target messages per second.
+        count : the number of messages, 0 for no limit.
+        duration_ms : the duration of the run, 0 for no limit.
+
+        Returns
+        -------
+        int : the number of messages sent.
+        """
+        if self.running:
+            raise OSError("a load is already running")
+        if rate <= 0:
+            raise ValueError(f"bad rate {rate}, it must be positive")
+        self.running = True
+        self._stop_requested = False
+        self.sent_count = 0
+        self.error_count = 0
+        self.target_rate = rate
+        self.rate = 0
+        self.progress = 0
+        period_us = 1000000 // rate
+        self._started_at = ticks_ms()
+        self._progress_at = self._started_at
+        deadline = ticks_us()
+        seq = 0
+        try:
+            while not self._stop_requested:
+                elapsed_ms = ticks_diff(ticks_ms(), self._started_at)
+                if count and seq >= count:
+                    break
+                if duration_ms and elapsed_ms >= duration_ms:
+                    break
+                wait_us = ticks_diff(deadline, ticks_us())
+                if wait_us >= 1000:
+                    await sleep_ms(wait_us // 1000)
+                elif wait_us < -MAX_LAG_US:
+                    # too late to catch up, restart the pacing from now
+                    deadline = ticks_us()
+                elif seq % YIELD_EVERY == 0:
+                    await sleep_ms(0)
+                frame.patch(seq)
+                try:
+                    await self.write(frame.frame)
+                    self.sent_count += 1
+                except OSError as e:
+                    self.error_count += 1
+                    if self.error_count == 1:
+                        self.logger.warning(f"write failed: {e}")
+                    await sleep_ms(ERROR_BACKOFF_MS)
+                seq += 1
+                deadline = ticks_add(deadline, period_us)
+                if count:
+                    self.progress = seq * 100 // count
+                elif duration_ms:
+                    self.progress = min(100, elapsed_ms * 100 // duration_ms)
+                self._report_progress(False)
+            else:
+                self.logger.info("load stopped")
+        finally:
+            self.running = False
+            self._report_progress(True)
+        self.logger.info(
+            f"{self.sent_count} messages sent at {self.rate} msg/s "
+            f"for {self.target_rate} msg/s, {self.error_count} errors"
+        )
+        return self.sent_count
+
+    def _report_progress(self, force: bool) -> None:
+        """ Refresh the achieved rate and call on_progress. """
+        now = ticks_ms()
+        elapsed_ms = ticks_diff(now, self._started_at)
+        if not force and ticks_diff(now, self._progress_at) < (
+            PROGRESS_INTERVAL_MS
+        ):
+            return
+        self._progress_at = now
+        if elapsed_ms > 0:
+            self.rate = self.sent_count * 1000 // elapsed_ms
+        if self.on_progress is not None:
+            self.on_progress(self.progress, self.target_rate, self.rate)
@@ -0,0 +1,256 @@
+"""
+Fixed memory store of the received mqtt messages.
+
+Both the last value cache and the ring buffer copy the topics and the
+payloads into buffers allocated once at init time, a high rate
+subscription only rewrites them and never grows or fragments the heap.
+Topics and payloads longer than the buffers are truncated.
+"""
+from array import array
+from binascii import hexlify
+
+from timing import ticks_diff, ticks_ms
+
+NO_SLOT = -1
+
+
+def _copy_into(buffer: bytearray, data) -> int:
+    """
+    Copy data at the start of a preallocated buffer.
+
+    Returns
+    -------
+    int : the number of copied bytes.
+    """
+    length = min(len(data), len(buffer))
+    if length == len(data):
+        buffer[:length] = data
+    else:
+        buffer[:length] = memoryview(data)[:length]
+    return length
+
+
+def to_printable(data) -> str:
+    """ Decode a payload for the oled, falling back to hex. """
+    try:
+        return bytes(data).decode("utf-8")
+    except (UnicodeError, ValueError):
+        return hexlify(bytes(data)).decode()
+
+
+class MessageRing:
+    """
+    Ring buffer of the most recent messages.
+
+    Attributes
+    ----------
+    size : the number of messages kept.
+    count : the number of messages currently stored.
+    total : the number of messages added since the creation.
+    """
+    def __init__(
+        self,
+        size: int = 32,
+        topic_size: int = 48,
+        msg_size: int = 64
+    ) -> None:
+        self.size = size
+        self.count = 0
+        self.total = 0
+        self._topics = [bytearray(topic_size) for _ in range(size)]
+        self._msgs = [bytearray(msg_size) for _ in range(size)]
+        self._topic_lens = array("H", [0] * size)
+        self._msg_lens = array("H", [0] * size)
+        self._stamps = array("L", [0] * size)
+        self._next = 0
+
+    def add(self, topic, msg) -> None:
+        """ Store a message, overwriting the oldest one when full. """
+        slot = self._next
+        self._topic_lens[slot] = _copy_into(self._topics[slot], topic)
+        self._msg_lens[slot] = _copy_into(self._msgs[slot], msg)
+        self._stamps[slot] = ticks_ms()
+        self._next = (slot + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.total += 1
+
+    def entries(self) -> list:
+        """
+        Return the stored messages, the newest first.
+
+        Returns
+        -------
+        list : a list of (topic, msg, stamp_ms) tuples of bytes.
+        """
+        result = []
+        for i in range(1, self.count + 1):
+            slot = (self._next - i) % self.size
+            result.append((
+                bytes(self._topics[slot][:self._topic_lens[slot]]),
+                bytes(self._msgs[slot][:self._msg_lens[slot]]),
+                self._stamps[slot],
+            ))
+        return result
+
+
+class LastValueCache:
+    """
+    Last payload received on each topic, the least recently updated
+    topic is evicted when all the slots are in use.
+
+    Attributes
+    ----------
+    slots : the number of topics kept.
+    used : the number of slots in use.
+    evicted_count : the number of evicted topics.
+    """
+    def __init__(
+        self,
+        slots: int = 16,
+        topic_size: int = 48,
+        msg_size: int = 64
+    ) -> None:
+        self.slots = slots
+        self.used = 0
+        self.evicted_count = 0
+        self._index = {}
+        self._keys = [None] * slots
+        self._msgs = [bytearray(msg_size) for _ in range(slots)]
+        self._topics = [bytearray(topic_size) for _ in range(slots)]
+        self._topic_lens = array("H", [0] * slots)
+        self._msg_lens = array("H", [0] * slots)
+        self._stamps = array("L", [0] * slots)
+        self._counts = array("L", [0] * slots)
+        self._prev = array("h", [NO_SLOT] * slots)
+        self._next = array("h", [NO_SLOT] * slots)
+        self._head = NO_SLOT
+        self._tail = NO_SLOT
+
+    def _unlink(self, slot: int) -> None:
+        """ Remove a slot from the recency list. """
+        prev_slot = self._prev[slot]
+        next_slot = self._next[slot]
+        if prev_slot == NO_SLOT:
+            self._head = next_slot
+        else:
+            self._next[prev_slot] = next_slot
+        if next_slot == NO_SLOT:
+            self._tail = prev_slot
+        else:
+            self._prev[next_slot] = prev_slot
+
+    def _push_front(self, slot: int) -> None:
+        """ Make a slot the most recently updated. """
+        self._prev[slot] = NO_SLOT
+        self._next[slot] = self._head
+        if self._head != NO_SLOT:
+            self._prev[self._head] = slot
+        self._head = slot
+        if self._tail == NO_SLOT:
+            self._tail = slot
+
+    def _allocate_slot(self, topic: bytes) -> int:
+        """ Return a free slot, evicting the least recent topic if needed. """
+        if self.used < self.slots:
+            slot = self.used
+            self.used += 1
+        else:
+            slot = self._tail
+            self._unlink(slot)
+            del self._index[self._keys[slot]]
+            self.evicted_count += 1
+        self._keys[slot] = topic
+        self._index[topic] = slot
+        self._topic_lens[slot] = _copy_into(self._topics[slot], topic)
+        self._counts[slot] = 0
+        return slot
+
+    def add(self, topic: bytes, msg) -> None:
+        """ Update the last value of a topic. """
+        slot = self._index.get(topic)
+        if slot is None:
+            slot = self._allocate_slot(topic)
+        else:
+            self._unlink(slot)
+        self._push_front(slot)
+        self._msg_lens[slot] = _copy_into(self._msgs[slot], msg)
+        self._stamps[slot] = ticks_ms()
+        self._counts[slot] += 1
+
+    def entries(self) -> list:
+        """
+        Return the cached topics, the most recently updated first.
+
+        Returns
+        -------
+        list : a list of (topic, msg, stamp_ms, count) tuples.
+        """
+        result = []
+        slot = self._head
+        while slot != NO_SLOT:
+            result.append((
+                bytes(self._topics[slot][:self._topic_lens[slot]]),
+                bytes(self._msgs[slot][:self._msg_lens[slot]]),
+                self._stamps[slot],
+                self._counts[slot],
+            ))
+            slot = self._next[slot]
+        return result
+
+
+class MessageStore:
+    """
+    Last value cache plus ring buffer of the received messages.
+
+    Attributes
+    ----------
+    last_values : the LastValueCache.
+    recent : the MessageRing.
+    """
+    def __init__(
+        self,
+        cache_slots: int = 16,
+        ring_size: int = 32,
+        topic_size: int = 48,
+        msg_size: int = 64
+    ) -> None:
+        self.last_values = LastValueCache(cache_slots, topic_size, msg_size)
+        self.recent = MessageRing(ring_size, topic_size, msg_size)
+
+    def add(self, topic, msg) -> None:
+        """
+        Store a received message.
+
+        Parameters
+        ----------
+        topic : the topic, as bytes or str.
+        msg : the payload.
+        """
+        if isinstance(topic, str):
+            topic = topic.encode("utf-8")
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        self.last_values.add(topic, msg)
+        self.recent.add(topic, msg)
+
+    def last_values_lines(self) -> list:
+        """ Return the last value cache as oled lines. """
+        now = ticks_ms()
+        lines = []
+        for topic, msg, stamp, count in self.last_values.entries():
+            lines.append(to_printable(topic))
+            lines.append(
+                f" {to_printable(msg)} x{count} "
+                f"{ticks_diff(now, stamp) // 1000}s"
+            )
+        return lines
+
+    def recent_lines(self) -> list:
+        """ Return the ring buffer content as oled lines. """
+        now = ticks_ms()
+        lines = []
+        for topic, msg, stamp in self.recent.entries():
+            age = ticks_diff(now, stamp) // 1000
+            lines.append(f"{age}s {to_printable(topic)}")
+            lines.append(f" {to_printable(msg)}")
+        return lines
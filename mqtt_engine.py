@@ -0,0 +1,559 @@
+"""
+Asyncio based mqtt client.
+
+Every network operation is a coroutine so connect, publish, subscribe
+and receive run as cooperative tasks on the same event loop as the menu,
+a slow broker never freezes the encoder and button handling.
+
+With protocol_level set to PROTOCOL_LEVEL_5 the client speaks MQTT 5:
+it negotiates topic aliases with the broker, the first publish to a
+topic carries the topic and its alias and the following ones only the
+two bytes alias, and it reports the reason codes of the broker.
+
+With a TlsContext the connections are encrypted, the context is shared
+by the reconnections and each connection offers the TLS session of the
+previous one to the broker (see tls.py).
+"""
+import asyncio
+
+from device_logging import Logger
+from mqtt_protocol import (
+    CONNACK,
+    DISCONNECT,
+    PINGREQ_PACKET,
+    DISCONNECT_PACKET,
+    PROPERTY_REASON_STRING,
+    PROPERTY_SERVER_KEEP_ALIVE,
+    PROPERTY_SESSION_EXPIRY_INTERVAL,
+    PROPERTY_TOPIC_ALIAS,
+    PROPERTY_TOPIC_ALIAS_MAXIMUM,
+    PROTOCOL_LEVEL_3_1_1,
+    PROTOCOL_LEVEL_5,
+    PUBACK,
+    PUBLISH,
+    SUBACK,
+    UNSUBACK,
+    MqttProtocolError,
+    connect_packet,
+    encode_properties,
+    parse_ack_reason,
+    parse_connack,
+    parse_connack_properties,
+    parse_packet_id,
+    parse_properties,
+    parse_publish,
+    parse_suback,
+    publish_packet,
+    puback_packet,
+    reason_name,
+    subscribe_packet,
+    unsubscribe_packet,
+)
+from mqtt_outbox import PublishOutbox
+from timing import ticks_diff, ticks_ms
+
+CONNECT_TIMEOUT_MS = 5000
+SUBACK_TIMEOUT_MS = 5000
+
+
+class AsyncMqttClient:
+    """
+    Non blocking mqtt 3.1.1 and mqtt 5 client running on the asyncio
+    event loop.
+
+    Attributes
+    ----------
+    client_id : the mqtt client identifier.
+    server : the broker address.
+    port : the broker port.
+    keepalive : the keepalive interval in seconds.
+    on_message : the callback called as on_message(topic, msg) for every
+    received publish, topic and msg are bytes like with umqtt.
+    on_sent : the callback called as on_sent(topic, msg) for every
+    publish sent by publish or by the outbox, retransmissions excluded.
+    subscriptions : a dict containing the subscribed topics and their qos.
+    sent_count : the number of publish packets sent.
+    received_count : the number of publish packets received.
+    last_rx_ms : the ticks_ms of the last packet received from the broker.
+    last_tx_ms : the ticks_ms of the last packet sent to the broker.
+    rx_packets : the number of packets of any type received.
+    outbox : the PublishOutbox handling the qos 1 publications.
+    protocol_level : PROTOCOL_LEVEL_3_1_1 or PROTOCOL_LEVEL_5.
+    session_expiry : the mqtt 5 session expiry interval in seconds,
+    0 ends the session with the connection.
+    topic_alias_maximum : the number of topic aliases accepted by the
+    broker on the current connection, 0 disables the aliases.
+    alias_count : the number of publish sent with an alias only.
+    last_reason : the last failure reason code reported by the broker.
+    clean_session : the clean session (clean start in mqtt 5) flag of
+    the connections, False to resume the session kept by the broker.
+    session_present : the session present flag of the last CONNACK.
+    tls : the TlsContext of the connections, None for plain tcp.
+    connect_ms : the time spent opening the last connection, tcp and tls
+    handshakes included.
+    """
+    def __init__(
+        self,
+        client_id: str,
+        server: str,
+        port: int = 1883,
+        keepalive: int = 0,
+        on_message=None,
+        protocol_level: int = PROTOCOL_LEVEL_3_1_1,
+        session_expiry: int = 0,
+        tls=None
+    ) -> None:
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.on_message = on_message
+        self.on_sent = None
+        self.subscriptions = {}
+        self.sent_count = 0
+        self.received_count = 0
+        self.last_rx_ms = 0
+        self.last_tx_ms = 0
+        self.rx_packets = 0
+        self.logger = Logger("MQTT_ENGINE")
+        self.outbox = PublishOutbox(self)
+        self.protocol_level = protocol_level
+        self.session_expiry = session_expiry
+        self.topic_alias_maximum = 0
+        self.alias_count = 0
+        self.last_reason = 0
+        self.clean_session = True
+        self.session_present = False
+        self.tls = tls
+        self.connect_ms = 0
+        self._topic_aliases = {}
+        self._suback_codes = {}
+        self._reader = None
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._receive_task = None
+        self._outbox_task = None
+        self._pending_acks = {}
+        self._last_pid = 0
+        self._connected = False
+
+    def isconnected(self) -> bool:
+        """ Return True if the session with the broker is up. """
+        return self._connected
+
+    def next_packet_id(self) -> int:
+        """ Return the next packet identifier, in the 1..65535 range. """
+        self._last_pid = self._last_pid % 0xFFFF + 1
+        return self._last_pid
+
+    def session_state(self) -> dict:
+        """
+        Return the client side state of the session.
+
+        Returns
+        -------
+        dict : a dictionary built as follows:
+            "last_pid" : the last packet identifier used.
+            "subscriptions" : the subscribed topics and their qos.
+            "in_flight" : the (pid, topic, msg, retain) of the messages
+            waiting for a PUBACK.
+            "queued" : the (topic, msg, retain) of the messages not sent.
+        """
+        in_flight, queued = self.outbox.snapshot()
+        return {
+            "last_pid": self._last_pid,
+            "subscriptions": dict(self.subscriptions),
+            "in_flight": in_flight,
+            "queued": queued,
+        }
+
+    def restore_session(self, state: dict) -> None:
+        """
+        Reload a state returned by session_state, before connecting.
+
+        Parameters
+        ----------
+        state : the dictionary returned by session_state.
+        """
+        self._last_pid = state["last_pid"]
+        self.subscriptions.update(state["subscriptions"])
+        self.outbox.restore(state["in_flight"], state["queued"])
+
+    async def connect(
+        self,
+        clean_session: bool = None,
+        timeout_ms: int = CONNECT_TIMEOUT_MS
+    ) -> bool:
+        """
+        Open the connection and perform the mqtt handshake.
+
+        Parameters
+        ----------
+        clean_session : if False the broker resumes the previous session,
+        the clean_session attribute is used if None.
+        timeout_ms : the maximum time to wait for the CONNACK.
+
+        Returns
+        -------
+        bool : the session present flag returned by the broker.
+        """
+        if clean_session is None:
+            clean_session = self.clean_session
+        options = {}
+        if self.tls is not None:
+            options = self.tls.connection_options(self.server)
+        started_at = ticks_ms()
+        self._reader, self._writer = await asyncio.open_connection(
+            self.server, self.port, **options
+        )
+        self.connect_ms = ticks_diff(ticks_ms(), started_at)
+        if self.tls is not None:
+            self.tls.handshake_done(self._writer, self.connect_ms)
+        properties = None
+        if self.protocol_level == PROTOCOL_LEVEL_5:
+            properties = encode_properties(
+                [(PROPERTY_SESSION_EXPIRY_INTERVAL, self.session_expiry)]
+                if self.session_expiry else []
+            )
+        await self._send(
+            connect_packet(
+                self.client_id,
+                self.keepalive,
+                clean_session,
+                properties=properties
+            )
+        )
+        try:
+            first_byte, body = await asyncio.wait_for(
+                self._read_packet(), timeout_ms / 1000
+            )
+        except asyncio.TimeoutError as e:
+            self.close()
+            raise OSError("CONNACK timeout") from e
+        if first_byte != CONNACK:
+            self.close()
+            raise MqttProtocolError(f"expected CONNACK, got {first_byte}")
+        session_present, return_code = parse_connack(body)
+        if return_code:
+            self.close()
+            self.last_reason = return_code
+            raise MqttProtocolError(
+                f"connection refused: {reason_name(return_code)}"
+            )
+        # the aliases are only valid on the connection they were set on
+        self._topic_aliases = {}
+        self.topic_alias_maximum = 0
+        if self.protocol_level == PROTOCOL_LEVEL_5:
+            self._apply_connack_properties(parse_connack_properties(body))
+        self.session_present = session_present
+        if self.tls is not None:
+            # the session tickets of TLS 1.3 come after the handshake
+            self.tls.remember_session(self._writer)
+        self._connected = True
+        self._receive_task = asyncio.create_task(self._receive_loop())
+        self.outbox.reset_timers()
+        self._outbox_task = asyncio.create_task(self.outbox.run())
+        self.logger.info(f"connected to {self.server}:{self.port}")
+        return session_present
+
+    def _apply_connack_properties(self, properties: dict) -> None:
+        """ Use the limits announced by the broker in its CONNACK. """
+        self.topic_alias_maximum = properties.get(
+            PROPERTY_TOPIC_ALIAS_MAXIMUM, 0
+        )
+        if PROPERTY_SERVER_KEEP_ALIVE in properties:
+            self.keepalive = properties[PROPERTY_SERVER_KEEP_ALIVE]
+        if PROPERTY_SESSION_EXPIRY_INTERVAL in properties:
+            self.session_expiry = properties[
+                PROPERTY_SESSION_EXPIRY_INTERVAL
+            ]
+
+    def publish_frame(
+        self,
+        topic,
+        msg,
+        qos: int = 0,
+        retain: bool = False,
+        pid: int = 0,
+        dup: bool = False
+    ) -> bytes:
+        """
+        Build the PUBLISH packet of a message for the current connection,
+        with mqtt 5 the known topics are replaced by their alias.
+
+        Parameters
+        ----------
+        topic : the topic to publish to.
+        msg : the message to publish.
+        qos : the quality of service, 0 or 1.
+        retain : the retain flag.
+        pid : the packet identifier, only used when qos > 0.
+        dup : the duplicate delivery flag, set on retransmissions.
+        """
+        if self.protocol_level != PROTOCOL_LEVEL_5:
+            return publish_packet(topic, msg, qos, retain, pid, dup)
+        alias = self._topic_aliases.get(topic)
+        if alias is not None:
+            self.alias_count += 1
+            return publish_packet(
+                b"",
+                msg,
+                qos,
+                retain,
+                pid,
+                dup,
+                encode_properties([(PROPERTY_TOPIC_ALIAS, alias)])
+            )
+        properties = b"\x00"
+        if len(self._topic_aliases) < self.topic_alias_maximum:
+            alias = len(self._topic_aliases) + 1
+            self._topic_aliases[topic] = alias
+            properties = encode_properties([(PROPERTY_TOPIC_ALIAS, alias)])
+        return publish_packet(topic, msg, qos, retain, pid, dup, properties)
+
+    async def disconnect(self) -> None:
+        """ Gracefully close the session with the broker. """
+        if self._connected:
+            try:
+                await self._send(DISCONNECT_PACKET)
+            except OSError:
+                pass
+        self.close()
+
+    def close(self) -> None:
+        """ Drop the connection without notifying the broker. """
+        self._connected = False
+        for task in (self._receive_task, self._outbox_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._receive_task = None
+        self._outbox_task = None
+        for event in self._pending_acks.values():
+            event.set()
+        self._pending_acks = {}
+        if self._writer is not None:
+            if self.tls is not None:
+                self.tls.remember_session(self._writer)
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+            self._writer = None
+        self._reader = None
+
+    async def publish(
+        self,
+        topic,
+        msg,
+        retain: bool = False,
+        qos: int = 0
+    ) -> None:
+        """
+        Publish a message to a topic.
+        The qos 1 messages are queued in the outbox, which can accept
+        them even while the connection is down.
+
+        Parameters
+        ----------
+        topic : the topic to publish to.
+        msg : the message to publish.
+        retain : the retain flag.
+        qos : the quality of service, 0 or 1.
+        """
+        if qos:
+            if not self.outbox.put(topic, msg, retain):
+                raise OSError("outbox full")
+            return
+        await self._send(self.publish_frame(topic, msg, qos, retain))
+        self.sent_count += 1
+        if self.on_sent is not None:
+            self.on_sent(topic, msg)
+
+    async def subscribe(
+        self,
+        topic,
+        qos: int = 0,
+        timeout_ms: int = SUBACK_TIMEOUT_MS
+    ) -> None:
+        """
+        Subscribe to a topic and wait for the SUBACK.
+
+        Parameters
+        ----------
+        topic : the topic filter to subscribe to.
+        qos : the maximum qos requested for the subscription.
+        timeout_ms : the maximum time to wait for the SUBACK.
+        """
+        pid = self.next_packet_id()
+        event = asyncio.Event()
+        try:
+            # registered in the try so a failed send does not leak it
+            self._pending_acks[pid] = event
+            await self._send(
+                subscribe_packet(
+                    pid, topic, qos, self.protocol_level == PROTOCOL_LEVEL_5
+                )
+            )
+            await asyncio.wait_for(event.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError as e:
+            raise OSError(f"SUBACK timeout for {topic}") from e
+        finally:
+            self._pending_acks.pop(pid, None)
+            code = self._suback_codes.pop(pid, 0)
+        if not self._connected:
+            raise OSError(f"connection lost subscribing to {topic}")
+        if code >= 0x80:
+            self.last_reason = code
+            raise OSError(
+                f"subscription to {topic} refused: {reason_name(code)}"
+            )
+        self.subscriptions[topic] = qos
+
+    async def unsubscribe(
+        self,
+        topic,
+        timeout_ms: int = SUBACK_TIMEOUT_MS
+    ) -> None:
+        """
+        Unsubscribe from a topic and wait for the UNSUBACK.
+
+        Parameters
+        ----------
+        topic : the topic filter to unsubscribe from.
+        timeout_ms : the maximum time to wait for the UNSUBACK.
+        """
+        self.subscriptions.pop(topic, None)
+        pid = self.next_packet_id()
+        event = asyncio.Event()
+        try:
+            self._pending_acks[pid] = event
+            await self._send(
+                unsubscribe_packet(
+                    pid, topic, self.protocol_level == PROTOCOL_LEVEL_5
+                )
+            )
+            await asyncio.wait_for(event.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError as e:
+            raise OSError(f"UNSUBACK timeout for {topic}") from e
+        finally:
+            self._pending_acks.pop(pid, None)
+
+    async def ping(self) -> None:
+        """ Send a PINGREQ to the broker. """
+        await self._send(PINGREQ_PACKET)
+
+    async def write_raw(self, packet) -> None:
+        """
+        Write an already encoded packet to the socket.
+
+        Parameters
+        ----------
+        packet : the bytes of a complete mqtt packet.
+        """
+        await self._send(packet)
+
+    async def _send(self, packet) -> None:
+        """ Write a packet, serializing the writers of concurrent tasks. """
+        if self._writer is None:
+            raise OSError("not connected")
+        async with self._write_lock:
+            try:
+                self._writer.write(packet)
+                await self._writer.drain()
+                self.last_tx_ms = ticks_ms()
+            except OSError:
+                self.close()
+                raise
+
+    async def _read_packet(self) -> tuple:
+        """
+        Read a whole packet from the socket.
+
+        Returns
+        -------
+        tuple : (first_byte, body) of the packet.
+        """
+        first_byte = (await self._reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            digit = (await self._reader.readexactly(1))[0]
+            length |= (digit & 0x7F) << shift
+            if not digit & 0x80:
+                break
+            shift += 7
+            if shift > 21:
+                raise MqttProtocolError("malformed remaining length")
+        body = await self._reader.readexactly(length) if length else b""
+        self.last_rx_ms = ticks_ms()
+        self.rx_packets += 1
+        return first_byte, body
+
+    async def _receive_loop(self) -> None:
+        """ Read and dispatch the incoming packets until disconnection. """
+        try:
+            while self._connected:
+                first_byte, body = await self._read_packet()
+                await self._handle_packet(first_byte, body)
+        except (OSError, EOFError, MqttProtocolError) as e:
+            if self._connected:
+                self.logger.error(f"connection lost: {e}")
+        finally:
+            self.close()
+
+    async def _handle_packet(self, first_byte: int, body: bytes) -> None:
+        """
+        Dispatch a received packet.
+
+        Parameters
+        ----------
+        first_byte : the first byte of the fixed header.
+        body : the bytes following the fixed header.
+        """
+        packet_type = first_byte & 0xF0
+        v5 = self.protocol_level == PROTOCOL_LEVEL_5
+        if packet_type == PUBLISH:
+            topic, msg, qos, pid = parse_publish(first_byte, body, v5)
+            if qos:
+                await self._send(puback_packet(pid))
+            self.received_count += 1
+            if self.on_message is not None:
+                try:
+                    self.on_message(topic, msg)
+                except Exception as e:
+                    self.logger.error(f"message callback failed: {e}")
+        elif packet_type == PUBACK:
+            pid = parse_packet_id(body)
+            code = parse_ack_reason(body) if v5 else 0
+            if code >= 0x80:
+                self.last_reason = code
+                self.logger.warning(
+                    f"publish {pid} refused: {reason_name(code)}"
+                )
+            self.outbox.ack(pid)
+        elif packet_type == SUBACK:
+            pid, code = parse_suback(body, v5)
+            event = self._pending_acks.get(pid)
+            if event is not None:
+                self._suback_codes[pid] = code
+                event.set()
+        elif packet_type == UNSUBACK:
+            event = self._pending_acks.get(parse_packet_id(body))
+            if event is not None:
+                event.set()
+        elif packet_type == DISCONNECT and v5:
+            self._handle_disconnect(body)
+
+    def _handle_disconnect(self, body: bytes) -> None:
+        """ Log the reason of a disconnection requested by the broker. """
+        code = body[0] if body else 0
+        self.last_reason = code
+        message = reason_name(code)
+        if len(body) > 1:
+            properties = parse_properties(body, 1)[0]
+            if PROPERTY_REASON_STRING in properties:
+                message += ", " + str(
+                    properties[PROPERTY_REASON_STRING], "utf-8"
+                )
+        self.logger.warning(f"disconnected by the broker: {message}")
+        self.close()
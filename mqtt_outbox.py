@@ -0,0 +1,247 @@
+"""
+QoS 1 publish outbox.
+
+Messages are queued and pushed to the broker by a single task which keeps
+up to `window` of them in flight at once, each PUBACK frees a slot, so the
+throughput is no longer bound to one round trip per message.
+"""
+import asyncio
+from collections import deque
+
+from timing import ticks_add, ticks_diff, ticks_ms
+
+RETRY_CHECK_INTERVAL_MS = 500
+RATE_WINDOW_MS = 1000
+
+
+class PublishOutbox:
+    """
+    Queue of the qos 1 messages waiting to be sent or acknowledged.
+
+    Attributes
+    ----------
+    client : the AsyncMqttClient used to send the messages.
+    window : the maximum number of messages waiting for a PUBACK.
+    retry_ms : the time after which an unacknowledged message is resent.
+    in_flight : a dict containing the packet ids of the messages waiting
+    for a PUBACK and, for each of them, [topic, msg, retain, sent_ms].
+    queued_count : the number of messages accepted by the outbox.
+    sent_count : the number of publish packets sent, retries excluded.
+    acked_count : the number of PUBACK received.
+    retry_count : the number of retransmissions.
+    dropped_count : the number of messages refused because of a full queue.
+    throughput : the acknowledged messages per second over the last second.
+    """
+    def __init__(
+        self,
+        client,
+        window: int = 16,
+        retry_ms: int = 5000,
+        max_queued: int = 64
+    ) -> None:
+        self.client = client
+        self.window = window
+        self.retry_ms = retry_ms
+        self.max_queued = max_queued
+        self.in_flight = {}
+        self.queued_count = 0
+        self.sent_count = 0
+        self.acked_count = 0
+        self.retry_count = 0
+        self.dropped_count = 0
+        self.throughput = 0
+        self._queue = deque((), max_queued)
+        self._wakeup = asyncio.Event()
+        self._rate_start_ms = ticks_ms()
+        self._rate_acked = 0
+
+    def pending_count(self) -> int:
+        """ Return the number of messages not acknowledged yet. """
+        return len(self._queue) + len(self.in_flight)
+
+    def put(self, topic, msg, retain: bool = False) -> bool:
+        """
+        Queue a message.
+
+        Parameters
+        ----------
+        topic : the topic to publish to.
+        msg : the message to publish.
+        retain : the retain flag.
+
+        Returns
+        -------
+        bool : False if the queue is full and the message has been dropped.
+        """
+        if len(self._queue) >= self.max_queued:
+            self.dropped_count += 1
+            return False
+        self._queue.append((topic, msg, retain))
+        self.queued_count += 1
+        self._wakeup.set()
+        return True
+
+    def ack(self, pid: int) -> None:
+        """
+        Release the in flight slot of an acknowledged message.
+
+        Parameters
+        ----------
+        pid : the packet id carried by the PUBACK.
+        """
+        if self.in_flight.pop(pid, None) is None:
+            return
+        self.acked_count += 1
+        self._wakeup.set()
+
+    def holds(self, messages: set) -> bool:
+        """
+        Return True while one of the messages is queued or in flight.
+
+        Parameters
+        ----------
+        messages : a set of (id(topic), id(msg)) of the messages, the
+        very objects given to put.
+        """
+        for entry in self.in_flight.values():
+            if (id(entry[0]), id(entry[1])) in messages:
+                return True
+        for topic, msg, _ in self._queue:
+            if (id(topic), id(msg)) in messages:
+                return True
+        return False
+
+    def discard(self, messages: set) -> int:
+        """
+        Remove the messages from the queue and from the in flight ones,
+        their PUBACK is then ignored.
+
+        Parameters
+        ----------
+        messages : a set of (id(topic), id(msg)), see holds.
+
+        Returns
+        -------
+        int : the number of removed messages.
+        """
+        removed = 0
+        for pid, entry in list(self.in_flight.items()):
+            if (id(entry[0]), id(entry[1])) in messages:
+                del self.in_flight[pid]
+                removed += 1
+        for _ in range(len(self._queue)):
+            entry = self._queue.popleft()
+            if (id(entry[0]), id(entry[1])) in messages:
+                removed += 1
+            else:
+                self._queue.append(entry)
+        self._wakeup.set()
+        return removed
+
+    def snapshot(self) -> tuple:
+        """
+        Return the messages of the outbox, to persist the session.
+
+        Returns
+        -------
+        tuple : (in_flight, queued), in_flight is a list of
+        (pid, topic, msg, retain) and queued of (topic, msg, retain).
+        """
+        in_flight = [
+            (pid, entry[0], entry[1], entry[2])
+            for pid, entry in self.in_flight.items()
+        ]
+        return in_flight, list(self._queue)
+
+    def restore(self, in_flight: list, queued: list) -> None:
+        """
+        Reload the messages returned by snapshot, the in flight ones are
+        resent with the DUP flag once the client is connected.
+
+        Parameters
+        ----------
+        in_flight : a list of (pid, topic, msg, retain).
+        queued : a list of (topic, msg, retain).
+        """
+        now = ticks_ms()
+        for pid, topic, msg, retain in in_flight:
+            self.in_flight[pid] = [topic, msg, retain, now]
+        for topic, msg, retain in queued:
+            self.put(topic, msg, retain)
+
+    def reset_timers(self) -> None:
+        """
+        Mark every in flight message as expired, called after a reconnect
+        so they are resent at once with the DUP flag.
+        """
+        now = ticks_ms()
+        for entry in self.in_flight.values():
+            entry[3] = ticks_add(now, -self.retry_ms - 1)
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """
+        Send the queued messages while the client is connected, the
+        messages in flight when the connection drops are kept and resent
+        after the next reconnect.
+        """
+        while self.client.isconnected():
+            self._wakeup.clear()
+            try:
+                await self._fill_window()
+                await self._retransmit_expired()
+            except OSError:
+                return
+            self._update_throughput()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), RETRY_CHECK_INTERVAL_MS / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_free_packet_id(self) -> int:
+        """ Return a packet id not used by a message in flight. """
+        pid = self.client.next_packet_id()
+        while pid in self.in_flight:
+            pid = self.client.next_packet_id()
+        return pid
+
+    async def _fill_window(self) -> None:
+        """ Send queued messages until the in flight window is full. """
+        while self._queue and len(self.in_flight) < self.window:
+            topic, msg, retain = self._queue.popleft()
+            pid = self._next_free_packet_id()
+            self.in_flight[pid] = [topic, msg, retain, ticks_ms()]
+            await self.client.write_raw(
+                self.client.publish_frame(topic, msg, 1, retain, pid)
+            )
+            self.sent_count += 1
+            if self.client.on_sent is not None:
+                self.client.on_sent(topic, msg)
+
+    async def _retransmit_expired(self) -> None:
+        """ Resend the messages whose PUBACK is overdue. """
+        now = ticks_ms()
+        for pid in list(self.in_flight):
+            entry = self.in_flight.get(pid)
+            if entry is None or ticks_diff(now, entry[3]) < self.retry_ms:
+                continue
+            entry[3] = now
+            await self.client.write_raw(
+                self.client.publish_frame(
+                    entry[0], entry[1], 1, entry[2], pid, True
+                )
+            )
+            self.retry_count += 1
+
+    def _update_throughput(self) -> None:
+        """ Refresh the acknowledged messages per second measure. """
+        elapsed = ticks_diff(ticks_ms(), self._rate_start_ms)
+        if elapsed < RATE_WINDOW_MS:
+            return
+        self.throughput = (
+            (self.acked_count - self._rate_acked) * 1000 // elapsed
+        )
+        self._rate_start_ms = ticks_ms()
+        self._rate_acked = self.acked_count
@@ -0,0 +1,207 @@
+"""
+Named pool of mqtt broker sessions.
+
+Every broker of the pool keeps its own AsyncMqttClient and supervisor,
+several sessions stay open at the same time so switching broker or
+publishing to another one does not cost a new handshake. The sessions
+left unused longer than the idle timeout are closed by a reaper task and
+reopened on their next use.
+"""
+import asyncio
+
+from device_logging import Logger
+from timing import sleep_ms, ticks_diff, ticks_ms
+
+DEFAULT_BROKER = "default"
+MIN_REAPER_INTERVAL_MS = 1000
+
+
+class BrokerSession:
+    """
+    A broker of the pool.
+
+    Attributes
+    ----------
+    name : the broker name, e.g. "lab".
+    client : the AsyncMqttClient of the broker.
+    supervisor : the ConnectionSupervisor keeping the client connected.
+    prefixes : the topic prefixes routed to this broker.
+    last_used_ms : the ticks_ms of the last use of the session.
+    """
+    def __init__(
+        self,
+        name: str,
+        client,
+        supervisor,
+        prefixes: list | tuple = ()
+    ) -> None:
+        self.name = name
+        self.client = client
+        self.supervisor = supervisor
+        self.prefixes = list(prefixes)
+        self.last_used_ms = ticks_ms()
+        self._received_seen = 0
+
+    def is_open(self) -> bool:
+        """ Return True if the session is supervised (open or opening). """
+        return self.supervisor.is_running()
+
+    def touch(self) -> None:
+        """ Mark the session as used now. """
+        self.last_used_ms = ticks_ms()
+
+    def idle_ms(self, now: int) -> int:
+        """
+        Return the time since the last use, a received message counts
+        as a use of the session.
+        """
+        if self.client.received_count != self._received_seen:
+            self._received_seen = self.client.received_count
+            self.last_used_ms = now
+        return ticks_diff(now, self.last_used_ms)
+
+
+class BrokerPool:
+    """
+    The open broker sessions, indexed by name and by topic prefix.
+
+    Attributes
+    ----------
+    sessions : a dict containing the BrokerSession of each broker name.
+    current : the name of the broker used by default.
+    idle_timeout_ms : the unused time after which a session is closed,
+    the current broker is never closed, 0 disables the reaper.
+    opened_count : the number of sessions opened.
+    reaped_count : the number of sessions closed for inactivity.
+    """
+    def __init__(self, idle_timeout_ms: int = 300000) -> None:
+        self.sessions = {}
+        self.current = None
+        self.idle_timeout_ms = idle_timeout_ms
+        self.opened_count = 0
+        self.reaped_count = 0
+        self.logger = Logger("MQTT_POOL")
+        self._routes = []
+        self._reaper_task = None
+
+    def add(self, session: BrokerSession) -> None:
+        """
+        Add a broker to the pool, replacing the broker with the same name.
+
+        Parameters
+        ----------
+        session : the BrokerSession of the broker, it is not opened.
+        """
+        previous = self.sessions.get(session.name)
+        if previous is not None:
+            previous.supervisor.stop()
+            previous.client.close()
+        self.sessions[session.name] = session
+        if self.current is None:
+            self.current = session.name
+        self._build_routes()
+
+    def _build_routes(self) -> None:
+        """ Sort the topic prefixes, the longest first. """
+        routes = []
+        for session in self.sessions.values():
+            for prefix in session.prefixes:
+                routes.append((prefix, session))
+        routes.sort(key=lambda route: len(route[0]), reverse=True)
+        self._routes = routes
+
+    def get(self, name: str) -> BrokerSession:
+        """ Return the session of a broker, ValueError if unknown. """
+        session = self.sessions.get(name)
+        if session is None:
+            raise ValueError(f"unknown broker {name}")
+        return session
+
+    def route(self, topic, broker: str = None) -> BrokerSession:
+        """
+        Return the session a message must be published to.
+
+        Parameters
+        ----------
+        topic : the topic of the message, as str or bytes.
+        broker : the broker name, if None the broker is chosen by the
+        longest matching topic prefix, falling back to the current one.
+        """
+        if broker is not None:
+            return self.get(broker)
+        if not isinstance(topic, str):
+            topic = topic.decode("utf-8")
+        for prefix, session in self._routes:
+            if topic.startswith(prefix):
+                return session
+        return self.get(self.current)
+
+    def acquire(self, name: str) -> BrokerSession:
+        """
+        Return the session of a broker, opening it if it was closed.
+
+        Parameters
+        ----------
+        name : the broker name.
+        """
+        session = self.get(name)
+        session.touch()
+        if not session.is_open():
+            session.supervisor.start()
+            self.opened_count += 1
+            self.logger.info(f"opening broker {name}")
+        if self._reaper_task is None and self.idle_timeout_ms:
+            self._reaper_task = asyncio.create_task(self._reap_idle())
+        return session
+
+    def switch(self, name: str) -> BrokerSession:
+        """
+        Make a broker the current one, opening it if needed.
+
+        Parameters
+        ----------
+        name : the broker name.
+        """
+        session = self.acquire(name)
+        self.current = name
+        return session
+
+    async def close(self, name: str) -> None:
+        """
+        Close the session of a broker, it is reopened on the next use.
+
+        Parameters
+        ----------
+        name : the broker name.
+        """
+        session = self.get(name)
+        session.supervisor.stop()
+        await session.client.disconnect()
+        self.logger.info(f"broker {name} closed")
+
+    async def _reap_idle(self) -> None:
+        """ Close the sessions unused for longer than the idle timeout. """
+        interval_ms = max(self.idle_timeout_ms // 4, MIN_REAPER_INTERVAL_MS)
+        while True:
+            await sleep_ms(interval_ms)
+            now = ticks_ms()
+            for name, session in list(self.sessions.items()):
+                if name == self.current or not session.is_open():
+                    continue
+                if session.idle_ms(now) >= self.idle_timeout_ms:
+                    self.reaped_count += 1
+                    await self.close(name)
+
+    def status_lines(self) -> list:
+        """ Return the state of each broker as oled lines. """
+        lines = []
+        for name, session in self.sessions.items():
+            if session.client.isconnected():
+                state = "up"
+            elif session.is_open():
+                state = "conn"
+            else:
+                state = "idle"
+            marker = "*" if name == self.current else " "
+            lines.append(f"{marker}{name} {state}")
+        return lines
@@ -0,0 +1,472 @@
+"""
+Encode and decode MQTT 3.1.1 and MQTT 5 control packets.
+
+This module is transport agnostic: it only builds and parses bytes,
+the socket handling lives in the mqtt_engine module. The MQTT 5 packets
+carry a properties block, the builders add it when they are given
+properties (b"" for an empty block) and the parsers skip or return it
+when called with v5=True.
+"""
+import struct
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA2
+UNSUBACK = 0xB0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+PINGREQ_PACKET = b"\xc0\x00"
+PINGRESP_PACKET = b"\xd0\x00"
+DISCONNECT_PACKET = b"\xe0\x00"
+
+PROTOCOL_LEVEL_3_1_1 = 4
+PROTOCOL_LEVEL_5 = 5
+
+PROPERTY_SESSION_EXPIRY_INTERVAL = 0x11
+PROPERTY_ASSIGNED_CLIENT_ID = 0x12
+PROPERTY_SERVER_KEEP_ALIVE = 0x13
+PROPERTY_REASON_STRING = 0x1F
+PROPERTY_RECEIVE_MAXIMUM = 0x21
+PROPERTY_TOPIC_ALIAS_MAXIMUM = 0x22
+PROPERTY_TOPIC_ALIAS = 0x23
+PROPERTY_MAXIMUM_QOS = 0x24
+PROPERTY_RETAIN_AVAILABLE = 0x25
+PROPERTY_MAXIMUM_PACKET_SIZE = 0x27
+
+# the wire type of every property: 1, 2 or 4 byte integer, variable
+# byte integer, utf-8 string, binary data or utf-8 string pair
+PROPERTY_TYPES = {
+    0x01: "byte",
+    0x02: "int4",
+    0x03: "string",
+    0x08: "string",
+    0x09: "binary",
+    0x0B: "varint",
+    0x11: "int4",
+    0x12: "string",
+    0x13: "int2",
+    0x15: "string",
+    0x16: "binary",
+    0x17: "byte",
+    0x18: "int4",
+    0x19: "byte",
+    0x1A: "string",
+    0x1C: "string",
+    0x1F: "string",
+    0x21: "int2",
+    0x22: "int2",
+    0x23: "int2",
+    0x24: "byte",
+    0x25: "byte",
+    0x26: "pair",
+    0x27: "int4",
+    0x28: "byte",
+    0x29: "byte",
+    0x2A: "byte",
+}
+
+REASON_NAMES = {
+    0x00: "success",
+    0x04: "disconnect with will",
+    0x80: "unspecified error",
+    0x81: "malformed packet",
+    0x82: "protocol error",
+    0x83: "implementation error",
+    0x84: "unsupported version",
+    0x85: "bad client id",
+    0x86: "bad credentials",
+    0x87: "not authorized",
+    0x88: "server unavailable",
+    0x89: "server busy",
+    0x8A: "banned",
+    0x8B: "server shutting down",
+    0x8D: "keepalive timeout",
+    0x8E: "session taken over",
+    0x8F: "topic filter invalid",
+    0x90: "topic name invalid",
+    0x93: "receive max exceeded",
+    0x94: "topic alias invalid",
+    0x95: "packet too large",
+    0x96: "rate too high",
+    0x97: "quota exceeded",
+    0x99: "payload format invalid",
+    0x9A: "retain unsupported",
+    0x9B: "qos unsupported",
+    0x9C: "use another server",
+    0x9D: "server moved",
+    0x9E: "shared subs unsupported",
+    0x9F: "connection rate exceeded",
+    0xA2: "wildcards unsupported",
+}
+
+
+class MqttProtocolError(Exception):
+    """ Raised when the peer sends a malformed or unexpected packet. """
+
+
+def to_bytes(value) -> bytes:
+    """
+    Return value as bytes, encoding it as utf-8 if it is a string.
+
+    Parameters
+    ----------
+    value : a str, bytes or bytearray.
+    """
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return bytes(value)
+
+
+def encode_remaining_length(length: int) -> bytes:
+    """
+    Encode the remaining length field of the fixed header.
+
+    Parameters
+    ----------
+    length : the number of bytes following the fixed header.
+
+    Returns
+    -------
+    bytes : the variable length encoding (1 to 4 bytes).
+    """
+    encoded = bytearray()
+    while True:
+        digit = length & 0x7F
+        length >>= 7
+        if length:
+            digit |= 0x80
+        encoded.append(digit)
+        if not length:
+            return bytes(encoded)
+
+
+def decode_variable_int(body, offset: int) -> tuple:
+    """
+    Decode a variable byte integer.
+
+    Returns
+    -------
+    tuple : (value, offset after the integer).
+    """
+    value = 0
+    shift = 0
+    while True:
+        digit = body[offset]
+        offset += 1
+        value |= (digit & 0x7F) << shift
+        if not digit & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 21:
+            raise MqttProtocolError("malformed variable byte integer")
+
+
+def reason_name(code: int) -> str:
+    """ Return a short description of a reason or return code. """
+    return REASON_NAMES.get(code, f"reason {code:#04x}")
+
+
+def encode_properties(properties: list) -> bytes:
+    """
+    Encode an MQTT 5 properties block.
+
+    Parameters
+    ----------
+    properties : a list of (identifier, value) tuples, a pair value is
+    a (name, value) tuple.
+
+    Returns
+    -------
+    bytes : the properties length followed by the properties.
+    """
+    encoded = bytearray()
+    for identifier, value in properties:
+        encoded.append(identifier)
+        kind = PROPERTY_TYPES[identifier]
+        if kind == "byte":
+            encoded.append(value)
+        elif kind == "int2":
+            encoded += struct.pack("!H", value)
+        elif kind == "int4":
+            encoded += struct.pack("!I", value)
+        elif kind == "varint":
+            encoded += encode_remaining_length(value)
+        elif kind == "pair":
+            encoded += encode_string(value[0]) + encode_string(value[1])
+        else:
+            encoded += encode_string(value)
+    return encode_remaining_length(len(encoded)) + encoded
+
+
+def parse_properties(body, offset: int) -> tuple:
+    """
+    Parse an MQTT 5 properties block.
+
+    Parameters
+    ----------
+    body : the packet body.
+    offset : the offset of the properties length.
+
+    Returns
+    -------
+    tuple : (properties, offset after the block), properties is a dict
+    of identifier to value, strings and binary data are bytes.
+    """
+    length, offset = decode_variable_int(body, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        identifier = body[offset]
+        offset += 1
+        kind = PROPERTY_TYPES.get(identifier)
+        if kind is None:
+            raise MqttProtocolError(f"unknown property {identifier}")
+        if kind == "byte":
+            value = body[offset]
+            offset += 1
+        elif kind == "int2":
+            value = (body[offset] << 8) | body[offset + 1]
+            offset += 2
+        elif kind == "int4":
+            value = struct.unpack_from("!I", body, offset)[0]
+            offset += 4
+        elif kind == "varint":
+            value, offset = decode_variable_int(body, offset)
+        else:
+            value, offset = _parse_string(body, offset)
+            if kind == "pair":
+                pair_value, offset = _parse_string(body, offset)
+                value = (value, pair_value)
+        properties[identifier] = value
+    return properties, end
+
+
+def _parse_string(body, offset: int) -> tuple:
+    """ Return a length prefixed string as bytes and the next offset. """
+    length = (body[offset] << 8) | body[offset + 1]
+    offset += 2
+    return bytes(body[offset:offset + length]), offset + length
+
+
+def encode_string(value) -> bytes:
+    """ Encode a length prefixed utf-8 string. """
+    value = to_bytes(value)
+    return struct.pack("!H", len(value)) + value
+
+
+def connect_packet(
+    client_id,
+    keepalive: int = 0,
+    clean_session: bool = True,
+    user=None,
+    password=None,
+    properties: bytes = None
+) -> bytes:
+    """
+    Build a CONNECT packet.
+
+    Parameters
+    ----------
+    client_id : the client identifier.
+    keepalive : the keepalive interval in seconds, 0 disables it.
+    clean_session : if False the broker resumes the previous session
+    (clean start in MQTT 5).
+    user : the optional user name.
+    password : the optional password, only sent with a user name.
+    properties : the encoded MQTT 5 properties, None for MQTT 3.1.1.
+    """
+    flags = 0x02 if clean_session else 0x00
+    payload = encode_string(client_id)
+    if user:
+        flags |= 0x80
+        payload += encode_string(user)
+        if password:
+            flags |= 0x40
+            payload += encode_string(password)
+    if properties is None:
+        variable_header = (
+            encode_string(b"MQTT")
+            + struct.pack("!BBH", PROTOCOL_LEVEL_3_1_1, flags, keepalive)
+        )
+    else:
+        # an MQTT 5 payload starts with the will properties, none here
+        variable_header = (
+            encode_string(b"MQTT")
+            + struct.pack("!BBH", PROTOCOL_LEVEL_5, flags, keepalive)
+            + properties
+        )
+    body = variable_header + payload
+    return bytes([CONNECT]) + encode_remaining_length(len(body)) + body
+
+
+def publish_packet(
+    topic,
+    msg,
+    qos: int = 0,
+    retain: bool = False,
+    pid: int = 0,
+    dup: bool = False,
+    properties: bytes = None
+) -> bytes:
+    """
+    Build a PUBLISH packet.
+
+    Parameters
+    ----------
+    topic : the topic to publish to, empty when a topic alias is used.
+    msg : the payload.
+    qos : the quality of service, 0 or 1.
+    retain : the retain flag.
+    pid : the packet identifier, only used when qos > 0.
+    dup : the duplicate delivery flag, set on retransmissions.
+    properties : the encoded MQTT 5 properties, None for MQTT 3.1.1.
+    """
+    first_byte = PUBLISH | (qos << 1) | retain
+    if dup:
+        first_byte |= 0x08
+    variable_header = encode_string(topic)
+    if qos:
+        variable_header += struct.pack("!H", pid)
+    if properties is not None:
+        variable_header += properties
+    msg = to_bytes(msg)
+    return (
+        bytes([first_byte])
+        + encode_remaining_length(len(variable_header) + len(msg))
+        + variable_header
+        + msg
+    )
+
+
+def subscribe_packet(
+    pid: int,
+    topic,
+    qos: int = 0,
+    v5: bool = False
+) -> bytes:
+    """
+    Build a SUBSCRIBE packet for a single topic filter.
+
+    Parameters
+    ----------
+    pid : the packet identifier.
+    topic : the topic filter.
+    qos : the maximum qos requested for the subscription.
+    v5 : True to add the (empty) MQTT 5 properties block.
+    """
+    body = struct.pack("!H", pid)
+    if v5:
+        body += b"\x00"
+    body += encode_string(topic) + bytes([qos])
+    return bytes([SUBSCRIBE]) + encode_remaining_length(len(body)) + body
+
+
+def unsubscribe_packet(pid: int, topic, v5: bool = False) -> bytes:
+    """
+    Build an UNSUBSCRIBE packet for a single topic filter.
+
+    Parameters
+    ----------
+    pid : the packet identifier.
+    topic : the topic filter.
+    v5 : True to add the (empty) MQTT 5 properties block.
+    """
+    body = struct.pack("!H", pid)
+    if v5:
+        body += b"\x00"
+    body += encode_string(topic)
+    return bytes([UNSUBSCRIBE]) + encode_remaining_length(len(body)) + body
+
+
+def puback_packet(pid: int) -> bytes:
+    """ Build a PUBACK packet acknowledging pid. """
+    return struct.pack("!BBH", PUBACK, 2, pid)
+
+
+def parse_connack(body: bytes) -> tuple:
+    """
+    Parse the body of a CONNACK packet.
+
+    Returns
+    -------
+    tuple : (session_present, return_code), the return code is the
+    reason code in MQTT 5.
+    """
+    if len(body) < 2:
+        raise MqttProtocolError("short CONNACK")
+    return bool(body[0] & 0x01), body[1]
+
+
+def parse_connack_properties(body: bytes) -> dict:
+    """ Return the properties of an MQTT 5 CONNACK packet. """
+    if len(body) < 3:
+        return {}
+    return parse_properties(body, 2)[0]
+
+
+def parse_suback(body: bytes, v5: bool = False) -> tuple:
+    """
+    Parse the body of a SUBACK packet for a single topic filter.
+
+    Returns
+    -------
+    tuple : (pid, code), a code >= 0x80 means the subscription failed.
+    """
+    pid = parse_packet_id(body)
+    offset = 2
+    if v5:
+        offset = parse_properties(body, offset)[1]
+    if len(body) <= offset:
+        raise MqttProtocolError("SUBACK without return code")
+    return pid, body[offset]
+
+
+def parse_ack_reason(body: bytes) -> int:
+    """
+    Return the reason code of an MQTT 5 PUBACK or DISCONNECT body,
+    an omitted reason code means success.
+    """
+    if len(body) < 3:
+        return 0
+    return body[2]
+
+
+def parse_publish(first_byte: int, body: bytes, v5: bool = False) -> tuple:
+    """
+    Parse the body of a PUBLISH packet.
+
+    Parameters
+    ----------
+    first_byte : the first byte of the fixed header (carries the flags).
+    body : the bytes following the fixed header.
+    v5 : True to skip the MQTT 5 properties block.
+
+    Returns
+    -------
+    tuple : (topic, msg, qos, pid) where topic and msg are bytes and
+    pid is 0 for qos 0 messages.
+    """
+    qos = (first_byte >> 1) & 0x03
+    topic_len = (body[0] << 8) | body[1]
+    topic = bytes(body[2:2 + topic_len])
+    offset = 2 + topic_len
+    pid = 0
+    if qos:
+        pid = (body[offset] << 8) | body[offset + 1]
+        offset += 2
+    if v5:
+        offset = parse_properties(body, offset)[1]
+    return topic, bytes(body[offset:]), qos, pid
+
+
+def parse_packet_id(body: bytes) -> int:
+    """ Return the packet identifier at the start of body. """
+    if len(body) < 2:
+        raise MqttProtocolError("missing packet identifier")
+    return (body[0] << 8) | body[1]
@@ -0,0 +1,175 @@
+"""
+Persistence of the mqtt session state.
+
+With clean_session disabled the broker keeps the subscriptions and the
+unacknowledged qos 1 messages of the client while it is offline. The
+client side of that session (the last packet id, the messages of the
+outbox and the subscriptions) is snapshotted to a json file so a device
+reset resumes the session: the in flight messages are resent with the
+DUP flag and no subscription is sent again when the broker reports the
+session as present.
+
+The snapshot is only written when the state changed, at most every
+save_interval_ms, a reset can lose the changes of the last interval,
+which at worst resends an already acknowledged message.
+"""
+import binascii
+
+from device_logging import Logger
+from storage import atomic_write_json, load_json
+from timing import sleep_ms
+
+SESSION_FORMAT = 1
+
+
+def _encode_msg(msg) -> list:
+    """ Return [text, is_binary] for a str or bytes like message. """
+    if isinstance(msg, str):
+        return [msg, False]
+    return [binascii.b2a_base64(bytes(msg)).decode().strip(), True]
+
+
+def _decode_msg(text: str, is_binary: bool):
+    """ Return the message encoded by _encode_msg. """
+    if is_binary:
+        return binascii.a2b_base64(text)
+    return text
+
+
+def _topic_str(topic) -> str:
+    """ Return a topic given as str or bytes as str. """
+    if isinstance(topic, str):
+        return topic
+    return str(topic, "utf-8")
+
+
+class SessionStore:
+    """
+    Save and restore the session state of an AsyncMqttClient.
+
+    Attributes
+    ----------
+    path : the path of the snapshot file.
+    save_interval_ms : the minimum time between two snapshots.
+    saved_count : the number of snapshots written.
+    restored : True if the state of the client comes from a snapshot.
+    client : the AsyncMqttClient snapshotted by run, None until attached.
+    """
+    def __init__(self, path: str, save_interval_ms: int = 1000) -> None:
+        self.path = path
+        self.save_interval_ms = save_interval_ms
+        self.saved_count = 0
+        self.restored = False
+        self.client = None
+        self.logger = Logger("MQTT_SESSION")
+        self._saved_signature = None
+
+    def _signature(self, client) -> tuple:
+        """ Return a cheap summary of the state, changing with it. """
+        outbox = client.outbox
+        return (
+            outbox.queued_count,
+            outbox.sent_count,
+            outbox.acked_count,
+            outbox.dropped_count,
+            tuple(sorted(client.subscriptions.items()))
+        )
+
+    def save(self, client) -> None:
+        """
+        Write the session state of a client.
+
+        Parameters
+        ----------
+        client : the AsyncMqttClient.
+        """
+        state = client.session_state()
+        atomic_write_json(self.path, {
+            "format": SESSION_FORMAT,
+            "client_id": client.client_id,
+            "last_pid": state["last_pid"],
+            "subscriptions": state["subscriptions"],
+            "in_flight": [
+                [pid, _topic_str(topic)] + _encode_msg(msg) + [retain]
+                for pid, topic, msg, retain in state["in_flight"]
+            ],
+            "queued": [
+                [_topic_str(topic)] + _encode_msg(msg) + [retain]
+                for topic, msg, retain in state["queued"]
+            ],
+        })
+        self._saved_signature = self._signature(client)
+        self.saved_count += 1
+
+    def restore(self, client) -> bool:
+        """
+        Load the snapshot into a client, before its first connection.
+
+        Parameters
+        ----------
+        client : the AsyncMqttClient.
+
+        Returns
+        -------
+        bool : False if there is no usable snapshot for this client.
+        """
+        snapshot = load_json(self.path)
+        if (
+            not snapshot
+            or snapshot.get("format") != SESSION_FORMAT
+            or snapshot.get("client_id") != client.client_id
+        ):
+            return False
+        client.restore_session({
+            "last_pid": snapshot["last_pid"],
+            "subscriptions": snapshot["subscriptions"],
+            "in_flight": [
+                (pid, topic, _decode_msg(text, is_binary), retain)
+                for pid, topic, text, is_binary, retain
+                in snapshot["in_flight"]
+            ],
+            "queued": [
+                (topic, _decode_msg(text, is_binary), retain)
+                for topic, text, is_binary, retain in snapshot["queued"]
+            ],
+        })
+        self._saved_signature = self._signature(client)
+        self.restored = True
+        self.logger.info(
+            f"session restored: {len(snapshot['subscriptions'])} "
+            f"subscriptions, {len(snapshot['in_flight'])} in flight, "
+            f"{len(snapshot['queued'])} queued"
+        )
+        return True
+
+    def save_if_changed(self, client) -> bool:
+        """ Write the state of a client if it changed since the last save. """
+        if self._signature(client) == self._saved_signature:
+            return False
+        self.save(client)
+        return True
+
+    def attach(self, client) -> None:
+        """
+        Make run snapshot a new client, the last state of the previous
+        one is saved first so the new client restores it.
+
+        Parameters
+        ----------
+        client : the AsyncMqttClient, not connected yet.
+        """
+        previous = self.client
+        self.client = client
+        if previous is not None and previous is not client:
+            self.save_if_changed(previous)
+
+    async def run(self) -> None:
+        """ Snapshot the state of the attached client when it changes. """
+        while True:
+            await sleep_ms(self.save_interval_ms)
+            if self.client is None:
+                continue
+            try:
+                self.save_if_changed(self.client)
+            except OSError as e:
+                self.logger.warning(f"session snapshot failed: {e}")
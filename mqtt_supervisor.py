@@ -0,0 +1,180 @@
+"""
+Keep the async mqtt client connected.
+
+The supervisor is a task that pings the broker on the keepalive
+schedule, declares the connection dead when a PINGRESP does not come
+back in time and reconnects with a jittered exponential backoff,
+restoring the subscriptions once the session is up again.
+"""
+import asyncio
+import random
+
+from device_logging import Logger
+from mqtt_protocol import MqttProtocolError
+from timing import sleep_ms, ticks_diff, ticks_ms
+
+IDLE_CHECK_INTERVAL_MS = 1000
+MIN_CHECK_INTERVAL_MS = 100
+
+
+class ConnectionSupervisor:
+    """
+    Connection supervisor of an AsyncMqttClient.
+
+    Attributes
+    ----------
+    client : the supervised AsyncMqttClient.
+    on_connect : an optional coroutine function awaited after every
+    successful (re)connection.
+    min_backoff_ms : the first delay between two connection attempts.
+    max_backoff_ms : the maximum delay between two connection attempts.
+    ping_timeout_ms : the time given to the broker to answer a PINGREQ.
+    attempts_count : the number of connection attempts.
+    failures_count : the number of failed connection attempts.
+    reconnect_count : the number of successful (re)connections.
+    dead_count : the number of connections declared dead.
+    last_attempts : the attempts needed by the last (re)connection.
+    last_reconnect_ms : the time between the detection of the loss and the
+    session being up again, for the last (re)connection.
+    last_handshake_ms : the duration of the last successful handshake.
+    """
+    def __init__(
+        self,
+        client,
+        on_connect=None,
+        min_backoff_ms: int = 500,
+        max_backoff_ms: int = 60000,
+        ping_timeout_ms: int = 5000
+    ) -> None:
+        self.client = client
+        self.on_connect = on_connect
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.ping_timeout_ms = ping_timeout_ms
+        self.attempts_count = 0
+        self.failures_count = 0
+        self.reconnect_count = 0
+        self.dead_count = 0
+        self.last_attempts = 0
+        self.last_reconnect_ms = 0
+        self.last_handshake_ms = 0
+        self.logger = Logger("MQTT_SUPERVISOR")
+        self._task = None
+        self._ping_sent_ms = None
+        self._rx_packets_at_ping = 0
+
+    def is_running(self) -> bool:
+        """ Return True if the supervisor task is running. """
+        return self._task is not None
+
+    def start(self) -> None:
+        """ Start supervising the client. """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        """ Stop supervising the client, the connection is left as is. """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        """ Supervise the client until stopped. """
+        while True:
+            if not self.client.isconnected():
+                await self._reconnect()
+            else:
+                await sleep_ms(await self._check_keepalive())
+
+    def _backoff_delay(self, backoff_ms: int) -> int:
+        """ Return a random delay in [backoff_ms / 2, backoff_ms]. """
+        half = backoff_ms // 2
+        return half + random.randint(0, half)
+
+    async def _reconnect(self) -> None:
+        """ Retry the connection until it succeeds. """
+        lost_at = ticks_ms()
+        backoff_ms = self.min_backoff_ms
+        attempts = 0
+        while True:
+            attempts += 1
+            self.attempts_count += 1
+            started_at = ticks_ms()
+            try:
+                session_present = await self.client.connect()
+                self.last_handshake_ms = ticks_diff(ticks_ms(), started_at)
+                await self._restore_subscriptions(session_present)
+                break
+            except (OSError, MqttProtocolError) as e:
+                self.failures_count += 1
+                self.client.close()
+                delay_ms = self._backoff_delay(backoff_ms)
+                self.logger.warning(
+                    f"connection attempt {attempts} failed: {e}, "
+                    f"retrying in {delay_ms} ms"
+                )
+                await sleep_ms(delay_ms)
+                backoff_ms = min(backoff_ms * 2, self.max_backoff_ms)
+        self.reconnect_count += 1
+        self.last_attempts = attempts
+        self.last_reconnect_ms = ticks_diff(ticks_ms(), lost_at)
+        self._ping_sent_ms = None
+        self.logger.info(
+            f"connected after {attempts} attempts "
+            f"in {self.last_reconnect_ms} ms"
+        )
+        if self.on_connect is not None:
+            try:
+                await self.on_connect()
+            except OSError as e:
+                self.logger.error(f"on connect callback failed: {e}")
+
+    async def _restore_subscriptions(self, session_present: bool) -> None:
+        """
+        Subscribe again to the topics of the previous session.
+
+        Parameters
+        ----------
+        session_present : the flag of the CONNACK.
+        """
+        if session_present:
+            return
+        for topic, qos in list(self.client.subscriptions.items()):
+            await self.client.subscribe(topic, qos)
+
+    async def _check_keepalive(self) -> int:
+        """
+        Send the keepalive ping when due and detect a dead connection.
+
+        Returns
+        -------
+        int : the delay in ms before the next check.
+        """
+        if not self.client.keepalive:
+            return IDLE_CHECK_INTERVAL_MS
+        now = ticks_ms()
+        if self._ping_sent_ms is not None:
+            if self.client.rx_packets != self._rx_packets_at_ping:
+                self._ping_sent_ms = None
+            elif ticks_diff(now, self._ping_sent_ms) > self.ping_timeout_ms:
+                self.dead_count += 1
+                self.logger.error("no PINGRESP, the connection is dead")
+                self.client.close()
+                return 0
+            else:
+                return MIN_CHECK_INTERVAL_MS
+        ping_interval_ms = self.client.keepalive * 500
+        idle_ms = max(
+            ticks_diff(now, self.client.last_tx_ms),
+            ticks_diff(now, self.client.last_rx_ms)
+        )
+        if idle_ms >= ping_interval_ms:
+            self._ping_sent_ms = now
+            self._rx_packets_at_ping = self.client.rx_packets
+            try:
+                await self.client.ping()
+            except OSError as e:
+                self.logger.error(f"ping failed: {e}")
+                return 0
+            return MIN_CHECK_INTERVAL_MS
+        return max(ping_interval_ms - idle_ms, MIN_CHECK_INTERVAL_MS)
@@ -1,5 +1,5 @@
 """ Manage the pages of the menu. """
-from time import sleep
+import asyncio
 
 from machine import Pin
 from ssd1306 import SSD1306_I2C
@@ -8,6 +8,10 @@ from commands_dispatcher import CommandsDispatcher
 from device_logging import Logger
 from page import Page
 from rotary. rotary_irq_pico import RotaryIRQ
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms
+
+SELECT_DEBOUNCE_MS = 200
+MENU_POLL_INTERVAL_MS = 5
 
 
 class PagesManager:
@@ -37,6 +41,7 @@ class PagesManager:
         self.target_page: Page | None = None
         self.back_positions = []
         self.last_encoder_value = 0
+        self.select_enabled_at = ticks_ms()
 
     def build_menu_from_dict(self, menu: dict) -> None:
         """
@@ -175,7 +180,10 @@ class PagesManager:
             self.last_encoder_value = self.encoder.value()
             self.target_page.cursor_position = self.encoder.value()
             self.target_page.to_oled()
-        if self.select_button.value() == 0:
+        if (
+            self.select_button.value() == 0
+            and ticks_diff(ticks_ms(), self.select_enabled_at) >= 0
+        ):
             self._perform_action()
 
     def _perform_action(self) -> None:
@@ -199,7 +207,7 @@ class PagesManager:
         self._switch_page(self.target_page, self.encoder.value())
         self.encoder.max_val = len(self.target_page.options) - 1
         self.target_page.to_oled()
-        sleep(0.2)
+        self.select_enabled_at = ticks_add(ticks_ms(), SELECT_DEBOUNCE_MS)
 
     def _excecute_command(self, target_page, encoder_value: int) -> None:
         """
@@ -265,3 +273,27 @@ class PagesManager:
                     raise e
                 self.logger.critical(f"an exception has been raised: {e}")
                 self.run(recovery_from_exceptions)
+
+    async def _run_async(self, recovery_from_exceptions: bool) -> None:
+        """
+        Poll the menu as a task, yielding to the other tasks of the
+        event loop between two iterations.
+        """
+        self._setup()
+        while True:
+            try:
+                self._loop()
+            except Exception as e:
+                if not recovery_from_exceptions:
+                    raise e
+                self.logger.critical(f"an exception has been raised: {e}")
+                self._setup()
+            await sleep_ms(MENU_POLL_INTERVAL_MS)
+
+    def run_async(self, recovery_from_exceptions = True) -> None:
+        """
+        Start the menu execution on the asyncio event loop, the loop is
+        shared with the tasks scheduled by the commands (e.g. the async
+        mqtt client).
+        """
+        asyncio.run(self._run_async(recovery_from_exceptions))
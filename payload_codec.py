@@ -0,0 +1,368 @@
+"""
+Payload codecs of the mqtt messages.
+
+A codec turns a python value into the bytes of a payload and back:
+
+- JsonCodec : the json text, the format used so far.
+- CborCodec : the compact binary CBOR encoding (RFC 8949) of ints,
+  floats, strings, bytes, lists and dicts.
+- StructCodec : a fixed layout of numeric fields, e.g. two uint32.
+
+encode writes into a buffer allocated once by the codec and returns a
+memoryview of the written bytes, valid until the next encode call, a
+caller keeping the payload (e.g. in a queue) must copy it with bytes().
+decode reads the payload through memoryview slices instead of building
+intermediate copies.
+"""
+import json
+import struct
+
+from topic_router import TopicRouter
+
+CBOR_UINT = 0x00
+CBOR_NEGINT = 0x20
+CBOR_BYTES = 0x40
+CBOR_TEXT = 0x60
+CBOR_ARRAY = 0x80
+CBOR_MAP = 0xA0
+CBOR_TAG = 0xC0
+CBOR_SIMPLE = 0xE0
+CBOR_FALSE = 0xF4
+CBOR_TRUE = 0xF5
+CBOR_NULL = 0xF6
+CBOR_FLOAT16 = 0xF9
+CBOR_FLOAT32 = 0xFA
+CBOR_FLOAT64 = 0xFB
+
+
+class JsonCodec:
+    """ Json text payloads. """
+    name = "json"
+
+    def encode(self, value) -> bytes:
+        """ Return the json encoding of value. """
+        return json.dumps(value).encode("utf-8")
+
+    def decode(self, data):
+        """ Return the value of a json payload. """
+        return json.loads(str(data, "utf-8"))
+
+
+class CborCodec:
+    """
+    CBOR payloads, encoded into a preallocated buffer.
+
+    Attributes
+    ----------
+    buffer_size : the maximum size of an encoded payload.
+    """
+    name = "cbor"
+
+    def __init__(self, buffer_size: int = 256) -> None:
+        self.buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._position = 0
+
+    def encode(self, value) -> memoryview:
+        """
+        Encode a value.
+
+        Parameters
+        ----------
+        value : None, a bool, int, float, str, bytes, list, tuple or dict.
+
+        Returns
+        -------
+        memoryview : the payload, valid until the next encode call.
+        """
+        self._position = 0
+        self._encode(value)
+        return self._view[:self._position]
+
+    def _reserve(self, size: int) -> int:
+        """ Return the write position of size bytes, advancing it. """
+        position = self._position
+        if position + size > self.buffer_size:
+            raise ValueError("payload larger than the codec buffer")
+        self._position = position + size
+        return position
+
+    def _write_head(self, major: int, argument: int) -> None:
+        """ Write the initial byte of an item and its argument. """
+        if argument < 24:
+            self._buffer[self._reserve(1)] = major | argument
+        elif argument < 0x100:
+            position = self._reserve(2)
+            self._buffer[position] = major | 24
+            self._buffer[position + 1] = argument
+        elif argument < 0x10000:
+            struct.pack_into(
+                "!BH", self._buffer, self._reserve(3), major | 25, argument
+            )
+        elif argument < 0x100000000:
+            struct.pack_into(
+                "!BI", self._buffer, self._reserve(5), major | 26, argument
+            )
+        else:
+            struct.pack_into(
+                "!BQ", self._buffer, self._reserve(9), major | 27, argument
+            )
+
+    def _write_bytes(self, major: int, data) -> None:
+        """ Write a byte or text string item. """
+        self._write_head(major, len(data))
+        position = self._reserve(len(data))
+        self._view[position:position + len(data)] = data
+
+    def _encode(self, value) -> None:
+        """ Append the encoding of value to the buffer. """
+        if value is None:
+            self._buffer[self._reserve(1)] = CBOR_NULL
+        elif value is True:
+            self._buffer[self._reserve(1)] = CBOR_TRUE
+        elif value is False:
+            self._buffer[self._reserve(1)] = CBOR_FALSE
+        elif isinstance(value, int):
+            if value >= 0:
+                self._write_head(CBOR_UINT, value)
+            else:
+                self._write_head(CBOR_NEGINT, -1 - value)
+        elif isinstance(value, float):
+            self._encode_float(value)
+        elif isinstance(value, str):
+            self._write_bytes(CBOR_TEXT, value.encode("utf-8"))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._write_bytes(CBOR_BYTES, value)
+        elif isinstance(value, (list, tuple)):
+            self._write_head(CBOR_ARRAY, len(value))
+            for item in value:
+                self._encode(item)
+        elif isinstance(value, dict):
+            self._write_head(CBOR_MAP, len(value))
+            for key, item in value.items():
+                self._encode(key)
+                self._encode(item)
+        else:
+            raise ValueError(f"cannot encode {type(value)}")
+
+    def _encode_float(self, value: float) -> None:
+        """ Write a float on 4 bytes when it is exact, otherwise on 8. """
+        position = self._reserve(5)
+        struct.pack_into("!Bf", self._buffer, position, CBOR_FLOAT32, value)
+        if struct.unpack_from("!f", self._buffer, position + 1)[0] == value:
+            return
+        self._position = position
+        struct.pack_into(
+            "!Bd", self._buffer, self._reserve(9), CBOR_FLOAT64, value
+        )
+
+    def decode(self, data):
+        """
+        Decode a payload.
+
+        Parameters
+        ----------
+        data : the payload, bytes or any object exposing a buffer.
+        """
+        value, _ = self._decode(memoryview(data), 0)
+        return value
+
+    def _read_argument(self, view: memoryview, position: int) -> tuple:
+        """
+        Read the argument of the item at position.
+
+        Returns
+        -------
+        tuple : (major type, argument, position after the head).
+        """
+        initial = view[position]
+        major = initial & 0xE0
+        info = initial & 0x1F
+        position += 1
+        if info < 24:
+            return major, info, position
+        if info == 24:
+            return major, view[position], position + 1
+        if info == 25:
+            return major, struct.unpack_from("!H", view, position)[0], (
+                position + 2
+            )
+        if info == 26:
+            return major, struct.unpack_from("!I", view, position)[0], (
+                position + 4
+            )
+        if info == 27:
+            return major, struct.unpack_from("!Q", view, position)[0], (
+                position + 8
+            )
+        raise ValueError("indefinite length items are not supported")
+
+    def _decode(self, view: memoryview, position: int) -> tuple:
+        """
+        Decode the item at position.
+
+        Returns
+        -------
+        tuple : (value, position after the item).
+        """
+        initial = view[position]
+        if initial >= CBOR_SIMPLE:
+            return self._decode_simple(view, position)
+        major, argument, position = self._read_argument(view, position)
+        if major == CBOR_UINT:
+            return argument, position
+        if major == CBOR_NEGINT:
+            return -1 - argument, position
+        if major == CBOR_BYTES:
+            end = position + argument
+            return bytes(view[position:end]), end
+        if major == CBOR_TEXT:
+            end = position + argument
+            return str(view[position:end], "utf-8"), end
+        if major == CBOR_ARRAY:
+            items = []
+            for _ in range(argument):
+                item, position = self._decode(view, position)
+                items.append(item)
+            return items, position
+        if major == CBOR_MAP:
+            items = {}
+            for _ in range(argument):
+                key, position = self._decode(view, position)
+                items[key], position = self._decode(view, position)
+            return items, position
+        # tags only annotate the following item
+        return self._decode(view, position)
+
+    def _decode_simple(self, view: memoryview, position: int) -> tuple:
+        """ Decode a simple value or a float. """
+        initial = view[position]
+        if initial == CBOR_FALSE:
+            return False, position + 1
+        if initial == CBOR_TRUE:
+            return True, position + 1
+        if initial == CBOR_NULL:
+            return None, position + 1
+        if initial == CBOR_FLOAT16:
+            return _half_to_float(
+                struct.unpack_from("!H", view, position + 1)[0]
+            ), position + 3
+        if initial == CBOR_FLOAT32:
+            return struct.unpack_from("!f", view, position + 1)[0], (
+                position + 5
+            )
+        if initial == CBOR_FLOAT64:
+            return struct.unpack_from("!d", view, position + 1)[0], (
+                position + 9
+            )
+        raise ValueError(f"unsupported simple value {initial}")
+
+
+def _half_to_float(half: int) -> float:
+    """ Convert the bits of an IEEE 754 half precision float. """
+    exponent = (half >> 10) & 0x1F
+    mantissa = half & 0x3FF
+    if exponent == 0:
+        value = mantissa * 2.0 ** -24
+    elif exponent == 0x1F:
+        value = float("inf") if not mantissa else float("nan")
+    else:
+        value = (mantissa + 1024) * 2.0 ** (exponent - 25)
+    return -value if half & 0x8000 else value
+
+
+class StructCodec:
+    """
+    Fixed layout payloads, the fields are packed in network byte order.
+
+    Attributes
+    ----------
+    names : the names of the fields, given with their struct format
+    character as [[name, format], ...], e.g. [["free", "I"]].
+    format : the struct format of the payload.
+    size : the size of a payload.
+    """
+    name = "struct"
+
+    def __init__(self, fields: list) -> None:
+        self.names = [field[0] for field in fields]
+        self.format = "!" + "".join(field[1] for field in fields)
+        self.size = struct.calcsize(self.format)
+        self._buffer = bytearray(self.size)
+
+    def encode(self, value) -> memoryview:
+        """
+        Pack the fields of a dict, or the items of a list in order.
+
+        Returns
+        -------
+        memoryview : the payload, valid until the next encode call.
+        """
+        if isinstance(value, dict):
+            value = [value[name] for name in self.names]
+        struct.pack_into(self.format, self._buffer, 0, *value)
+        return memoryview(self._buffer)
+
+    def decode(self, data) -> dict:
+        """ Unpack a payload into a dict of its fields. """
+        if len(data) != self.size:
+            raise ValueError(f"expected {self.size} bytes, got {len(data)}")
+        return dict(zip(self.names, struct.unpack_from(self.format, data)))
+
+
+def create_codec(settings: dict):
+    """
+    Build a codec from its settings.
+
+    Parameters
+    ----------
+    settings : {"type": "json"}, {"type": "cbor", "buffer_size": 256}
+    or {"type": "struct", "fields": [[name, format], ...]}.
+    """
+    codec_type = settings.get("type", "json")
+    if codec_type == "cbor":
+        return CborCodec(settings.get("buffer_size", 256))
+    if codec_type == "struct":
+        return StructCodec(settings["fields"])
+    if codec_type == "json":
+        return JsonCodec()
+    raise ValueError(f"unknown codec {codec_type}")
+
+
+class CodecTable:
+    """
+    The codec of each topic, selected by topic filter, the longest
+    matching filter wins and unmatched topics use the default codec.
+
+    Attributes
+    ----------
+    default : the codec of the topics matching no filter.
+    """
+    def __init__(self, default=None) -> None:
+        self.default = default if default is not None else JsonCodec()
+        self._router = TopicRouter()
+
+    def add(self, topic_filter: str, codec) -> None:
+        """
+        Use a codec for the topics matching a filter.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter, '+' and '#' wildcards allowed.
+        codec : the codec.
+        """
+        self._router.add(topic_filter, (len(topic_filter), codec))
+
+    def codec_for(self, topic):
+        """ Return the codec of a topic, as str or bytes. """
+        if not isinstance(topic, str):
+            topic = str(topic, "utf-8")
+        matched = self._router.match(topic)
+        if not matched:
+            return self.default
+        best = matched[0]
+        for candidate in matched:
+            if candidate[0] > best[0]:
+                best = candidate
+        return best[1]
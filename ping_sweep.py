@@ -0,0 +1,278 @@
+"""
+Concurrent ICMP host discovery.
+
+A sweep keeps up to window echo requests in flight on a single raw
+socket instead of waiting for the timeout of every address in turn: the
+requests of a sweep share a random identifier and carry the index of
+their address as sequence number, so each reply is matched to its probe
+without any per address socket. A /24 without retries takes about
+254 / window timeouts at worst, a few seconds.
+
+The echo request is built once and only its sequence number and
+checksum are patched before each send. sweep blocks until every address
+is settled, sweep_async polls the socket from a task instead.
+"""
+import random
+import select
+import socket
+import struct
+
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms, ticks_us
+
+ICMP_PROTOCOL = 1
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER = "!BBHHH"
+ICMP_HEADER_SIZE = 8
+MAX_REPLY_SIZE = 256
+PROGRESS_STEP = 5
+POLL_INTERVAL_MS = 10
+
+
+def checksum(data) -> int:
+    """ Return the internet checksum (rfc 1071) of data. """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    total = 0
+    for i in range(0, len(data), 2):
+        total += (data[i] << 8) | data[i + 1]
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class PingSweep:
+    """
+    Ping many addresses at once on one raw socket.
+
+    Attributes
+    ----------
+    window : the maximum number of echo requests in flight.
+    timeout_ms : the time to wait for the reply of a request.
+    retries : the number of requests sent again to a silent address.
+    on_host : an optional callable called as on_host(address, latency_ms)
+    as soon as an address answers.
+    on_progress : an optional callable called as
+    on_progress(percentage, found_count) when an address is settled.
+    sent_count : the number of echo requests sent by the last sweep.
+    """
+    def __init__(
+        self,
+        window: int = 32,
+        timeout_ms: int = 1000,
+        retries: int = 1,
+        payload_size: int = 16,
+        on_host=None,
+        on_progress=None
+    ) -> None:
+        self.window = window
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self.on_host = on_host
+        self.on_progress = on_progress
+        self.sent_count = 0
+        self._packet = bytearray(ICMP_HEADER_SIZE + payload_size)
+        for i in range(payload_size):
+            self._packet[ICMP_HEADER_SIZE + i] = 0x61 + i % 26
+        self._identifier = 0
+        self._reported = 0
+        self._addresses = []
+        self._found = []
+        self._settled = 0
+        self._attempts = None
+        self._sent_at = {}
+        self._deadlines = {}
+        self._retry = []
+        self._next_index = 0
+        self._sock = None
+        self._poller = None
+
+    def _request(self, sequence: int) -> bytearray:
+        """ Patch the echo request of an address index. """
+        packet = self._packet
+        struct.pack_into(
+            ICMP_HEADER,
+            packet,
+            0,
+            ICMP_ECHO_REQUEST,
+            0,
+            0,
+            self._identifier,
+            sequence
+        )
+        struct.pack_into("!H", packet, 2, checksum(packet))
+        return packet
+
+    def _parse_reply(self, data) -> int:
+        """
+        Return the sequence number of an echo reply of the current sweep,
+        -1 for any other packet. The ip header is skipped if present.
+        """
+        offset = 0
+        if len(data) >= 20 and data[0] >> 4 == 4:
+            offset = (data[0] & 0x0F) * 4
+        if len(data) < offset + ICMP_HEADER_SIZE:
+            return -1
+        icmp_type, _, _, identifier, sequence = struct.unpack_from(
+            ICMP_HEADER, data, offset
+        )
+        if icmp_type != ICMP_ECHO_REPLY or identifier != self._identifier:
+            return -1
+        return sequence
+
+    def _begin(self, addresses: list) -> None:
+        """ Open the socket and reset the state of a sweep. """
+        self._identifier = random.getrandbits(16)
+        self.sent_count = 0
+        self._reported = -PROGRESS_STEP
+        self._addresses = addresses
+        self._found = []
+        self._settled = 0
+        self._attempts = bytearray(len(addresses))
+        self._sent_at = {}
+        self._deadlines = {}
+        self._retry = []
+        self._next_index = 0
+        self._sock = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, ICMP_PROTOCOL
+        )
+        self._sock.setblocking(False)
+        self._poller = select.poll()
+        self._poller.register(self._sock, select.POLLIN)
+
+    def _end(self) -> list:
+        """ Close the socket, return the hosts found. """
+        self._sock.close()
+        self._sock = None
+        self._poller = None
+        return self._found
+
+    def _step(self, block: bool) -> bool:
+        """
+        Fill the window of requests, read the replies and expire the
+        silent requests.
+
+        Parameters
+        ----------
+        block : True to wait for a reply until the next deadline, False
+        to only read the replies already received.
+
+        Returns
+        -------
+        bool : False once every address is settled.
+        """
+        addresses = self._addresses
+        deadlines = self._deadlines
+        while len(deadlines) < self.window and (
+            self._retry or self._next_index < len(addresses)
+        ):
+            if self._retry:
+                index = self._retry.pop()
+            else:
+                index = self._next_index
+                self._next_index += 1
+            try:
+                self._sock.sendto(
+                    self._request(index), (addresses[index], 0)
+                )
+            except OSError:
+                # unreachable right away, counted as a timeout
+                pass
+            self.sent_count += 1
+            self._attempts[index] += 1
+            self._sent_at[index] = ticks_us()
+            deadlines[index] = ticks_add(ticks_ms(), self.timeout_ms)
+        if not deadlines:
+            return False
+        wait_ms = 0
+        if block:
+            now = ticks_ms()
+            wait_ms = min(
+                max(0, ticks_diff(deadline, now))
+                for deadline in deadlines.values()
+            )
+        if self._poller.poll(wait_ms):
+            self._read_replies()
+        now = ticks_ms()
+        for index, deadline in list(deadlines.items()):
+            if ticks_diff(now, deadline) < 0:
+                continue
+            del deadlines[index]
+            del self._sent_at[index]
+            if self._attempts[index] <= self.retries:
+                self._retry.append(index)
+            else:
+                self._settled += 1
+                self._report()
+        return True
+
+    def _read_replies(self) -> None:
+        """ Settle the addresses of every reply waiting on the socket. """
+        while True:
+            try:
+                data, source = self._sock.recvfrom(MAX_REPLY_SIZE)
+            except OSError:
+                return
+            index = self._parse_reply(data)
+            if index not in self._deadlines:
+                continue
+            address = self._addresses[index]
+            if source[0] != address:
+                continue
+            latency_ms = ticks_diff(
+                ticks_us(), self._sent_at.pop(index)
+            ) / 1000
+            del self._deadlines[index]
+            self._found.append((address, latency_ms))
+            self._settled += 1
+            if self.on_host is not None:
+                self.on_host(address, latency_ms)
+            self._report()
+
+    def sweep(self, addresses: list) -> list:
+        """
+        Ping every address and return the ones which answered, blocking
+        until the last one is settled.
+
+        Parameters
+        ----------
+        addresses : the ipv4 addresses to ping, at most 65536.
+
+        Returns
+        -------
+        list : (address, latency_ms) tuples, in the order of the replies.
+        """
+        if not addresses:
+            return []
+        self._begin(addresses)
+        try:
+            while self._step(True):
+                pass
+        finally:
+            found = self._end()
+        return found
+
+    async def sweep_async(self, addresses: list) -> list:
+        """
+        Same as sweep but as a task, polling the socket every
+        POLL_INTERVAL_MS instead of blocking the event loop.
+        """
+        if not addresses:
+            return []
+        self._begin(addresses)
+        try:
+            while self._step(False):
+                await sleep_ms(POLL_INTERVAL_MS)
+        finally:
+            found = self._end()
+        return found
+
+    def _report(self) -> None:
+        """ Call on_progress every PROGRESS_STEP percent. """
+        percentage = self._settled * 100 // len(self._addresses)
+        if self.on_progress is None or (
+            percentage - self._reported < PROGRESS_STEP and percentage < 100
+        ):
+            return
+        self._reported = percentage
+        self.on_progress(percentage, len(self._found))
@@ -0,0 +1,164 @@
+"""
+Concurrent TCP port scanner.
+
+The (host, port) pairs are probed with non-blocking connects, at most
+max_sockets of them at once, a single poll object waiting for all of
+them: a port is open when its socket becomes writable without error,
+closed when the connection is refused and filtered when it stays silent
+for timeout_ms. A closed port costs one round trip instead of a timeout,
+a filtered one costs a timeout shared with every other socket in flight.
+
+The open ports are cached per host with the time of the scan.
+"""
+import errno
+import select
+import socket
+
+from timing import ticks_add, ticks_diff, ticks_ms
+
+SERVICES = {
+    22: "ssh",
+    23: "telnet",
+    80: "http",
+    443: "https",
+    1883: "mqtt",
+    8080: "http",
+    8883: "mqtts",
+}
+POLL_FAILED = select.POLLERR | select.POLLHUP
+
+
+def service_name(port: int) -> str:
+    """ Return the usual service of a port, an empty string if unknown. """
+    return SERVICES.get(port, "")
+
+
+class PortScanner:
+    """
+    Scan TCP ports of many hosts at once.
+
+    Attributes
+    ----------
+    ports : the ports to scan on each host.
+    max_sockets : the maximum number of connections in progress.
+    timeout_ms : the time after which a silent port is filtered.
+    on_open : an optional callable called as on_open(host, port) for
+    every open port as soon as it is found.
+    results : a dict containing the last scan of each host as
+    (ticks_ms of the scan, list of the open ports).
+    """
+    def __init__(
+        self,
+        ports: list,
+        max_sockets: int = 16,
+        timeout_ms: int = 500,
+        on_open=None
+    ) -> None:
+        self.ports = ports
+        self.max_sockets = max_sockets
+        self.timeout_ms = timeout_ms
+        self.on_open = on_open
+        self.results = {}
+
+    def cached(self, host: str, max_age_ms: int):
+        """
+        Return the open ports of a host scanned less than max_age_ms ago,
+        None if it must be scanned.
+        """
+        result = self.results.get(host)
+        if result is None or ticks_diff(ticks_ms(), result[0]) > max_age_ms:
+            return None
+        return result[1]
+
+    def hosts_with_port(self, port: int) -> list:
+        """ Return the cached hosts on which port is open. """
+        return [
+            host for host, (_, ports) in self.results.items()
+            if port in ports
+        ]
+
+    def _open(self, host: str, port: int):
+        """ Start a non-blocking connection, None if it failed at once. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(socket.getaddrinfo(host, port)[0][-1])
+        except OSError as e:
+            if e.args[0] != errno.EINPROGRESS:
+                sock.close()
+                return None
+        return sock
+
+    def scan(self, hosts: list) -> dict:
+        """
+        Scan the ports of hosts and cache the results.
+
+        Parameters
+        ----------
+        hosts : the ipv4 addresses of the hosts.
+
+        Returns
+        -------
+        dict : a dict containing the sorted open ports of each host.
+        """
+        probes = [(host, port) for host in hosts for port in self.ports]
+        open_ports = {host: [] for host in hosts}
+        next_probe = 0
+        in_flight = {}
+        by_fd = {}
+        poller = select.poll()
+        try:
+            while next_probe < len(probes) or in_flight:
+                while (
+                    len(in_flight) < self.max_sockets
+                    and next_probe < len(probes)
+                ):
+                    host, port = probes[next_probe]
+                    next_probe += 1
+                    sock = self._open(host, port)
+                    if sock is None:
+                        continue
+                    poller.register(sock, select.POLLOUT)
+                    in_flight[sock] = (
+                        host, port, ticks_add(ticks_ms(), self.timeout_ms)
+                    )
+                    if hasattr(sock, "fileno"):
+                        by_fd[sock.fileno()] = sock
+                if not in_flight:
+                    break
+                now = ticks_ms()
+                wait_ms = min(
+                    max(0, ticks_diff(deadline, now))
+                    for _, _, deadline in in_flight.values()
+                )
+                for obj, event in poller.poll(wait_ms):
+                    # cpython returns file descriptors, micropython sockets
+                    sock = by_fd.get(obj) if isinstance(obj, int) else obj
+                    if sock not in in_flight:
+                        continue
+                    host, port, _ = in_flight[sock]
+                    if event & select.POLLOUT and not event & POLL_FAILED:
+                        open_ports[host].append(port)
+                        if self.on_open is not None:
+                            self.on_open(host, port)
+                    self._close(poller, sock, in_flight, by_fd)
+                now = ticks_ms()
+                for sock, (_, _, deadline) in list(in_flight.items()):
+                    if ticks_diff(now, deadline) >= 0:
+                        self._close(poller, sock, in_flight, by_fd)
+        finally:
+            for sock in list(in_flight):
+                self._close(poller, sock, in_flight, by_fd)
+        now = ticks_ms()
+        for host, ports in open_ports.items():
+            ports.sort()
+            self.results[host] = (now, ports)
+        return open_ports
+
+    def _close(self, poller, sock, in_flight: dict, by_fd: dict) -> None:
+        """ Forget a probe and close its socket. """
+        del in_flight[sock]
+        if hasattr(sock, "fileno"):
+            by_fd.pop(sock.fileno(), None)
+        poller.unregister(sock)
+        sock.close()
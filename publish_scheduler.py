@@ -0,0 +1,193 @@
+"""
+Rate limited publish scheduler.
+
+Every topic owns a token bucket refilled at `rate` tokens per second up
+to `burst` tokens. A message submitted while its topic has a token
+takes it at once and is queued for sending, every message of a burst
+within the budget is delivered. While a topic is over its budget its
+pending message is replaced by the newer ones (last writer wins): a
+burst costs one slot per topic, and the freshest state is still
+delivered once the bucket refills.
+"""
+import asyncio
+from collections import deque
+
+from device_logging import Logger
+from timing import ticks_diff, ticks_ms
+from topic_router import TopicRouter
+
+IDLE_WAIT_MS = 1000
+
+
+class PublishScheduler:
+    """
+    Per topic token buckets in front of a publish coroutine.
+
+    Attributes
+    ----------
+    publish : a coroutine function called as publish(topic, msg, broker).
+    rate : the default tokens per second of a topic.
+    burst : the default bucket size of a topic.
+    max_topics : the maximum number of topics with a pending message,
+    and of messages queued with their token.
+    submitted_count : the number of submitted messages.
+    sent_count : the number of published messages.
+    coalesced_count : the number of messages replaced by a newer one.
+    dropped_count : the number of messages refused because max_topics
+    topics were already waiting.
+    error_count : the number of failed publications.
+    """
+    def __init__(
+        self,
+        publish,
+        rate: float = 10,
+        burst: int = 5,
+        max_topics: int = 32
+    ) -> None:
+        self.publish = publish
+        self.rate = rate
+        self.burst = burst
+        self.max_topics = max_topics
+        self.submitted_count = 0
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+        self.logger = Logger("PUBLISH_SCHEDULER")
+        self._limits = TopicRouter()
+        self._buckets = {}
+        self._ready = deque((), max_topics)
+        self._pending = {}
+        self._order = deque((), max_topics)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def set_limit(self, topic_filter: str, rate: float, burst: int) -> None:
+        """
+        Set the budget of the topics matching a filter, the most
+        restrictive budget applies when several filters match.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter, '+' and '#' wildcards allowed.
+        rate : the tokens per second.
+        burst : the bucket size.
+        """
+        self._limits.add(topic_filter, (rate, burst))
+        self._buckets = {}
+
+    def pending_count(self) -> int:
+        """ Return the number of messages waiting. """
+        return len(self._ready) + len(self._pending)
+
+    def submit(self, topic: str, msg, broker: str = None) -> bool:
+        """
+        Schedule a message, queued if its topic has a token, otherwise
+        replacing the pending one of the same topic.
+
+        Parameters
+        ----------
+        topic : the topic to publish to.
+        msg : the message to publish.
+        broker : the broker name passed to publish.
+
+        Returns
+        -------
+        bool : False if the message has been dropped.
+        """
+        self.submitted_count += 1
+        if topic in self._pending:
+            # the bucket is empty until the pending message is sent
+            self._pending[topic] = (msg, broker)
+            self.coalesced_count += 1
+            return True
+        if len(self._ready) < self.max_topics and not self._take_token(
+            topic, ticks_ms()
+        ):
+            self._ready.append((topic, msg, broker))
+        elif len(self._pending) >= self.max_topics:
+            self.dropped_count += 1
+            return False
+        else:
+            self._pending[topic] = (msg, broker)
+            self._order.append(topic)
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        self._wakeup.set()
+        return True
+
+    def _limit(self, topic: str) -> tuple:
+        """ Return the (rate, burst) budget of a topic. """
+        limits = self._limits.match(topic)
+        if not limits:
+            return self.rate, self.burst
+        return min(limits)
+
+    def _take_token(self, topic: str, now: int) -> int:
+        """
+        Refill the bucket of a topic and take a token.
+
+        Returns
+        -------
+        int : 0 if a token has been taken, otherwise the ms to wait
+        before the next token.
+        """
+        bucket = self._buckets.get(topic)
+        if bucket is None:
+            rate, burst = self._limit(topic)
+            bucket = [burst, now, rate, burst]
+            self._buckets[topic] = bucket
+        tokens, refilled_at, rate, burst = bucket
+        tokens = min(
+            burst, tokens + ticks_diff(now, refilled_at) * rate / 1000
+        )
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return int((1 - tokens) * 1000 / rate) + 1
+
+    def _forget_full_buckets(self, now: int) -> None:
+        """
+        Drop the buckets refilled to their burst, a new bucket is full so
+        the budget is unchanged and the buckets dict stays bounded.
+        """
+        for topic in list(self._buckets):
+            if topic in self._pending:
+                continue
+            tokens, refilled_at, rate, burst = self._buckets[topic]
+            if tokens + ticks_diff(now, refilled_at) * rate / 1000 >= burst:
+                del self._buckets[topic]
+
+    async def _send(self, topic: str, msg, broker: str) -> None:
+        """ Publish a message which took its token. """
+        try:
+            await self.publish(topic, msg, broker)
+            self.sent_count += 1
+        except (OSError, ValueError) as e:
+            self.error_count += 1
+            self.logger.warning(f"publish failed: {e}")
+
+    async def run(self) -> None:
+        """ Publish the pending messages as their buckets allow it. """
+        while True:
+            self._wakeup.clear()
+            wait_ms = IDLE_WAIT_MS
+            while self._ready:
+                await self._send(*self._ready.popleft())
+            for _ in range(len(self._order)):
+                topic = self._order.popleft()
+                delay_ms = self._take_token(topic, ticks_ms())
+                if delay_ms:
+                    self._order.append(topic)
+                    wait_ms = min(wait_ms, delay_ms)
+                    continue
+                msg, broker = self._pending.pop(topic)
+                await self._send(topic, msg, broker)
+            if len(self._buckets) > self.max_topics:
+                self._forget_full_buckets(ticks_ms())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
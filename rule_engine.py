@@ -0,0 +1,335 @@
+"""
+Streaming rules applied to the received mqtt messages.
+
+The rules of the rules settings file are compiled once: their topic
+filters go into a TopicRouter and their payload predicates into a
+comparison function and a constant, so a message costs one walk of the
+topic trie and a comparison per matching rule. A rule is built as
+follows:
+
+    {
+        "topic": "sensors/+/temp",
+        "field": "value",
+        "when": {"op": ">", "value": 30},
+        "action": "republish" | "drop" | "aggregate" | "led_bar",
+        "stop": false,
+        ...the parameters of the action
+    }
+
+- "field" is optional, it selects the key of a decoded dict payload
+  used by the predicate and the actions, without it the payload itself
+  is used (a number or a string).
+- "when" is optional, the predicate of the rule.
+- republish : "to" is the topic to publish the message to, "{topic}" is
+  replaced by the topic of the message.
+- drop : the message does not reach the message store and the handlers.
+- aggregate : "to" receives {"count", "min", "max", "avg"} of the values
+  of every "window_ms" window (if it got at least one value).
+- led_bar : the value, scaled from ["min", "max"], lights the led bar.
+- stop : True to skip the following rules when this one applies.
+
+A republished message comes back to the device if it is subscribed to
+its topic, a rule must not republish to a topic matched by itself.
+"""
+import asyncio
+import json
+
+from device_logging import Logger
+from timing import sleep_ms, ticks_diff, ticks_ms
+from topic_router import TopicRouter
+
+ACTION_REPUBLISH = "republish"
+ACTION_DROP = "drop"
+ACTION_AGGREGATE = "aggregate"
+ACTION_LED_BAR = "led_bar"
+ACTIONS = (ACTION_REPUBLISH, ACTION_DROP, ACTION_AGGREGATE, ACTION_LED_BAR)
+FLUSH_INTERVAL_MS = 500
+
+OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "contains": lambda a, b: b in a,
+}
+
+_MISSING = object()
+
+
+class Rule:
+    """
+    A compiled rule.
+
+    Attributes
+    ----------
+    index : the position of the rule in the settings file.
+    topic_filter : the topic filter of the rule.
+    action : one of ACTIONS.
+    field : the key of the compared value in a dict payload, or None.
+    compare : the predicate operator, None if the rule has no predicate.
+    operand : the constant the value is compared to.
+    stop : True to skip the following rules when this one applies.
+    to : the topic of the republished or aggregated messages.
+    window_ms : the aggregation window.
+    low, high : the values lighting no led and the whole led bar.
+    hit_count : the number of messages the rule applied to.
+    """
+    def __init__(self, index: int, settings: dict) -> None:
+        self.index = index
+        self.topic_filter = settings["topic"]
+        self.action = settings["action"]
+        if self.action not in ACTIONS:
+            raise ValueError(f"unknown rule action {self.action}")
+        when = settings.get("when")
+        self.field = settings.get("field")
+        self.compare = None
+        self.operand = None
+        if when is not None:
+            self.compare = OPERATORS[when.get("op", "==")]
+            self.operand = when["value"]
+        self.stop = settings.get("stop", False)
+        self.to = settings.get("to", "")
+        self.window_ms = settings.get("window_ms", 10000)
+        self.low = settings.get("min", 0)
+        self.high = settings.get("max", 100)
+        self.hit_count = 0
+        self._window_start_ms = ticks_ms()
+        self._reset_window()
+
+    def needs_value(self) -> bool:
+        """ Return True if the rule uses the payload value. """
+        return self.compare is not None or self.action in (
+            ACTION_AGGREGATE, ACTION_LED_BAR
+        )
+
+    def select(self, value):
+        """ Return the value of the rule field, _MISSING if absent. """
+        if self.field is None:
+            return value
+        if isinstance(value, dict):
+            return value.get(self.field, _MISSING)
+        return _MISSING
+
+    def accepts(self, value) -> bool:
+        """ Return True if the predicate holds for a payload value. """
+        if self.compare is None:
+            return True
+        value = self.select(value)
+        if value is _MISSING:
+            return False
+        try:
+            return self.compare(value, self.operand)
+        except TypeError:
+            return False
+
+    def _reset_window(self) -> None:
+        """ Start a new aggregation window. """
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+
+    def aggregate(self, value) -> None:
+        """ Add a number to the current window. """
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def take_window(self, now: int):
+        """
+        Close the current window if it is over.
+
+        Returns
+        -------
+        dict : the statistics of the closed window, None if the window
+        is not over or got no value.
+        """
+        if ticks_diff(now, self._window_start_ms) < self.window_ms:
+            return None
+        self._window_start_ms = now
+        if not self.count:
+            return None
+        stats = {
+            "count": self.count,
+            "min": self.minimum,
+            "max": self.maximum,
+            "avg": self.total / self.count,
+        }
+        self._reset_window()
+        return stats
+
+
+def parse_value(msg):
+    """
+    Return the value of a raw payload: a number if the payload is one,
+    the decoded json if it is json, otherwise the text.
+    """
+    if not isinstance(msg, str):
+        msg = str(msg, "utf-8")
+    try:
+        return float(msg) if "." in msg else int(msg)
+    except ValueError:
+        pass
+    try:
+        return json.loads(msg)
+    except ValueError:
+        return msg
+
+
+class RuleEngine:
+    """
+    Evaluate the compiled rules on the received messages.
+
+    Attributes
+    ----------
+    publish : a callable called as publish(topic, msg) by republish.
+    publish_value : a callable called as publish_value(topic, value) with
+    the statistics of the aggregate rules.
+    set_led_bar : a callable called with the number of leds to light.
+    decode : a callable called as decode(topic, msg) returning the value
+    of a payload, parse_value if None.
+    rules : the compiled rules, in the settings file order.
+    evaluated_count : the number of messages evaluated.
+    dropped_count : the number of messages dropped.
+    error_count : the number of rule actions which failed.
+    """
+    def __init__(
+        self,
+        publish,
+        publish_value,
+        set_led_bar,
+        decode=None
+    ) -> None:
+        self.publish = publish
+        self.publish_value = publish_value
+        self.set_led_bar = set_led_bar
+        self.decode = decode
+        self.rules = []
+        self.evaluated_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+        self.logger = Logger("RULE_ENGINE")
+        self._router = TopicRouter()
+        self._aggregates = []
+        self._task = None
+
+    def load(self, rules: list) -> None:
+        """
+        Compile rules, replacing the previous ones.
+
+        Parameters
+        ----------
+        rules : the rules of the settings file.
+        """
+        self.rules = []
+        self._router = TopicRouter()
+        self._aggregates = []
+        for index, settings in enumerate(rules):
+            rule = Rule(index, settings)
+            self._router.add(rule.topic_filter, rule)
+            self.rules.append(rule)
+            if rule.action == ACTION_AGGREGATE:
+                self._aggregates.append(rule)
+        self.logger.info(f"{len(self.rules)} rules loaded")
+
+    def process(self, topic, msg) -> bool:
+        """
+        Apply the rules matching a message.
+
+        Parameters
+        ----------
+        topic : the topic of the message, as str or bytes.
+        msg : the raw payload.
+
+        Returns
+        -------
+        bool : False if the message has been dropped.
+        """
+        if not self.rules:
+            return True
+        if not isinstance(topic, str):
+            topic = str(topic, "utf-8")
+        matched = self._router.match(topic)
+        if not matched:
+            return True
+        self.evaluated_count += 1
+        if len(matched) > 1:
+            matched.sort(key=lambda rule: rule.index)
+        value = _MISSING
+        keep = True
+        for rule in matched:
+            if value is _MISSING and rule.needs_value():
+                value = self._decode(topic, msg)
+            if not rule.accepts(value):
+                continue
+            rule.hit_count += 1
+            try:
+                keep = self._apply(rule, topic, msg, value) and keep
+            except Exception as e:
+                self.error_count += 1
+                self.logger.warning(f"rule {rule.index} failed: {e}")
+            if rule.stop:
+                break
+        if not keep:
+            self.dropped_count += 1
+        return keep
+
+    def _decode(self, topic: str, msg):
+        """ Return the value of a payload, None if it cannot be decoded. """
+        try:
+            if self.decode is not None:
+                return self.decode(topic, msg)
+            return parse_value(msg)
+        except Exception:
+            return None
+
+    def _apply(self, rule: Rule, topic: str, msg, value) -> bool:
+        """ Run the action of a rule, return False to drop the message. """
+        if rule.action == ACTION_DROP:
+            return False
+        if rule.action == ACTION_REPUBLISH:
+            self.publish(rule.to.replace("{topic}", topic), msg)
+        elif rule.action == ACTION_AGGREGATE:
+            number = rule.select(value)
+            if isinstance(number, (int, float)):
+                self._flush(rule, ticks_ms())
+                rule.aggregate(number)
+        else:
+            number = rule.select(value)
+            if isinstance(number, (int, float)):
+                span = rule.high - rule.low
+                leds = round((number - rule.low) * 10 / span) if span else 0
+                self.set_led_bar(min(10, max(0, leds)))
+        return True
+
+    def _flush(self, rule: Rule, now: int) -> None:
+        """ Publish the statistics of a finished aggregation window. """
+        stats = rule.take_window(now)
+        if stats is not None:
+            self.publish_value(rule.to, stats)
+
+    def flush_all(self) -> None:
+        """ Publish the statistics of every finished window. """
+        now = ticks_ms()
+        for rule in self._aggregates:
+            try:
+                self._flush(rule, now)
+            except (OSError, ValueError) as e:
+                self.error_count += 1
+                self.logger.warning(f"rule {rule.index} failed: {e}")
+
+    def start(self) -> None:
+        """ Start the task closing the idle aggregation windows. """
+        if self._task is None and self._aggregates:
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        """ Close the aggregation windows even without new messages. """
+        while True:
+            await sleep_ms(FLUSH_INTERVAL_MS)
+            self.flush_all()
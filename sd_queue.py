@@ -0,0 +1,322 @@
+"""
+Persistent store and forward queue for the mqtt publications.
+
+The queue is a fixed size ring buffer file on the sd card, the messages
+published while the broker is unreachable are appended to it and
+drained in batches after the reconnection.
+
+Every record is framed as:
+
+    magic (1 byte) | seq (4) | topic length (2) | msg length (2) |
+    crc32 (4) | topic | msg
+
+the crc covers the seq, lengths, topic and msg, so a record torn by a
+reset is detected and ignored. The read and write offsets are kept in a
+small json file rewritten atomically on every commit and discard but
+only every META_SAVE_INTERVAL puts, which spares the sd a file rewrite
+per message: the records appended after its last update are recovered at
+load time by following the sequence numbers.
+"""
+import struct
+from binascii import crc32
+
+from device_logging import Logger
+from storage import atomic_write_json, file_exists, load_json
+from timing import sleep_ms
+
+RECORD_MAGIC = 0xA5
+WRAP_MARKER = 0x5A
+HEADER_FORMAT = "!BIHHI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DRAIN_PAUSE_MS = 20
+BLOCK_SIZE = 512
+META_SAVE_INTERVAL = 16
+
+
+class SdQueue:
+    """
+    Bounded append only ring buffer of (topic, msg) records.
+    When the buffer is full the oldest records are discarded.
+
+    Attributes
+    ----------
+    path : the path of the queue files, without extension.
+    capacity : the size in bytes of the ring buffer file.
+    head : the offset of the oldest record.
+    tail : the offset where the next record is written.
+    count : the number of records in the queue.
+    next_seq : the sequence number of the next record.
+    discarded_count : the number of records overwritten while full.
+    """
+    def __init__(self, path: str, capacity: int = 262144) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.head = 0
+        self.tail = 0
+        self.count = 0
+        self.next_seq = 0
+        self.discarded_count = 0
+        self.logger = Logger("SD_QUEUE")
+        self._unsaved_puts = 0
+        self._data_path = f"{path}.bin"
+        self._meta_path = f"{path}.json"
+        self._open()
+
+    def _open(self) -> None:
+        """ Create the ring buffer file or reload its state. """
+        if not file_exists(self._data_path):
+            self._preallocate()
+            self._save_meta()
+            return
+        meta = load_json(self._meta_path, {})
+        self.head = meta.get("head", 0)
+        self.tail = meta.get("tail", 0)
+        self.count = meta.get("count", 0)
+        self.next_seq = meta.get("next_seq", 0)
+        recovered = self._recover()
+        if recovered:
+            self.logger.info(f"recovered {recovered} records")
+            self._save_meta()
+
+    def _preallocate(self) -> None:
+        """ Write the whole ring buffer file once, a block at a time. """
+        block = bytes(BLOCK_SIZE)
+        with open(self._data_path, "wb") as data_file:
+            for offset in range(0, self.capacity, BLOCK_SIZE):
+                data_file.write(
+                    block[:min(BLOCK_SIZE, self.capacity - offset)]
+                )
+
+    def _save_meta(self) -> None:
+        """ Persist the offsets of the ring buffer. """
+        self._unsaved_puts = 0
+        atomic_write_json(
+            self._meta_path,
+            {
+                "head": self.head,
+                "tail": self.tail,
+                "count": self.count,
+                "next_seq": self.next_seq,
+            }
+        )
+
+    def _recover(self) -> int:
+        """
+        Follow the records written after the last meta update.
+
+        Returns
+        -------
+        int : the number of recovered records.
+        """
+        recovered = 0
+        with open(self._data_path, "rb") as data_file:
+            while True:
+                offset = self._normalize_offset(data_file, self.tail)
+                record = self._read_record(data_file, offset)
+                if record is None or record[0] != self.next_seq:
+                    return recovered
+                self.tail = offset + record[3]
+                self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+                self.count += 1
+                recovered += 1
+
+    def _normalize_offset(self, data_file, offset: int) -> int:
+        """ Return 0 if offset points past the end or to a wrap marker. """
+        if offset + HEADER_SIZE > self.capacity:
+            return 0
+        data_file.seek(offset)
+        marker = data_file.read(1)
+        if not marker or marker[0] == WRAP_MARKER:
+            return 0
+        return offset
+
+    def _read_record(self, data_file, offset: int):
+        """
+        Read and validate the record at offset.
+
+        Returns
+        -------
+        tuple : (seq, topic, msg, size) or None if the record is invalid.
+        """
+        data_file.seek(offset)
+        header = data_file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            return None
+        magic, seq, topic_len, msg_len, crc = struct.unpack(
+            HEADER_FORMAT, header
+        )
+        size = HEADER_SIZE + topic_len + msg_len
+        if magic != RECORD_MAGIC or offset + size > self.capacity:
+            return None
+        body = data_file.read(topic_len + msg_len)
+        if crc32(body, crc32(header[1:9])) != crc:
+            return None
+        return seq, body[:topic_len], body[topic_len:], size
+
+    def _fits(self, size: int) -> bool:
+        """ Return True if size bytes can be written at tail. """
+        if not self.count:
+            return True
+        if self.tail > self.head:
+            return self.tail + size <= self.capacity or size <= self.head
+        return self.tail + size <= self.head
+
+    def _discard_oldest(self, data_file) -> None:
+        """ Drop the record at head to make room for a new one. """
+        self.head = self._normalize_offset(data_file, self.head)
+        record = self._read_record(data_file, self.head)
+        self.count -= 1
+        self.discarded_count += 1
+        if record is None or not self.count:
+            self.head = self.tail = self.count = 0
+            return
+        self.head += record[3]
+
+    def put(self, topic, msg) -> None:
+        """
+        Append a message to the queue.
+
+        Parameters
+        ----------
+        topic : the topic of the message.
+        msg : the message.
+        """
+        topic = topic.encode() if isinstance(topic, str) else bytes(topic)
+        msg = msg.encode() if isinstance(msg, str) else bytes(msg)
+        size = HEADER_SIZE + len(topic) + len(msg)
+        if size > self.capacity // 2:
+            raise ValueError("message too big for the queue")
+        lengths = struct.pack("!IHH", self.next_seq, len(topic), len(msg))
+        crc = crc32(msg, crc32(topic, crc32(lengths)))
+        with open(self._data_path, "r+b") as data_file:
+            if not self._fits(size):
+                while not self._fits(size):
+                    self._discard_oldest(data_file)
+                self._save_meta()
+            if not self.count:
+                self.head = self.tail = 0
+            if self.tail + size > self.capacity:
+                if self.tail < self.capacity:
+                    data_file.seek(self.tail)
+                    data_file.write(bytes([WRAP_MARKER]))
+                self.tail = 0
+            data_file.seek(self.tail)
+            data_file.write(
+                struct.pack(
+                    HEADER_FORMAT,
+                    RECORD_MAGIC,
+                    self.next_seq,
+                    len(topic),
+                    len(msg),
+                    crc
+                )
+            )
+            data_file.write(topic)
+            data_file.write(msg)
+        self.tail += size
+        self.count += 1
+        self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+        self._unsaved_puts += 1
+        if self._unsaved_puts >= META_SAVE_INTERVAL:
+            self._save_meta()
+
+    def peek(self, max_records: int) -> list:
+        """
+        Read the oldest records without removing them.
+
+        Parameters
+        ----------
+        max_records : the maximum number of records to read.
+
+        Returns
+        -------
+        list : a list of (topic, msg, next_head) tuples, next_head is the
+        offset of the record following each one.
+        """
+        records = []
+        offset = self.head
+        with open(self._data_path, "rb") as data_file:
+            while len(records) < min(max_records, self.count):
+                offset = self._normalize_offset(data_file, offset)
+                record = self._read_record(data_file, offset)
+                if record is None:
+                    self.logger.error(f"corrupted record at {offset}")
+                    break
+                offset += record[3]
+                records.append((record[1], record[2], offset))
+        return records
+
+    def commit(self, consumed: int, next_head: int) -> None:
+        """
+        Remove the records returned by peek once they have been sent.
+
+        Parameters
+        ----------
+        consumed : the number of records to remove.
+        next_head : the next_head of the last removed record.
+        """
+        self.count -= consumed
+        self.head = next_head
+        if not self.count:
+            self.head = self.tail = 0
+        self._save_meta()
+
+    async def drain(
+        self,
+        publish,
+        batch_size: int = 32,
+        acked=None
+    ) -> int:
+        """
+        Publish the queued messages in batches, yielding to the other tasks
+        between two batches so the menu stays responsive.
+        The draining stops at the first failing publish, the unsent records
+        stay in the queue.
+
+        Parameters
+        ----------
+        publish : a coroutine function called as publish(topic, msg).
+        batch_size : the number of records read from the sd at once.
+        acked : an optional coroutine function called as acked(records)
+        after the publishes of a batch, records being the (topic, msg,
+        next_head) tuples of peek, returning True once the broker
+        acknowledged them and False if it cannot. The batch is only
+        removed from the queue once acknowledged, a reset or a
+        disconnection before that sends it again (at least once
+        delivery).
+
+        Returns
+        -------
+        int : the number of drained records.
+        """
+        drained = 0
+        while self.count:
+            records = self.peek(batch_size)
+            if not records:
+                self.logger.error("dropping the unreadable queue content")
+                self.commit(self.count, 0)
+                break
+            sent = 0
+            try:
+                for topic, msg, next_head in records:
+                    await publish(topic, msg)
+                    sent += 1
+            except OSError as e:
+                if acked is None:
+                    raise
+                # the published part is still acknowledged or withdrawn
+                self.logger.warning(f"drain stopped: {e}")
+            finally:
+                if sent and acked is None:
+                    self.commit(sent, records[sent - 1][2])
+                    drained += sent
+            if acked is not None:
+                if not sent or not await acked(records[:sent]):
+                    self.logger.warning("batch not acknowledged, kept")
+                    break
+                self.commit(sent, records[sent - 1][2])
+                drained += sent
+                if sent < len(records):
+                    break
+            await sleep_ms(DRAIN_PAUSE_MS)
+        return drained
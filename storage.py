@@ -0,0 +1,57 @@
+""" Crash safe helpers to persist small json documents. """
+import json
+import os
+
+
+def file_exists(path: str) -> bool:
+    """
+    Return True if the path exists.
+
+    Parameters
+    ----------
+    path : the path to check.
+    """
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def atomic_write_json(path: str, data) -> None:
+    """
+    Write data as json so that a reset never leaves a truncated file:
+    the document is written to a temporary file which then replaces
+    the old one.
+
+    Parameters
+    ----------
+    path : the path of the json file.
+    data : the json serializable object to write.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+        json.dump(data, tmp_file)
+    if file_exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def load_json(path: str, default=None):
+    """
+    Load a json file written by atomic_write_json.
+    If a reset happened between the removal of the old file and the
+    rename, the temporary file is the latest complete copy.
+
+    Parameters
+    ----------
+    path : the path of the json file.
+    default : the value returned if no readable copy exists.
+    """
+    for candidate in (path, f"{path}.tmp"):
+        try:
+            with open(candidate, "r", encoding="utf-8") as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            continue
+    return default
@@ -19,4 +19,4 @@ p_man = PagesManager(
 
 p_man.build_menu_from_dict(menu_pages)
 
-p_man.run(recovery_from_exceptions=False)
+p_man.run_async(recovery_from_exceptions=False)
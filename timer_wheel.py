@@ -0,0 +1,145 @@
+"""
+Hashed timer wheel for periodic jobs.
+
+The wheel is a ring of slots, a job due at tick t lives in the slot
+t % slots, so a tick only visits the jobs of one slot whatever the
+number of jobs and their periods. The jobs are rescheduled from their
+previous expiry and not from the time they actually ran, a late tick
+never shifts the following ones.
+"""
+from device_logging import Logger
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms
+
+CATCH_UP_YIELD_EVERY = 16
+
+
+class TimerJob:
+    """
+    A periodic job of the wheel.
+
+    Attributes
+    ----------
+    callback : the callable called, without arguments, at every expiry.
+    period_ticks : the period of the job in ticks.
+    expiry_tick : the tick of the next expiry.
+    fired_count : the number of times the job ran.
+    cancelled : True once the job has been cancelled.
+    """
+    def __init__(
+        self,
+        callback,
+        period_ticks: int,
+        expiry_tick: int
+    ) -> None:
+        self.callback = callback
+        self.period_ticks = period_ticks
+        self.expiry_tick = expiry_tick
+        self.fired_count = 0
+        self.cancelled = False
+
+
+class TimerWheel:
+    """
+    Periodic jobs scheduler driven by a single task.
+
+    Attributes
+    ----------
+    tick_ms : the duration of a tick, the periods resolution.
+    tick_count : the number of ticks elapsed since the creation.
+    jobs_count : the number of scheduled jobs.
+    late_ticks : the number of ticks processed late to catch up.
+    """
+    def __init__(self, slots: int = 64, tick_ms: int = 100) -> None:
+        self.tick_ms = tick_ms
+        self.tick_count = 0
+        self.jobs_count = 0
+        self.late_ticks = 0
+        self.logger = Logger("TIMER_WHEEL")
+        self._slots = [[] for _ in range(slots)]
+
+    def add(self, period_ms: int, callback, delay_ms: int = None) -> TimerJob:
+        """
+        Schedule a periodic job.
+
+        Parameters
+        ----------
+        period_ms : the period, rounded to a whole number of ticks.
+        callback : the callable to call, it must not block.
+        delay_ms : the delay before the first run, a period if None.
+
+        Returns
+        -------
+        TimerJob : the job, to be passed to cancel.
+        """
+        period_ticks = max(1, (period_ms + self.tick_ms // 2) // self.tick_ms)
+        if delay_ms is None:
+            delay_ticks = period_ticks
+        else:
+            delay_ticks = max(1, delay_ms // self.tick_ms)
+        job = TimerJob(callback, period_ticks, self.tick_count + delay_ticks)
+        self._insert(job)
+        self.jobs_count += 1
+        return job
+
+    def cancel(self, job: TimerJob) -> None:
+        """ Cancel a job, it is removed from its slot on its next expiry. """
+        if not job.cancelled:
+            job.cancelled = True
+            self.jobs_count -= 1
+
+    def _insert(self, job: TimerJob) -> None:
+        """ Put a job in the slot of its expiry tick. """
+        self._slots[job.expiry_tick % len(self._slots)].append(job)
+
+    def tick(self, horizon: int = 0) -> None:
+        """
+        Advance the wheel by one tick, running the expired jobs.
+
+        Parameters
+        ----------
+        horizon : the last tick already due when the wheel is catching
+        up, the runs of a job missed before it are skipped so a late
+        job runs once instead of in a burst, keeping its phase.
+        """
+        self.tick_count += 1
+        slot = self._slots[self.tick_count % len(self._slots)]
+        if not slot:
+            return
+        waiting = []
+        expired = []
+        for job in slot:
+            if job.cancelled:
+                continue
+            if job.expiry_tick <= self.tick_count:
+                expired.append(job)
+            else:
+                waiting.append(job)
+        slot[:] = waiting
+        for job in expired:
+            try:
+                job.callback()
+            except Exception as e:
+                self.logger.error(f"job failed: {e}")
+            job.fired_count += 1
+            job.expiry_tick += job.period_ticks
+            horizon = max(horizon, self.tick_count)
+            if job.expiry_tick <= horizon:
+                missed = (horizon - job.expiry_tick) // job.period_ticks + 1
+                job.expiry_tick += missed * job.period_ticks
+            if not job.cancelled:
+                self._insert(job)
+
+    async def run(self) -> None:
+        """ Tick the wheel on absolute deadlines, forever. """
+        deadline = ticks_ms()
+        while True:
+            deadline = ticks_add(deadline, self.tick_ms)
+            wait_ms = ticks_diff(deadline, ticks_ms())
+            if wait_ms > 0:
+                await sleep_ms(wait_ms)
+                self.tick()
+                continue
+            self.late_ticks += 1
+            if self.late_ticks % CATCH_UP_YIELD_EVERY == 0:
+                await sleep_ms(0)
+            self.tick(self.tick_count + 1 + (-wait_ms) // self.tick_ms)
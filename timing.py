@@ -0,0 +1,41 @@
+"""
+Monotonic clock helpers shared by the asyncio based modules.
+
+MicroPython exposes the wrapping ticks_* functions in the time module,
+plain CPython (used to run the benchmarks on a workstation) does not,
+so they are rebuilt here on top of time.monotonic_ns.
+"""
+import asyncio
+
+try:
+    from time import ticks_add, ticks_diff, ticks_ms, ticks_us
+except ImportError:
+    from time import monotonic_ns
+
+    TICKS_PERIOD = 1 << 30
+    TICKS_HALF_PERIOD = TICKS_PERIOD >> 1
+
+    def ticks_ms() -> int:
+        """ Return the milliseconds counter. """
+        return (monotonic_ns() // 1000000) & (TICKS_PERIOD - 1)
+
+    def ticks_us() -> int:
+        """ Return the microseconds counter. """
+        return (monotonic_ns() // 1000) & (TICKS_PERIOD - 1)
+
+    def ticks_add(ticks: int, delta: int) -> int:
+        """ Offset a ticks value by delta, wrapping around. """
+        return (ticks + delta) & (TICKS_PERIOD - 1)
+
+    def ticks_diff(ticks_1: int, ticks_2: int) -> int:
+        """ Return the signed difference ticks_1 - ticks_2. """
+        diff = (ticks_1 - ticks_2) & (TICKS_PERIOD - 1)
+        return diff - TICKS_PERIOD if diff >= TICKS_HALF_PERIOD else diff
+
+
+if hasattr(asyncio, "sleep_ms"):
+    sleep_ms = asyncio.sleep_ms
+else:
+    async def sleep_ms(ms: int) -> None:
+        """ Sleep for ms milliseconds, yielding to the event loop. """
+        await asyncio.sleep(ms / 1000)
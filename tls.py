@@ -0,0 +1,171 @@
+"""
+TLS settings of the mqtt connections.
+
+The SSL context is created on the first connection and reused by every
+reconnection: loading the certificates is done once. Where the ssl
+module exposes the TLS sessions (CPython, ssl.SSLSession) the session of
+the last connection is offered on the next handshake, so the broker can
+resume it and skip the key exchange. The MicroPython ssl module does not
+expose the sessions, there only the context is reused.
+"""
+import ssl
+
+from device_logging import Logger
+
+RESUMPTION_SUPPORTED = hasattr(ssl, "SSLSession")
+
+
+if RESUMPTION_SUPPORTED:
+    class _ResumingContext(ssl.SSLContext):
+        """ SSL context offering its last session to the new connections. """
+        resume_session = None
+
+        def wrap_bio(
+            self,
+            incoming,
+            outgoing,
+            server_side=False,
+            server_hostname=None,
+            session=None
+        ):
+            if session is None and not server_side:
+                session = self.resume_session
+            return super().wrap_bio(
+                incoming, outgoing, server_side, server_hostname, session
+            )
+
+
+class TlsContext:
+    """
+    The cached SSL context and TLS session of a broker connection.
+
+    Attributes
+    ----------
+    ca_file : the path of the CA certificates, None to skip the server
+    certificate verification.
+    cert_file : the path of the client certificate, None for none.
+    key_file : the path of the client certificate key.
+    server_hostname : the name checked against the server certificate,
+    None to use the broker address.
+    resumption : True to resume the previous TLS session if possible.
+    full_count : the number of full handshakes.
+    resumed_count : the number of resumed handshakes.
+    last_full_ms : the connection time of the last full handshake.
+    last_resumed_ms : the connection time of the last resumed handshake.
+    """
+    def __init__(
+        self,
+        ca_file: str = None,
+        cert_file: str = None,
+        key_file: str = None,
+        server_hostname: str = None,
+        resumption: bool = True
+    ) -> None:
+        self.ca_file = ca_file
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.server_hostname = server_hostname
+        self.resumption = resumption and RESUMPTION_SUPPORTED
+        self.full_count = 0
+        self.resumed_count = 0
+        self.last_full_ms = 0
+        self.last_resumed_ms = 0
+        self.logger = Logger("TLS")
+        self._context = None
+
+    def context(self):
+        """ Return the SSL context, creating it on the first call. """
+        if self._context is None:
+            self._context = self._create_context()
+        return self._context
+
+    def _create_context(self):
+        """ Build the SSL context and load its certificates. """
+        if self.resumption:
+            context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if self.ca_file is None:
+            if hasattr(context, "check_hostname"):
+                context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(cafile=self.ca_file)
+        if self.cert_file is not None:
+            context.load_cert_chain(self.cert_file, self.key_file)
+        return context
+
+    def connection_options(self, server: str) -> dict:
+        """
+        Return the TLS options of asyncio.open_connection.
+
+        Parameters
+        ----------
+        server : the broker address, the default server hostname.
+        """
+        return {
+            "ssl": self.context(),
+            "server_hostname": self.server_hostname or server,
+        }
+
+    def handshake_done(self, writer, elapsed_ms: int) -> bool:
+        """
+        Account a completed connection.
+
+        Parameters
+        ----------
+        writer : the stream writer of the connection.
+        elapsed_ms : the time spent opening the connection, tcp and tls
+        handshakes included.
+
+        Returns
+        -------
+        bool : True if the TLS session has been resumed.
+        """
+        ssl_object = self._ssl_object(writer)
+        resumed = bool(getattr(ssl_object, "session_reused", False))
+        if resumed:
+            self.resumed_count += 1
+            self.last_resumed_ms = elapsed_ms
+        else:
+            self.full_count += 1
+            self.last_full_ms = elapsed_ms
+        self.logger.info(
+            f"{'resumed' if resumed else 'full'} tls handshake "
+            f"in {elapsed_ms} ms"
+        )
+        return resumed
+
+    def remember_session(self, writer) -> None:
+        """
+        Keep the TLS session of a connection for the next handshake,
+        called once data has been received since TLS 1.3 delivers the
+        session tickets after the handshake.
+        """
+        if not self.resumption or writer is None:
+            return
+        session = getattr(self._ssl_object(writer), "session", None)
+        if session is not None:
+            self.context().resume_session = session
+
+    def forget_session(self) -> None:
+        """ Make the next connection perform a full handshake. """
+        if self._context is not None and self.resumption:
+            self._context.resume_session = None
+
+    def _ssl_object(self, writer):
+        """ Return the ssl object of a stream writer, None if unknown. """
+        try:
+            return writer.get_extra_info("ssl_object")
+        except (AttributeError, KeyError):
+            return None
+
+    def status_lines(self) -> list:
+        """ Return the handshake counters for the status page. """
+        return [
+            f"tls full: {self.full_count}",
+            f"in {self.last_full_ms} ms",
+            f"tls resumed: {self.resumed_count}",
+            f"in {self.last_resumed_ms} ms",
+        ]
@@ -0,0 +1,163 @@
+"""
+Route the received mqtt messages to the registered handlers.
+
+The topic filters are stored in a trie with one level per topic level,
+matching a topic walks the trie once, so the cost depends on the topic
+depth and not on the number of registered handlers.
+"""
+from device_logging import Logger
+
+SINGLE_LEVEL_WILDCARD = "+"
+MULTI_LEVEL_WILDCARD = "#"
+
+
+class _TopicNode:
+    """ A level of the topic trie. """
+    def __init__(self) -> None:
+        self.children = {}
+        self.handlers = []
+
+
+def validate_topic_filter(topic_filter: str) -> list:
+    """
+    Check the wildcards placement of a topic filter.
+
+    Parameters
+    ----------
+    topic_filter : the topic filter, e.g. "sensors/+/temperature".
+
+    Returns
+    -------
+    list : the levels of the topic filter.
+    """
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if MULTI_LEVEL_WILDCARD in level and (
+            level != MULTI_LEVEL_WILDCARD or i != len(levels) - 1
+        ):
+            raise ValueError(f"bad '#' position in {topic_filter}")
+        if SINGLE_LEVEL_WILDCARD in level and level != SINGLE_LEVEL_WILDCARD:
+            raise ValueError(f"bad '+' position in {topic_filter}")
+    return levels
+
+
+class TopicRouter:
+    """
+    Topic trie mapping topic filters to message handlers.
+    A handler is called as handler(topic, msg) where topic is a str and
+    msg is the raw payload.
+    """
+    def __init__(self) -> None:
+        self._root = _TopicNode()
+        self.handlers_count = 0
+        self.logger = Logger("TOPIC_ROUTER")
+
+    def add(self, topic_filter: str, handler) -> None:
+        """
+        Register a handler for a topic filter.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter, it can contain '+' and '#'.
+        handler : the callable to call for the matching messages.
+        """
+        node = self._root
+        for level in validate_topic_filter(topic_filter):
+            child = node.children.get(level)
+            if child is None:
+                child = _TopicNode()
+                node.children[level] = child
+            node = child
+        node.handlers.append(handler)
+        self.handlers_count += 1
+
+    def remove(self, topic_filter: str, handler=None) -> None:
+        """
+        Unregister the handlers of a topic filter.
+
+        Parameters
+        ----------
+        topic_filter : the topic filter used at registration time.
+        handler : the handler to remove, if None all the handlers
+        of the topic filter are removed.
+        """
+        path = [self._root]
+        levels = validate_topic_filter(topic_filter)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        node = path[-1]
+        removed = [
+            h for h in node.handlers if handler is None or h == handler
+        ]
+        node.handlers = [h for h in node.handlers if h not in removed]
+        self.handlers_count -= len(removed)
+        for i in range(len(levels), 0, -1):
+            if path[i].handlers or path[i].children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, topic: str) -> list:
+        """
+        Return the handlers whose topic filter matches topic.
+
+        Parameters
+        ----------
+        topic : the topic of a received message (no wildcards).
+        """
+        levels = topic.split("/")
+        matched = []
+        self._match(self._root, levels, 0, matched)
+        return matched
+
+    def _match(
+        self,
+        node: _TopicNode,
+        levels: list,
+        depth: int,
+        matched: list
+    ) -> None:
+        """ Walk the trie collecting the handlers matching levels. """
+        # topics starting with '$' are not matched by a leading wildcard
+        wildcards_allowed = depth or not levels[0].startswith("$")
+        if wildcards_allowed:
+            multi_level = node.children.get(MULTI_LEVEL_WILDCARD)
+            if multi_level is not None:
+                matched.extend(multi_level.handlers)
+        if depth == len(levels):
+            matched.extend(node.handlers)
+            return
+        exact = node.children.get(levels[depth])
+        if exact is not None:
+            self._match(exact, levels, depth + 1, matched)
+        if wildcards_allowed:
+            single_level = node.children.get(SINGLE_LEVEL_WILDCARD)
+            if single_level is not None:
+                self._match(single_level, levels, depth + 1, matched)
+
+    def dispatch(self, topic, msg) -> int:
+        """
+        Call the handlers matching topic.
+
+        Parameters
+        ----------
+        topic : the topic of the message, as str or bytes.
+        msg : the payload of the message.
+
+        Returns
+        -------
+        int : the number of called handlers.
+        """
+        if not isinstance(topic, str):
+            topic = topic.decode("utf-8")
+        handlers = self.match(topic)
+        for handler in handlers:
+            # a failing handler must not starve the next ones nor the
+            # receive loop calling dispatch
+            try:
+                handler(topic, msg)
+            except Exception as e:
+                self.logger.error(f"handler failed on {topic}: {e}")
+        return len(handlers)
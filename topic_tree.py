@@ -0,0 +1,225 @@
+"""
+Live tree of the topics seen on a broker.
+
+Every received message is accounted to the nodes of its topic levels:
+a node counts the messages and bytes of its whole branch, so the busy
+devices of a broker stand out at the top of the tree. The tree holds at
+most max_nodes nodes, when a new topic does not fit the branches not
+seen for the longest time are pruned first.
+"""
+from timing import ticks_diff, ticks_ms
+
+RATE_WINDOW_MS = 2000
+PRUNE_TO_FRACTION = 0.875
+
+
+class TopicNode:
+    """
+    A topic level of the tree.
+
+    Attributes
+    ----------
+    name : the topic level, as bytes.
+    parent : the parent node, None for the root.
+    children : a dict containing the child nodes by topic level.
+    depth : the number of levels above the node.
+    msg_count : the number of messages received on the branch.
+    byte_count : the number of payload bytes received on the branch.
+    last_seen_ms : the ticks_ms of the last message of the branch.
+    msg_rate : the messages per second of the last rate window.
+    byte_rate : the bytes per second of the last rate window.
+    """
+    def __init__(self, name: bytes, parent=None, now: int = 0) -> None:
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.msg_count = 0
+        self.byte_count = 0
+        self.last_seen_ms = now
+        self.msg_rate = 0
+        self.byte_rate = 0
+        self._window_start_ms = now
+        self._window_msgs = 0
+        self._window_bytes = 0
+
+    def account(self, size: int, now: int) -> None:
+        """ Count a message of size bytes received at now. """
+        self.msg_count += 1
+        self.byte_count += size
+        self.last_seen_ms = now
+        self._window_msgs += 1
+        self._window_bytes += size
+        elapsed = ticks_diff(now, self._window_start_ms)
+        if elapsed >= RATE_WINDOW_MS:
+            self.msg_rate = self._window_msgs * 1000 // elapsed
+            self.byte_rate = self._window_bytes * 1000 // elapsed
+            self._window_start_ms = now
+            self._window_msgs = 0
+            self._window_bytes = 0
+
+    def rates(self, now: int) -> tuple:
+        """
+        Return the (msg_rate, byte_rate) of the node, both 0 once the
+        branch has been silent for a whole rate window.
+        """
+        if ticks_diff(now, self.last_seen_ms) > RATE_WINDOW_MS:
+            return 0, 0
+        return self.msg_rate, self.byte_rate
+
+    def path(self) -> list:
+        """ Return the topic levels from the root to the node. """
+        levels = []
+        node = self
+        while node.parent is not None:
+            levels.append(node.name)
+            node = node.parent
+        levels.reverse()
+        return levels
+
+
+class TopicTree:
+    """
+    Bounded tree of the received topics.
+
+    Attributes
+    ----------
+    max_nodes : the maximum number of nodes, the root excluded.
+    name_size : the maximum length of a topic level, the longer ones
+    are truncated (and share a node).
+    root : the root node, accounting every message.
+    node_count : the number of nodes, the root excluded.
+    pruned_count : the number of nodes pruned to keep the budget.
+    overflow_count : the number of messages accounted to an ancestor
+    because their levels did not fit the budget.
+    """
+    def __init__(self, max_nodes: int = 128, name_size: int = 24) -> None:
+        self.max_nodes = max_nodes
+        self.name_size = name_size
+        self.root = TopicNode(b"", now=ticks_ms())
+        self.node_count = 0
+        self.pruned_count = 0
+        self.overflow_count = 0
+
+    def record(self, topic, msg) -> None:
+        """
+        Account a received message, the signature of a message handler.
+
+        Parameters
+        ----------
+        topic : the topic, as bytes or str.
+        msg : the payload.
+        """
+        if isinstance(topic, str):
+            topic = topic.encode("utf-8")
+        now = ticks_ms()
+        size = len(msg)
+        node = self.root
+        node.account(size, now)
+        for level in topic.split(b"/"):
+            level = level[:self.name_size]
+            child = node.children.get(level)
+            if child is None:
+                child = self._add_child(node, level, now)
+                if child is None:
+                    self.overflow_count += 1
+                    return
+            child.account(size, now)
+            node = child
+
+    def _add_child(self, parent: TopicNode, name: bytes, now: int):
+        """
+        Create a node, pruning the coldest branches if the budget is
+        used up.
+
+        Returns
+        -------
+        TopicNode : the new node, None if no branch could be pruned.
+        """
+        if self.node_count >= self.max_nodes:
+            self.prune(int(self.max_nodes * PRUNE_TO_FRACTION), parent, now)
+            if self.node_count >= self.max_nodes:
+                return None
+        child = TopicNode(name, parent, now)
+        parent.children[name] = child
+        self.node_count += 1
+        return child
+
+    def prune(
+        self,
+        target: int,
+        keep: TopicNode = None,
+        now: int = None
+    ) -> None:
+        """
+        Remove the branches not seen for the longest time until the tree
+        holds at most target nodes.
+
+        Parameters
+        ----------
+        target : the number of nodes to keep.
+        keep : a node whose ancestors, itself included, are not pruned.
+        now : the current ticks_ms.
+        """
+        if now is None:
+            now = ticks_ms()
+        protected = []
+        while keep is not None:
+            protected.append(keep)
+            keep = keep.parent
+        candidates = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for child in node.children.values():
+                stack.append(child)
+                candidates.append(
+                    (-ticks_diff(now, child.last_seen_ms), -child.depth, child)
+                )
+        # oldest first, deepest first among equals: a descendant is always
+        # met before its ancestor, which is never older than it
+        candidates.sort(key=lambda candidate: candidate[:2])
+        for _, _, node in candidates:
+            if self.node_count <= target:
+                break
+            if node in protected or node.parent is None:
+                continue
+            del node.parent.children[node.name]
+            node.parent = None
+            removed = self._count(node)
+            self.node_count -= removed
+            self.pruned_count += removed
+
+    def _count(self, node: TopicNode) -> int:
+        """ Return the number of nodes of a branch. """
+        count = 1
+        for child in node.children.values():
+            count += self._count(child)
+        return count
+
+    def find(self, path: list):
+        """
+        Return the node of a path of topic levels, None if it has been
+        pruned.
+        """
+        node = self.root
+        for level in path:
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node
+
+    def busiest_children(self, node: TopicNode, now: int = None) -> list:
+        """ Return the children of a node, the highest byte rate first. """
+        if now is None:
+            now = ticks_ms()
+        return sorted(
+            node.children.values(),
+            key=lambda child: (child.rates(now)[1], child.byte_count),
+            reverse=True
+        )
+
+    def clear(self) -> None:
+        """ Remove every node. """
+        self.root = TopicNode(b"", now=ticks_ms())
+        self.node_count = 0
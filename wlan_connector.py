@@ -0,0 +1,289 @@
+"""
+Non-blocking wireless connection state machine.
+
+At boot the last network the device was connected to is joined right
+away with the bssid and channel it had, which skips the scan of every
+channel; only if that fails are the networks scanned and the known ones
+tried in turn, in the order ranked by the CredentialStore which is told
+the outcome of every attempt. wlan.connect does not wait for the link,
+the state machine is advanced by a task polling wlan.status, so the menu
+never waits for the wireless connection.
+
+    idle -> fast connect -> connected
+                 |              |  (link lost)
+                 v              v
+            scanning  ->  connecting -> connected
+                 ^              |
+                 |              v
+                 +---------  failed  (retried after retry_ms)
+"""
+import asyncio
+import binascii
+
+import network
+
+from device_logging import Logger
+from storage import atomic_write_json, load_json
+from timing import sleep_ms, ticks_add, ticks_diff, ticks_ms
+
+STATE_IDLE = "idle"
+STATE_FAST_CONNECT = "fast connect"
+STATE_SCANNING = "scanning"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_FAILED = "failed"
+STAT_GOT_IP = getattr(network, "STAT_GOT_IP", 3)
+STEP_INTERVAL_MS = 100
+
+
+class WlanConnector:
+    """
+    Connect the station interface without blocking.
+
+    Attributes
+    ----------
+    wlan : the station interface.
+    credentials : the CredentialStore of the known networks.
+    hints_path : the path of the file caching the last good network.
+    fast_timeout_ms : the time given to the fast reconnection.
+    connect_timeout_ms : the time given to a connection after a scan.
+    retry_ms : the time before scanning again once every known network
+    failed.
+    on_connected : an optional callable called as on_connected(ssid,
+    password) once a connection got an ip address.
+    state : the current state, one of the STATE_* constants.
+    ssid : the ssid of the network being joined or joined.
+    connect_ms : the time the last connection took, from connect to the
+    ip address.
+    """
+    def __init__(
+        self,
+        wlan,
+        credentials,
+        hints_path: str,
+        fast_timeout_ms: int = 5000,
+        connect_timeout_ms: int = 15000,
+        retry_ms: int = 30000,
+        on_connected=None
+    ) -> None:
+        self.wlan = wlan
+        self.credentials = credentials
+        self.hints_path = hints_path
+        self.fast_timeout_ms = fast_timeout_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.retry_ms = retry_ms
+        self.on_connected = on_connected
+        self.state = STATE_IDLE
+        self.ssid = ""
+        self.connect_ms = 0
+        self.logger = Logger("WLAN_CONNECTOR")
+        self._password = ""
+        self._save = False
+        self._candidates = []
+        self._scan_results = {}
+        self._started_at = 0
+        self._deadline = 0
+        self._task = None
+
+    def start(self) -> None:
+        """
+        Start joining the last good network, or scanning if there is
+        none, and start the task advancing the state machine.
+        """
+        hints = load_json(self.hints_path)
+        password = None
+        if hints:
+            password = self.credentials.password(hints.get("ssid"))
+        if password is not None:
+            self._join(
+                STATE_FAST_CONNECT,
+                hints["ssid"],
+                password,
+                self.fast_timeout_ms,
+                hints.get("bssid"),
+                hints.get("channel")
+            )
+        else:
+            self.state = STATE_SCANNING
+        if self._task is None:
+            # queued until the menu starts the event loop
+            self._task = asyncio.create_task(self.run())
+
+    def connect(self, ssid: str, password: str, save: bool = False) -> None:
+        """
+        Join a network chosen by the user.
+
+        Parameters
+        ----------
+        ssid : the network ssid.
+        password : the network password.
+        save : True to add the network to the credentials once joined.
+        """
+        hint = self._scan_results.get(ssid, (None, None, 0))
+        self._candidates = []
+        self._join(
+            STATE_CONNECTING,
+            ssid,
+            password,
+            self.connect_timeout_ms,
+            hint[0],
+            hint[1],
+            save
+        )
+
+    def disconnect(self) -> None:
+        """ Leave the network and stay idle until the next connect. """
+        self.state = STATE_IDLE
+        self._candidates = []
+        self.wlan.disconnect()
+
+    def remember_scan(self, output: list) -> None:
+        """
+        Keep the bssid, channel and rssi of the networks of a wlan.scan
+        output, used as hints when joining them.
+        """
+        self._scan_results = {}
+        for entry in output:
+            ssid = entry[0].decode("utf-8")
+            known = self._scan_results.get(ssid)
+            # the strongest access point of each ssid
+            if known is None or entry[3] > known[2]:
+                self._scan_results[ssid] = (
+                    binascii.hexlify(entry[1]).decode(), entry[2], entry[3]
+                )
+
+    def _update_credentials(self, success: bool) -> None:
+        """ Save the outcome of the attempt to join self.ssid. """
+        try:
+            if success and self._save:
+                self.credentials.add(self.ssid, self._password)
+            self.credentials.record(self.ssid, success)
+        except OSError as e:
+            self.logger.warning(f"credentials not saved: {e}")
+
+    def _join(
+        self,
+        state: str,
+        ssid: str,
+        password: str,
+        timeout_ms: int,
+        bssid: str = None,
+        channel: int = None,
+        save: bool = False
+    ) -> None:
+        """ Start joining a network, without waiting for the link. """
+        self.state = state
+        self.ssid = ssid
+        self._password = password
+        self._save = save
+        self._started_at = ticks_ms()
+        self._deadline = ticks_add(self._started_at, timeout_ms)
+        self.logger.info(f"{state}: joining {ssid}")
+        hints = {}
+        if bssid:
+            hints["bssid"] = binascii.unhexlify(bssid)
+        if channel:
+            hints["channel"] = channel
+        try:
+            self.wlan.connect(ssid, password, **hints)
+        except TypeError:
+            # this port does not take the hints
+            self.wlan.connect(ssid, password)
+        except OSError as e:
+            self.logger.error(f"cannot join {ssid}: {e}")
+
+    def step(self) -> None:
+        """ Advance the state machine, never blocks but to scan. """
+        if self.state == STATE_CONNECTED:
+            if not self.wlan.isconnected():
+                self.logger.warning(f"link to {self.ssid} lost")
+                self.start()
+        elif self.state in (STATE_FAST_CONNECT, STATE_CONNECTING):
+            status = self.wlan.status()
+            if status == STAT_GOT_IP:
+                self._connected()
+            elif status < 0 or ticks_diff(ticks_ms(), self._deadline) >= 0:
+                self.logger.warning(
+                    f"joining {self.ssid} failed, status {status}"
+                )
+                self.wlan.disconnect()
+                self._update_credentials(False)
+                self._next_candidate()
+        elif self.state == STATE_SCANNING:
+            self._scan()
+        elif self.state == STATE_FAILED:
+            if ticks_diff(ticks_ms(), self._deadline) >= 0:
+                self.state = STATE_SCANNING
+
+    def _connected(self) -> None:
+        """ Account a successful connection and cache its hints. """
+        self.state = STATE_CONNECTED
+        self.connect_ms = ticks_diff(ticks_ms(), self._started_at)
+        self.logger.info(f"connected to {self.ssid} in {self.connect_ms} ms")
+        hint = self._scan_results.get(self.ssid)
+        hints = {"ssid": self.ssid}
+        if hint is not None:
+            hints["bssid"], hints["channel"] = hint[0], hint[1]
+        else:
+            previous = load_json(self.hints_path)
+            if previous and previous.get("ssid") == self.ssid:
+                hints = previous
+        try:
+            atomic_write_json(self.hints_path, hints)
+        except OSError as e:
+            self.logger.warning(f"connection hints not saved: {e}")
+        self._update_credentials(True)
+        if self.on_connected is not None:
+            self.on_connected(self.ssid, self._password)
+
+    def _scan(self) -> None:
+        """ Scan and queue the visible known networks, best first. """
+        if not self.credentials.networks:
+            # nothing to join until the user connects a network
+            self.state = STATE_IDLE
+            return
+        try:
+            self.remember_scan(self.wlan.scan())
+        except OSError as e:
+            self.logger.error(f"scan failed: {e}")
+            self._fail()
+            return
+        self._candidates = self.credentials.rank(
+            (ssid, hint[2]) for ssid, hint in self._scan_results.items()
+        )
+        self.logger.debug(f"known networks visible: {self._candidates}")
+        self._next_candidate()
+
+    def _next_candidate(self) -> None:
+        """ Join the next candidate network, scan or fail if none left. """
+        if self.state == STATE_FAST_CONNECT:
+            self.state = STATE_SCANNING
+            return
+        if not self._candidates:
+            self._fail()
+            return
+        ssid = self._candidates.pop(0)
+        hint = self._scan_results[ssid]
+        self._join(
+            STATE_CONNECTING,
+            ssid,
+            self.credentials.password(ssid),
+            self.connect_timeout_ms,
+            hint[0],
+            hint[1]
+        )
+
+    def _fail(self) -> None:
+        """ Wait retry_ms before scanning again. """
+        self.state = STATE_FAILED
+        self._deadline = ticks_add(ticks_ms(), self.retry_ms)
+        self.logger.warning("no known network joined")
+
+    async def run(self) -> None:
+        """ Advance the state machine every STEP_INTERVAL_MS. """
+        while True:
+            try:
+                self.step()
+            except OSError as e:
+                self.logger.error(f"wlan step failed: {e}")
+            await sleep_ms(STEP_INTERVAL_MS)
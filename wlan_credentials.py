@@ -0,0 +1,209 @@
+"""
+Indexed store of the known wireless networks.
+
+The networks are kept in memory in a dict indexed by ssid and written
+back with atomic_write_json after every change but the failed connection
+attempts, which are only counted in memory and written with the next
+save: a network out of range does not rewrite the file at every retry.
+The file is always a single json document:
+
+    {
+        "format": 1,
+        "networks": {
+            "ssid": {
+                "password": "...",
+                "priority": 0,
+                "successes": 3,
+                "failures": 1
+            }
+        }
+    }
+
+The files written by the previous versions, a sequence of {ssid:
+password} objects appended to each other, are migrated on load.
+
+The visible known networks are ranked in a single pass over the scan
+results by
+
+    priority * PRIORITY_WEIGHT + rssi + reliability * RELIABILITY_WEIGHT
+
+where reliability is the smoothed success ratio (successes + 1) /
+(successes + failures + 2): the priority set by the user comes first,
+then a network that keeps failing loses up to RELIABILITY_WEIGHT dB
+against the reliable ones.
+"""
+import json
+
+from device_logging import Logger
+from storage import atomic_write_json
+
+CREDENTIALS_FORMAT = 1
+PRIORITY_WEIGHT = 100
+RELIABILITY_WEIGHT = 30
+
+
+def parse_legacy(text: str) -> dict:
+    """
+    Parse the json objects of a legacy networks file, written one after
+    the other without separator, the last ones win.
+    """
+    networks = {}
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            if depth == 0:
+                start = position
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                networks.update(json.loads(text[start:position + 1]))
+    return networks
+
+
+class CredentialStore:
+    """
+    The known networks, their passwords and connection history.
+
+    Attributes
+    ----------
+    path : the path of the networks file.
+    networks : a dict containing the entry of each ssid, see the module
+    docstring.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.networks = {}
+        self.logger = Logger("WLAN_CREDENTIALS")
+
+    def load(self) -> None:
+        """
+        Read the networks file, migrating it if it has the legacy format.
+        A missing or unreadable file leaves the store empty.
+        """
+        self.networks = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as networks_file:
+                text = networks_file.read()
+        except OSError:
+            self.logger.warning("no networks file found")
+            return
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.get("format") == (
+            CREDENTIALS_FORMAT
+        ):
+            self.networks = data["networks"]
+            return
+        try:
+            legacy = parse_legacy(text)
+        except ValueError as e:
+            self.logger.error(f"networks file unreadable: {e}")
+            return
+        for ssid, password in legacy.items():
+            self.networks[ssid] = self._entry(password)
+        self.logger.info(f"{len(self.networks)} legacy networks migrated")
+        self.save()
+
+    def save(self) -> None:
+        """ Write the networks file. """
+        atomic_write_json(self.path, {
+            "format": CREDENTIALS_FORMAT,
+            "networks": self.networks,
+        })
+
+    @staticmethod
+    def _entry(password: str, priority: int = 0) -> dict:
+        """ Return the entry of a network never joined. """
+        return {
+            "password": password,
+            "priority": priority,
+            "successes": 0,
+            "failures": 0,
+        }
+
+    def password(self, ssid: str):
+        """ Return the password of a network, None if it is unknown. """
+        entry = self.networks.get(ssid)
+        return None if entry is None else entry["password"]
+
+    def add(self, ssid: str, password: str, priority: int = None) -> None:
+        """
+        Save a network, keeping the history of a known one.
+
+        Parameters
+        ----------
+        ssid : the network ssid.
+        password : the network password.
+        priority : the network priority, unchanged if None.
+        """
+        entry = self.networks.get(ssid)
+        if entry is None:
+            self.networks[ssid] = self._entry(password, priority or 0)
+        elif entry["password"] == password and priority is None:
+            return
+        else:
+            entry["password"] = password
+            if priority is not None:
+                entry["priority"] = priority
+        self.save()
+
+    def remove(self, ssid: str) -> None:
+        """ Forget a network. """
+        if self.networks.pop(ssid, None) is not None:
+            self.save()
+
+    def record(self, ssid: str, success: bool) -> None:
+        """
+        Account a connection attempt to a known network, only a success
+        writes the file.
+        """
+        entry = self.networks.get(ssid)
+        if entry is None:
+            return
+        entry["successes" if success else "failures"] += 1
+        if success:
+            self.save()
+
+    def reliability(self, ssid: str) -> float:
+        """ Return the smoothed success ratio of a known network. """
+        entry = self.networks[ssid]
+        return (entry["successes"] + 1) / (
+            entry["successes"] + entry["failures"] + 2
+        )
+
+    def rank(self, visible) -> list:
+        """
+        Return the known networks among the visible ones, best first.
+
+        Parameters
+        ----------
+        visible : an iterable of (ssid, rssi) of the scanned networks.
+        """
+        scored = []
+        for ssid, rssi in visible:
+            entry = self.networks.get(ssid)
+            if entry is None:
+                continue
+            scored.append((
+                entry["priority"] * PRIORITY_WEIGHT
+                + rssi
+                + self.reliability(ssid) * RELIABILITY_WEIGHT,
+                ssid
+            ))
+        scored.sort(reverse=True)
+        return [ssid for _, ssid in scored]